@@ -14,13 +14,12 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
-from app.routing import websocket_urlpatterns
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'controlfreak.settings')
 
+# Set up Django before the routing imports the consumers and their models
 django_asgi_app = get_asgi_application()
 
-import controlfreakapp.routing
-
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'controlfreak.settings')
+from controlfreakapp.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter(
     {
@@ -84,7 +84,7 @@ DATABASES = {
     }
 }
 
-ASGI_APPLICATION = "progressbar.asgi.application"
+ASGI_APPLICATION = "controlfreak.asgi.application"
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
@@ -93,6 +93,8 @@ CHANNEL_LAYERS = {
         },
     },
 }
+# The most progress messages a report job sends over the channel layer per second
+REPORT_PROGRESS_EVENTS_PER_SECOND = 4
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -136,4 +138,15 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_URL = '/media/'
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Parsed 12d files are cached here by file hash, so re-running a report doesn't decode and parse them again
+PARSE_CACHE_DIR = os.path.join(MEDIA_ROOT, 'parse_cache')
+PARSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Finished reports are cached here by their files and tolerances, so a repeated upload is answered without adjusting again
+REPORT_CACHE_DIR = os.path.join(MEDIA_ROOT, 'report_cache')
+REPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# The largest Hz and Vt tolerance (mm) the tolerance preview can be asked about
+PREVIEW_MAX_TOLERANCE = 20
@@ -1,102 +1,55 @@
-import json
-import time
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from django.core.exceptions import ValidationError
+from .models import ReportJob
+from .utilities.job_progress import job_group
 
 
-class ProgressBarConsumer(WebsocketConsumer):
-    def connect(self):
-        self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-        self.temperature = self.scope["url_route"]["kwargs"]["temperature"]
-        self.room_group_name = f"chat_{self.room_name}"
+class ReportJobConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Sends the progress of a report job to the browser as the run_report_jobs worker publishes it.
 
-        # Join room group
-        async_to_sync(self.channel_layer.group_add)(
-            self.room_group_name, self.channel_name
-        )
+    On connecting the client gets the job's current status, then {"type": "progress", "events": [...]} as the
+    stages run and {"type": "points", "points": [...]} with the one shot and proposed points as they are found.
+    A final {"type": "status", "status": "done" | "failed", "error": ...} is sent and the socket is closed.
+    """
+    FINISHED = (ReportJob.DONE, ReportJob.FAILED)
 
-        self.accept()
+    async def connect(self):
+        self.job_id = int(self.scope["url_route"]["kwargs"]["job_id"])
+        self.group_name = job_group(self.job_id)
 
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                "type": "make_cake",
-                "message": {
-                    "message": "The cake is ready",
-                    "progress": "6",
-                },
-            },
-        )
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
 
-    def disconnect(self, close_code):
-        # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name, self.channel_name
-        )
+        # Joined before the status is read, so nothing published in between is missed
+        job = await database_sync_to_async(ReportJob.objects.filter(pk=self.job_id).first)()
+        if job is None:
+            await self.send_json({"type": "error", "message": f"There is no report job {self.job_id}"})
+            await self.close()
+            return
 
-    def send_progress_msg(self, msg, progress):
-        self.send(
-            text_data=json.dumps(
-                {
-                    "type": "progress",
-                    "message": msg,
-                    "progress": progress,
-                }
-            )
-        )
+        await self.send_json({
+            "type": "status",
+            "status": job.status,
+            "stage": job.stage,
+            "percent": job.percent,
+            "error": job.error,
+        })
+        if job.status in self.FINISHED:
+            await self.close()
 
-    def send_completed_msg(self, msg, progress):
-        self.send(
-            text_data=json.dumps(
-                {
-                    "type": "completed",
-                    "message": msg,
-                    "progress": progress,
-                }
-            )
-        )
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
-    def send_error_msg(self, msg):
-        if not isinstance(msg, str):
-            msg = (
-                msg.args[0] if hasattr(msg, "args") and len(msg.args) > 0 else str(msg)
-            )
-        self.send(text_data=json.dumps({"type": "error", "message": msg}))
+    async def job_progress(self, event):
+        await self.send_json({"type": "progress", "events": event["events"]})
 
-    def make_cake(self, event):
-        message = event["message"]
-        self.send_progress_msg("Gathering Ingredients", 1)
-        self.gather_ingredients()
-        self.send_progress_msg("Preparing the Batter", 2)
-        self.prepare_the_batter()
-        self.send_progress_msg("Preparing Cake Pans", 3)
-        self.prepare_cake_pans()
-        self.send_progress_msg("Baking", 4)
-        try:
-            self.bake()
-        except ValidationError as e:
-            self.send_error_msg(e)
-            return None
-        self.send_progress_msg("Cooling And Frosting", 5)
-        self.cool_and_frost()
-        self.send_completed_msg(message.get("message"), message.get("progress"))
-        self.disconnect(1000)
+    async def job_points(self, event):
+        await self.send_json({"type": "points", "points": event["points"]})
 
-    def gather_ingredients(self):
-        time.sleep(1)
+    async def job_status(self, event):
+        await self.send_json({"type": "status", "status": event["status"], "error": event["error"]})
+        if event["status"] in self.FINISHED:
+            await self.close()
 
-    def prepare_the_batter(self):
-        time.sleep(1)
-
-    def prepare_cake_pans(self):
-        time.sleep(1)
-
-    def bake(self):
-        time.sleep(2)
-        if self.temperature == "high":
-            raise ValidationError("Temperature was too high, the cake burned")
-
-    def cool_and_frost(self):
-        time.sleep(1)
\ No newline at end of file
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from ...utilities.report_jobs import run_worker, POLL_INTERVAL
+
+
+class Command(BaseCommand):
+    help = 'Runs the queued report jobs, waiting for new ones until stopped.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Stop once the queue is empty.')
+        parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                            help='Seconds to wait before looking again when the queue is empty.')
+
+    def handle(self, *args, **options):
+        try:
+            ran = run_worker(once=options['once'], poll_interval=options['poll_interval'])
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(f'Ran {ran} report jobs.')
@@ -0,0 +1,26 @@
+# Generated by Django 4.2 on 2026-10-17 18:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('controlfreakapp', '0003_averagedtertiarycontrolpoint_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='unadjustedtertiarycontrolpoint',
+            name='resection_coordinates',
+        ),
+        migrations.AddField(
+            model_name='tertiarycontrolfile',
+            name='encoding',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='unadjustedtertiarycontrolpoint',
+            constraint=models.UniqueConstraint(fields=('resection', 'coordinates', 'source'), name='resection_coordinates'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2 on 2026-10-17 19:03
+
+import math
+
+from django.db import migrations, models
+
+# Must match SPATIAL_GRID_SIZE in models.py at the time of this migration
+SPATIAL_GRID_SIZE = 1.0
+
+
+def fill_grid_cells(apps, schema_editor):
+    Coordinates = apps.get_model('controlfreakapp', 'Coordinates')
+    batch = []
+    for coordinates in Coordinates.objects.only('pk', 'easting', 'northing').iterator(chunk_size=2000):
+        coordinates.grid_x = math.floor(float(coordinates.easting) / SPATIAL_GRID_SIZE)
+        coordinates.grid_y = math.floor(float(coordinates.northing) / SPATIAL_GRID_SIZE)
+        batch.append(coordinates)
+        if len(batch) == 2000:
+            Coordinates.objects.bulk_update(batch, ['grid_x', 'grid_y'])
+            batch = []
+    Coordinates.objects.bulk_update(batch, ['grid_x', 'grid_y'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('controlfreakapp', '0004_tertiarycontrolfile_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coordinates',
+            name='grid_x',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coordinates',
+            name='grid_y',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='coordinates',
+            index=models.Index(fields=['grid_x', 'grid_y'], name='coordinates_grid_cell'),
+        ),
+        migrations.RunPython(fill_grid_cells, migrations.RunPython.noop),
+    ]
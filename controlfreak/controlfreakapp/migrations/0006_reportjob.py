@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-17 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('controlfreakapp', '0005_coordinates_grid_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('upload', 'Uploaded files'), ('admin', 'Admin selection')], default='upload', max_length=10)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='queued', max_length=10)),
+                ('stage', models.CharField(blank=True, default='', max_length=50)),
+                ('percent', models.IntegerField(default=0)),
+                ('report_name', models.CharField(max_length=255)),
+                ('hz_tolerance', models.FloatField(blank=True, null=True)),
+                ('vt_tolerance', models.FloatField(blank=True, null=True)),
+                ('file_ids', models.JSONField(blank=True, null=True)),
+                ('point_ids', models.JSONField(blank=True, null=True)),
+                ('result', models.FileField(blank=True, null=True, upload_to='reports/')),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
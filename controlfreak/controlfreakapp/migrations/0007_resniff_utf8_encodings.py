@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def clear_utf8_encodings(apps, schema_editor):
+    # UTF-16 without a BOM used to be sniffed as UTF-8, so those files are sniffed again on their next upload
+    TertiaryControlFile = apps.get_model('controlfreakapp', 'TertiaryControlFile')
+    TertiaryControlFile.objects.filter(encoding='utf-8').update(encoding=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('controlfreakapp', '0006_reportjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_utf8_encodings, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,5 @@
 import os
+import math
 import hashlib
 import base64
 import datetime
@@ -9,10 +10,13 @@ from datetime import datetime
 
 from django.db import models
 from django.core.files import File
-from django.db.models.signals import pre_save, post_delete
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from django.conf import settings
+from django.utils import timezone
 from django.db.models import UniqueConstraint
+
+from .utilities.report_cache import invalidate_reports, invalidate_reports_near
 BASE_DIR = settings.BASE_DIR
 
 def extract_and_convert_to_date(file_name):
@@ -89,6 +93,8 @@ class TertiaryControlFile(models.Model):
     uploaded_at = models.DateTimeField(auto_now_add=True)
     file_hash = models.CharField(max_length=32, unique=True, null=True, blank=True)
     observation_date = models.DateField(null=True, blank=True)
+    # Text encoding of the 12d content, sniffed once per file_hash and reused on every reprocess
+    encoding = models.CharField(max_length=32, null=True, blank=True)
 
     @staticmethod
     def delete_original_control(sender, instance, **kwargs):
@@ -121,12 +127,19 @@ class TertiaryControlFile(models.Model):
             self.observation_date = extract_and_convert_to_date(self.file.name)
             super().save(*args, **kwargs)
 
-    def __str__(self):
+    @staticmethod
+    def display_name(file_name, revision) -> str:
+        """
+        The str() of a file from its file name and revision, so it can be built from a values() row.
+        """
         try:
-            return f'{os.path.basename(self.file.name)} {f"- {self.revision}" if self.revision else " "}'
+            return f'{os.path.basename(file_name)} {f"- {revision}" if revision else " "}'
         except TypeError:
             return 'WTF'
 
+    def __str__(self):
+        return self.display_name(self.file.name, self.revision)
+
 
 post_delete.connect(TertiaryControlFile.delete_original_control, sender=TertiaryControlFile)
 
@@ -165,11 +178,35 @@ COORD_FLAVOURS = (
 )
 
 
+# Size in metres of the cells of the spatial grid that Coordinates are indexed on
+SPATIAL_GRID_SIZE = 1.0
+
+
 class Coordinates(models.Model):
     easting = models.DecimalField(max_digits=20, decimal_places=8)
     northing = models.DecimalField(max_digits=20, decimal_places=8)
     elevation = models.DecimalField(max_digits=20, decimal_places=8)
     flavour = models.CharField(max_length=2, choices=COORD_FLAVOURS, null=True, blank=True)
+    # The grid cell the coordinates fall in, so nearby coordinates can be found without scanning every row
+    grid_x = models.IntegerField(null=True, blank=True)
+    grid_y = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['grid_x', 'grid_y'], name='coordinates_grid_cell')
+        ]
+
+    @staticmethod
+    def grid_cell(easting, northing) -> tuple[int, int]:
+        return math.floor(float(easting) / SPATIAL_GRID_SIZE), math.floor(float(northing) / SPATIAL_GRID_SIZE)
+
+    def set_grid_cell(self):
+        self.grid_x, self.grid_y = self.grid_cell(self.easting, self.northing)
+
+    def save(self, *args, **kwargs):
+        # bulk_create skips this, so callers of bulk_create have to call set_grid_cell themselves
+        self.set_grid_cell()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.easting} {self.northing} {self.elevation}, {self.flavour}"
@@ -389,3 +426,133 @@ class AveragedTertiaryControlPoint(models.Model):
     def __str__(self):
         return self.control_id
 
+
+def report_cache_dir():
+    return getattr(settings, 'REPORT_CACHE_DIR', None)
+
+
+def invalidate_reports_of_points(point_ids) -> None:
+    """
+    Deletes the cached reports that used the files of some UnAdjustedTertiaryControlPoints.
+    For the callers of bulk_create and update, which send no signals.
+    """
+    point_ids = sorted({pk for pk in point_ids if pk is not None})
+    file_hashes = set()
+    # Batched to keep the IN (...) lookup under SQLite's parameter limit
+    for i in range(0, len(point_ids), 500):
+        file_hashes.update(TertiaryControlFile.objects.filter(
+            unadjustedtertiarycontrolpoint__pk__in=point_ids[i:i + 500]).values_list('file_hash', flat=True))
+
+    invalidate_reports(report_cache_dir(), file_hashes)
+
+
+@receiver(post_delete, sender=TertiaryControlFile)
+def invalidate_file_reports(sender, instance, **kwargs):
+    """
+    Cached reports that used a file are out of date once it is deleted.
+    """
+    invalidate_reports(report_cache_dir(), [instance.file_hash])
+
+
+@receiver([post_save, post_delete], sender=UnAdjustedTertiaryControlPoint)
+def invalidate_point_reports(sender, instance, **kwargs):
+    """
+    Cached reports that used a file are out of date once any of its points change.
+    """
+    if isinstance(kwargs.get('origin'), TertiaryControlFile):
+        # Deleted along with its file, which has already done this
+        return
+
+    invalidate_reports(report_cache_dir(), TertiaryControlFile.objects.filter(pk=instance.source_id).values_list('file_hash', flat=True))
+    if instance.coordinates_id is not None:
+        # A report of other files would take the point in as history
+        coordinates = Coordinates.objects.filter(pk=instance.coordinates_id).values_list('easting', 'northing')
+        invalidate_reports_near(report_cache_dir(), coordinates)
+
+
+@receiver(post_save, sender=Coordinates)
+def invalidate_coordinates_reports(sender, instance, created, **kwargs):
+    """
+    Cached reports that used a point are out of date once its coordinates are edited.
+    """
+    if created:
+        return
+
+    invalidate_reports(report_cache_dir(), TertiaryControlFile.objects.filter(
+        unadjustedtertiarycontrolpoint__coordinates=instance).values_list('file_hash', flat=True).distinct())
+    # The points may have moved into the area of another report
+    invalidate_reports_near(report_cache_dir(), [(instance.easting, instance.northing)])
+
+
+@receiver(post_delete, sender=AveragedTertiaryControlPoint)
+def invalidate_averaged_reports(sender, instance, **kwargs):
+    """
+    Cached reports that used a seed's file are out of date once its averaged point is deleted, as the seeds are then
+    taken in as history again.
+    """
+    invalidate_reports_of_points([instance.a_seed_id, instance.b_seed_id])
+
+
+class ReportJob(models.Model):
+    """
+    A report that is worked out by the run_report_jobs worker rather than inside the request that asked for it.
+    The worker moves it from QUEUED to RUNNING and then to DONE, with the zip in result, or FAILED, with the error.
+    """
+    UPLOAD = 'upload'
+    ADMIN = 'admin'
+    KIND_CHOICES = [
+        (UPLOAD, 'Uploaded files'),
+        (ADMIN, 'Admin selection'),
+    ]
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=UPLOAD)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    stage = models.CharField(max_length=50, blank=True, default='')
+    percent = models.IntegerField(default=0)
+
+    report_name = models.CharField(max_length=255)
+    hz_tolerance = models.FloatField(null=True, blank=True)
+    vt_tolerance = models.FloatField(null=True, blank=True)
+    # The TertiaryControlFile pks of an UPLOAD job, in the order they were uploaded
+    file_ids = models.JSONField(null=True, blank=True)
+    # The selected UnAdjustedTertiaryControlPoint pks of an ADMIN job
+    point_ids = models.JSONField(null=True, blank=True)
+
+    result = models.FileField(upload_to='reports/', null=True, blank=True)
+    # The message shown to the client, the traceback of a failed job is only kept here for the admin
+    error = models.TextField(blank=True, default='')
+    traceback = models.TextField(blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Updated by the worker as the job makes progress, a running job without one for a while has lost its worker
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # How many times a worker has started the job
+    attempts = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def set_progress(self, stage: str, percent: int) -> None:
+        """
+        Records how far the job has got, without saving the rest of it. This is also the job's heartbeat.
+        """
+        self.stage = stage
+        self.percent = percent
+        self.heartbeat_at = timezone.now()
+        ReportJob.objects.filter(pk=self.pk).update(stage=stage, percent=percent, heartbeat_at=self.heartbeat_at)
+
+    def __str__(self):
+        return f'{self.report_name} ({self.status})'
@@ -3,8 +3,5 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(
-        r"ws/bar/(?P<room_name>\w+)/(?P<temperature>\w+)/$",
-        consumers.ProgressBarConsumer.as_asgi(),
-    ),
+    re_path(r"ws/report_jobs/(?P<job_id>\d+)/$", consumers.ReportJobConsumer.as_asgi()),
 ]
\ No newline at end of file
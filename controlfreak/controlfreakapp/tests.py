@@ -1,3 +1,1207 @@
-from django.test import TestCase
+import codecs
+import contextlib
+import csv
+import dataclasses
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from fuzzywuzzy import fuzz
+
+from django.conf import settings
+from django.core.files import File
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (AveragedTertiaryControlPoint, Coordinates, HelmertResection, OverPointStationSetup, ReportJob, ResectionPoint,
+                     TertiaryControlFile, UnAdjustedTertiaryControlPoint)
+from .utilities import cluster_pool, geometry_manipulation as gm, parse_cache, process_files, report_jobs, similarity, text_from_12d
+from .utilities.CONSTANTS import ControlPoint
+from .utilities.report_cache import report_key
+from .utilities.shot_columns import ShotColumns
+from .utilities.create_django_models import SetupWriter
+from .utilities.fixed_point import to_fixed, from_fixed, fixed_mean, fixed_delta, format_fixed, point_keys
+from .utilities.process_files import create_control_point_objects, iter_adjustment, write_control_file, REPORT_SECTIONS, ONE_SHOT, REPORT, PROPOSED
+from .utilities.spatial_index import find_neighbouring_history
+from .utilities.tolerance_hierarchy import ToleranceHierarchy
+from .utilities.section_index import SectionIndex, parse_attribute, GROUP, CHECK_SHOT, DATA_3D, INST_STAT_SETUP
+from .utilities.station_setup_parser import StationSetupParser, extract_helmert_points
+from .utilities.twelve_da_parser import (parse_control_file, parse_coordinate_block, TwelveDaParser, SuperStringRecord,
+                                         CoordinateBlockRecord, PointNameBlockRecord, StationSetupRecord)
+from .utilities.text_from_12d import TextFrom12dConverter, EncodingRestart, detect_encoding, ZIP_MEMBER_ENCODING
+
+# The sample uploads, and the report they gave at 3 mm before the report was streamed
+SAMPLE_DIR = os.path.join(settings.BASE_DIR.parent, 'test')
+SAMPLE_FILES = ('230131AWB VTB4 SCAN CON.12daz', '230508 AWB MEL3 TERT CON.12daz')
+EXPECTED_3MM_DIR = os.path.join(SAMPLE_DIR, 'expected_3mm')
+
+# The queries write_control_file makes for the MEL3 sample
+QUERY_COUNT = 41
+
+SAMPLE_12DA = 'model "Control"\n{\n  super {\n    name "TAPE"\n    data_3d {\n      1.0 2.0 3.0\n    }\n  }\n}\n' * 20
+
+
+class DetectEncodingTests(SimpleTestCase):
+
+    def test_bom(self):
+        self.assertEqual(detect_encoding(SAMPLE_12DA.encode('utf-16')), ('utf-16', 1.0))
+        self.assertEqual(detect_encoding(codecs.BOM_UTF8 + SAMPLE_12DA.encode()), ('utf-8-sig', 1.0))
+
+    def test_utf16_without_bom(self):
+        self.assertEqual(detect_encoding(SAMPLE_12DA.encode('utf-16-le'))[0], 'utf-16-le')
+        self.assertEqual(detect_encoding(SAMPLE_12DA.encode('utf-16-be'))[0], 'utf-16-be')
+
+    def test_utf8(self):
+        self.assertEqual(detect_encoding(SAMPLE_12DA.encode()), ('utf-8', 0.99))
+        # A multibyte character cut off by the end of the prefix
+        self.assertEqual(detect_encoding(('x' + 'é').encode()[:-1])[0], 'utf-8')
+
+    def test_nul_is_never_utf8(self):
+        encoding, _ = detect_encoding(b'abc\x00def' * 10)
+        self.assertNotEqual(encoding, 'utf-8')
+
+    def test_fallback(self):
+        self.assertEqual(detect_encoding(b'\xff\xfe\xfd\x00\x01' * 10, fallback=ZIP_MEMBER_ENCODING)[0], ZIP_MEMBER_ENCODING)
+
+
+class StreamLinesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_12daz_member_without_bom(self):
+        path = os.path.join(self.directory, 'member.12daz')
+        with zipfile.ZipFile(path, 'w') as zip_file:
+            zip_file.writestr('member.12da', SAMPLE_12DA.encode('utf-16-le'))
+
+        converter = TextFrom12dConverter(path)
+        self.assertEqual(list(converter.iter_12da_lines()), [line.rstrip() for line in SAMPLE_12DA.splitlines()])
+        self.assertEqual(converter.encoding, 'utf-16-le')
+
+    def test_encoding_restart(self):
+        path = os.path.join(self.directory, 'latin.12da')
+        # The é is past the prefix the encoding is sniffed from
+        lines = ['a'] * 50000 + ['é', 'z']
+        with open(path, 'wb') as f:
+            f.write('\n'.join(lines).encode('cp1252'))
+
+        converter = TextFrom12dConverter(path)
+        with self.assertRaises(EncodingRestart) as restart:
+            list(converter.iter_12da_lines())
+
+        # Started again with the encoding of the whole file, every line comes out once
+        restarted = list(TextFrom12dConverter(path, restart.exception.encoding).iter_12da_lines())
+        self.assertEqual(restarted, lines)
+
+    def test_bad_byte_after_prefix_is_raised(self):
+        path = os.path.join(self.directory, 'bad.12da')
+        # Plain UTF-8 in the prefix, with a byte that is never UTF-8 past it
+        with open(path, 'wb') as f:
+            f.write(b'a\n' * 50000 + b'\xff\n' + b'z\n')
+
+        # The whole file sniffs as the same codec, so there is nothing to restart with
+        with mock.patch.object(text_from_12d, 'get_full_file_encoding', return_value=('utf-8', 0.99)):
+            with self.assertRaises(UnicodeDecodeError):
+                list(TextFrom12dConverter(path).iter_12da_lines())
+
+            with self.assertRaises(UnicodeDecodeError):
+                parse_control_file(path, None)
+
+    def test_bad_byte_on_second_pass_is_raised(self):
+        path = os.path.join(self.directory, 'bad_first_line.12da')
+        with open(path, 'wb') as f:
+            f.write(b'\xe9\n' + b'a\n' * 10 + b'\xff\xfe\x00\n')
+
+        # The first line already fails as ASCII, and the file isn't UTF-8 either
+        with mock.patch.object(text_from_12d, 'get_full_file_encoding', return_value=('utf-8', 0.99)):
+            with self.assertRaises(UnicodeDecodeError):
+                list(TextFrom12dConverter(path, 'ascii').iter_12da_lines())
+
+
+# A cut down 12da file: a super string with a Helmert resection, then an unnamed one with an over the point setup
+PARSER_12DA = '''model "Control"
+string super {
+  name      "TAPE"
+  data_3d {
+    100.0 200.0 10.0
+    101.0 201.0 11.0
+    102.0 202.0 12.0
+  }
+  point_data {
+    "CP1" "CP2" "CP2"
+  }
+  vertex_attribute_data {
+    attributes {
+      group {
+        name "12dField"
+        attributes {
+          group {
+            name "Inst Stat Setup"
+            attributes {
+              text    "is_id"   "HELM0020"
+              real    "is_x"   101.5
+              real    "is_y"   199.5
+              real    "is_z"   10.5
+              real    "is_z_orig"   5.5
+              real    "is_hi"   1
+              real    "is_bearing_swing"   1.87109214
+              text    "is_utc_time_text"   "2023/04/27 23:34:13"
+              text    "setup_type"   "Helmert"
+              real    "is_helm_pos_error"   0.00100354
+              real    "is_helm_scale_factor"   0.99998686
+              real    "is_helm_level_diff"   0.00107448
+              group {
+                name "Helmert Details"
+                attributes {
+                  text    "helm_id_1"   "L306"
+                  real    "helm_x_1"   105.62
+                  real    "helm_y_1"   181.735
+                  real    "helm_z_1"   30.72912
+                  integer "helm_use_xy_1"   1
+                  integer "helm_tps_reflector_type_1"   101
+                  text    "helm_tps_reflector_type_as_text_1"   "Leica mini-16.9"
+                  integer "helm_inst_meas_style_1"   8
+                  text    "helm_inst_meas_style_text_1"   "Multiface"
+                  integer "helm_tps_settings_1"   10
+                  text    "helm_tps_settings_text_1"   "Infrared Std EDM Auto Locked"
+                  text    "helm_id_2"   "L307"
+                  real    "helm_x_2"   95.376
+                }
+              }
+            }
+          }
+          group {
+            name "Check Shot"
+            attributes {
+              text    "cs_id"   "L308"
+            }
+          }
+          group {
+            name "Inst Stat Setup"
+            attributes {
+              text    "is_id"   "HELM0021"
+            }
+          }
+        }
+      }
+    }
+  }
+}
+string super {
+  name      ""
+  data_3d {
+    300.0 400.0 20.0
+  }
+  point_data {
+    "CP3"
+  }
+  vertex_attribute_data {
+    attributes {
+      group {
+        name "Inst Stat Setup"
+        attributes {
+          text    "is_id"   "STN0001"
+          real    "is_x"   300.5
+          real    "is_y"   399.5
+          real    "is_z"   20.5
+          real    "is_z_orig"   20.5
+          real    "is_hi"   1.5
+          real    "is_bearing_swing"   0.5
+          text    "is_utc_time_text"   "2023/04/27 23:40:00"
+          text    "setup_type"   "Known Point"
+          text    "bs_id"   "L306"
+          real    "bs_ht"   0.1
+          real    "bs_x"   105.62
+          real    "bs_y"   181.735
+          real    "bs_z"   30.72912
+          real    "bs_diff_hd"   0.001
+          real    "bs_diff_x"   0.001
+          real    "bs_diff_y"   -0.001
+          real    "bs_diff_z"   0.002
+          text    "bs_model_ref"   "CON"
+        }
+      }
+    }
+  }
+}
+'''
+
+
+class ParseCoordinateBlockTests(SimpleTestCase):
+
+    def test_block(self):
+        coordinates = parse_coordinate_block(['1.5 2.5 3.5', '  -4 5e1 6  '])
+        self.assertEqual(coordinates.dtype, np.float64)
+        self.assertEqual(coordinates.tolist(), [[1.5, 2.5, 3.5], [-4.0, 50.0, 6.0]])
+
+    def test_ragged_lines(self):
+        # Extra values on a line are dropped and parsing goes on
+        self.assertEqual(parse_coordinate_block(['1 2 3 4', '5 6 7', '8 9 10']).tolist(),
+                         [[1.0, 2.0, 3.0], [5.0, 6.0, 7.0], [8.0, 9.0, 10.0]])
+
+    def test_stops_at_first_non_coordinate(self):
+        # The same number of values as a clean block, so only the per line fallback can find where it ends
+        self.assertEqual(parse_coordinate_block(['1 2 3', 'a b c', '4 5 6']).tolist(), [[1.0, 2.0, 3.0]])
+
+    def test_empty(self):
+        self.assertEqual(parse_coordinate_block([]).shape, (0, 3))
+        self.assertEqual(parse_coordinate_block(['name "x"']).shape, (0, 3))
+
+
+class SectionIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lines = PARSER_12DA.splitlines()
+
+    def offsets(self, text):
+        return [offset for offset, line in enumerate(self.lines) if text in line]
+
+    def test_from_lines_matches_parser(self):
+        parser = TwelveDaParser(self.lines)
+        list(parser)
+        index = SectionIndex.from_lines(self.lines)
+
+        self.assertEqual(index.offsets, parser.section_index.offsets)
+        self.assertEqual(index.offsets[INST_STAT_SETUP], self.offsets(INST_STAT_SETUP))
+        self.assertEqual(index.offsets[CHECK_SHOT], self.offsets(CHECK_SHOT))
+        self.assertEqual(index.offsets[DATA_3D], self.offsets('data_3d {'))
+        self.assertEqual(index.offsets[GROUP], self.offsets(GROUP))
+
+    def test_find(self):
+        index = SectionIndex.from_lines(self.lines)
+        setups = self.offsets(INST_STAT_SETUP)
+
+        self.assertEqual(index.find(INST_STAT_SETUP), setups[0])
+        self.assertEqual(index.find(INST_STAT_SETUP, setups[0] + 1), setups[1])
+        self.assertEqual(index.find(INST_STAT_SETUP, setups[0], setups[0]), None)
+        self.assertEqual(index.find(CHECK_SHOT, self.offsets(CHECK_SHOT)[0] + 1), None)
+
+    def test_window(self):
+        index = SectionIndex.from_lines(self.lines)
+        start, stop = self.offsets(INST_STAT_SETUP)[:2]
+
+        window = index.window(start, stop)
+        self.assertEqual(window.offsets[INST_STAT_SETUP], [0])
+        self.assertEqual(window.offsets[CHECK_SHOT], [self.offsets(CHECK_SHOT)[0] - start])
+        self.assertEqual(window.offsets[DATA_3D], [])
+        self.assertEqual(window.offsets, SectionIndex.from_lines(self.lines[start:stop]).offsets)
+
+    def test_parse_attribute(self):
+        self.assertEqual(parse_attribute('              real    "is_x"   101.5'), ('is_x', '101.5'))
+        self.assertEqual(parse_attribute('  text    "is_id"   "HELM0020"'), ('is_id', 'HELM0020'))
+        self.assertEqual(parse_attribute('  text    "pu_cs_plm_hz_kpt_ch"   ""'), ('pu_cs_plm_hz_kpt_ch', ''))
+        self.assertEqual(parse_attribute('}'), None)
+
+
+class TwelveDaParserTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lines = PARSER_12DA.splitlines()
+        self.records = list(TwelveDaParser(self.lines))
+
+    def of_type(self, record_type):
+        return [record for record in self.records if isinstance(record, record_type)]
+
+    def test_super_strings(self):
+        self.assertEqual([record.name for record in self.of_type(SuperStringRecord)], ['TAPE', 'Not specified'])
+
+    def test_coordinate_blocks(self):
+        blocks = self.of_type(CoordinateBlockRecord)
+        self.assertEqual([self.lines[block.line_number].strip() for block in blocks], ['data_3d {'] * 2)
+        self.assertEqual(blocks[0].coordinates.tolist(), [[100.0, 200.0, 10.0], [101.0, 201.0, 11.0], [102.0, 202.0, 12.0]])
+        self.assertEqual(blocks[1].coordinates.tolist(), [[300.0, 400.0, 20.0]])
+
+    def test_point_name_blocks(self):
+        self.assertEqual([record.names for record in self.of_type(PointNameBlockRecord)], [['CP1', 'CP2', 'CP2'], ['CP3']])
+
+    def test_record_order(self):
+        self.assertEqual([type(record) for record in self.records], [
+            SuperStringRecord, CoordinateBlockRecord, PointNameBlockRecord, StationSetupRecord,
+            SuperStringRecord, CoordinateBlockRecord, PointNameBlockRecord, StationSetupRecord,
+        ])
+
+    def test_only_first_setup_after_data_3d(self):
+        setups = self.of_type(StationSetupRecord)
+        self.assertEqual([self.lines[setup.line_number] for setup in setups], [setup.lines[0] for setup in setups])
+        self.assertEqual([setup.line_number for setup in setups],
+                         [offset for offset, line in enumerate(self.lines) if INST_STAT_SETUP in line][::2][:2])
+        self.assertNotIn('HELM0021', '\n'.join(line for setup in setups for line in setup.lines))
+
+    def test_setup_window(self):
+        setup = self.of_type(StationSetupRecord)[0]
+        self.assertEqual(setup.section_index.offsets, SectionIndex.from_lines(setup.lines).offsets)
+
+    def test_unclosed_block(self):
+        records = list(TwelveDaParser(['data_3d {', '1 2 3', '4 5 6']))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].coordinates.tolist(), [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+
+
+class StationSetupParserTests(SimpleTestCase):
+
+    def setUp(self):
+        self.setups = [record for record in TwelveDaParser(PARSER_12DA.splitlines()) if isinstance(record, StationSetupRecord)]
+
+    def test_resection(self):
+        setup_data = StationSetupParser(self.setups[0].lines, 0, self.setups[0].section_index).return_setup_data()
+
+        self.assertTrue(setup_data.is_helmert_resection)
+        self.assertEqual(setup_data.setup['is_id'], 'HELM0020')
+        self.assertEqual(setup_data.setup['is_x'], '101.5')
+        self.assertEqual(setup_data.setup['setup_type'], 'Helmert')
+        self.assertEqual(setup_data.setup['is_helm_scale_factor'], '0.99998686')
+        self.assertNotIn('bs_id', setup_data.setup)
+
+        # The second point has no settings text, so it isn't complete
+        self.assertEqual([point['helm_id'] for point in setup_data.resection_points], ['L306'])
+        point = setup_data.resection_points[0]
+        self.assertEqual((point['helm_x'], point['helm_y'], point['helm_z']), ('105.62', '181.735', '30.72912'))
+
+    def test_over_point(self):
+        setup_data = StationSetupParser(self.setups[1].lines, 0, self.setups[1].section_index).return_setup_data()
+
+        self.assertFalse(setup_data.is_helmert_resection)
+        self.assertEqual(setup_data.setup['is_id'], 'STN0001')
+        self.assertEqual(setup_data.setup['bs_id'], 'L306')
+        self.assertEqual(setup_data.setup['bs_diff_y'], '-0.001')
+        self.assertNotIn('is_helm_pos_error', setup_data.setup)
+        self.assertEqual(setup_data.resection_points, [])
+
+    def test_builds_its_own_index(self):
+        lines = self.setups[0].lines
+        self.assertEqual(StationSetupParser(lines, 0).return_setup_data(),
+                         StationSetupParser(lines, 0, self.setups[0].section_index).return_setup_data())
+
+    def test_extract_helmert_points(self):
+        points = extract_helmert_points({
+            'helm_id_2': 'B', 'helm_tps_settings_text_2': 'Reflectorless',
+            'helm_id_1': 'A', 'helm_x_1': '1.5', 'helm_tps_settings_text_1': 'Infrared Std EDM Auto Locked',
+            'helm_tps_reflector_type_1': '101', 'helm_tps_reflector_type_as_text_1': 'Leica mini-16.9',
+            'helm_inst_meas_style_1': '8', 'helm_inst_meas_style_text_1': 'Multiface', 'helm_tps_settings_1': '10',
+            'helm_id_3': 'C',
+            'is_x': '0',
+        })
+
+        # In the order the numbers first appear, and only the points with a settings text
+        self.assertEqual([point['helm_id'] for point in points], ['B', 'A'])
+        self.assertEqual(points[1]['helm_x'], '1.5')
+        self.assertEqual(points[1]['reflector_id'], '101')
+        self.assertEqual((points[1]['reflector_type'], points[1]['reflector_constant']), ('Leica mini', -16.9))
+        self.assertEqual((points[1]['ms_id'], points[1]['ms_name']), ('8', 'Multiface'))
+        self.assertEqual((points[1]['set_id'], points[1]['set_name']), ('10', 'Infrared Std EDM Auto Locked'))
+
+        # A point without the optional text attributes
+        self.assertEqual((points[0]['reflector_id'], points[0]['reflector_type'], points[0]['reflector_constant']), (None, '', None))
+        self.assertEqual(points[0]['set_name'], 'Reflectorless')
+
+
+class ParseControlFileTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'control.12da')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(PARSER_12DA)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_events(self):
+        parsed = parse_control_file(self.path)
+        self.assertEqual(parsed.encoding, 'utf-8')
+        self.assertEqual([kind for kind, _ in parsed.events], ['coordinates', 'points', 'setup', 'setup', 'coordinates', 'points', 'setup'])
+
+        # The repeated CP2 shot is only kept once
+        points = [event for kind, event in parsed.events if kind == 'points']
+        self.assertEqual(points[0].as_rows(), [['CP1', 100.0, 200.0, 10.0, 'TAPE'], ['CP2', 101.0, 201.0, 11.0, 'TAPE']])
+        self.assertEqual(points[1].as_rows(), [['CP3', 300.0, 400.0, 20.0, 'Not specified']])
+
+        # Every setup is parsed, including the second one after the first data_3d block,
+        # which has no group after its attributes and is short enough to read as a resection
+        setups = [event for kind, event in parsed.events if kind == 'setup']
+        self.assertEqual([setup.setup['is_id'] for setup in setups], ['HELM0020', 'HELM0021', 'STN0001'])
+        self.assertEqual([setup.is_helmert_resection for setup in setups], [True, True, False])
+
+
+class ParseCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.path = os.path.join(self.directory, 'control.12da')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write(PARSER_12DA)
+        self.parsed = parse_control_file(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entries(self):
+        return sorted(os.listdir(os.path.join(self.cache_dir, f'v{parse_cache.PARSE_CACHE_VERSION}')))
+
+    def test_round_trip(self):
+        parse_cache.store_parsed_file(self.cache_dir, 'abc', self.parsed, 10 ** 6)
+        loaded = parse_cache.load_parsed_file(self.cache_dir, 'abc')
+
+        self.assertEqual(loaded.encoding, self.parsed.encoding)
+        self.assertEqual([kind for kind, _ in loaded.events], [kind for kind, _ in self.parsed.events])
+        for (kind, value), (_, expected) in zip(loaded.events, self.parsed.events):
+            if kind == 'points':
+                # Read straight from the file rather than copied into memory
+                self.assertIsInstance(value.coordinates, np.memmap)
+                self.assertEqual(value.as_rows(), expected.as_rows())
+            else:
+                self.assertEqual(value, expected)
+
+    def test_missing_entry(self):
+        self.assertIsNone(parse_cache.load_parsed_file(self.cache_dir, 'abc'))
+
+    def test_unreadable_entry(self):
+        parse_cache.store_parsed_file(self.cache_dir, 'abc', self.parsed, 10 ** 6)
+        with open(os.path.join(self.cache_dir, f'v{parse_cache.PARSE_CACHE_VERSION}', 'abc', parse_cache.METADATA_FILE), 'w') as f:
+            f.write('{')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(parse_cache.load_parsed_file(self.cache_dir, 'abc'))
+
+    def test_parsed_once(self):
+        with mock.patch.object(parse_cache, 'parse_control_file', wraps=parse_control_file) as parse:
+            first = parse_cache.parse_control_file_cached(self.path, None, 'abc', self.cache_dir, 10 ** 6)
+            second = parse_cache.parse_control_file_cached(self.path, None, 'abc', self.cache_dir, 10 ** 6)
+            parse_cache.parse_control_file_cached(self.path, None, None, self.cache_dir, 10 ** 6)
+            parse_cache.parse_control_file_cached(self.path, None, 'abc', None, 10 ** 6)
+
+        # Once to fill the cache, then once each without a hash or without a cache
+        self.assertEqual(parse.call_count, 3)
+        self.assertEqual([kind for kind, _ in first.events], [kind for kind, _ in second.events])
+
+    def test_older_versions_are_cleared(self):
+        for name in ('v1', 'v2', 'other'):
+            os.makedirs(os.path.join(self.cache_dir, name, 'abc'))
+
+        parse_cache.store_parsed_file(self.cache_dir, 'abc', self.parsed, 10 ** 6)
+
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), ['other', f'v{parse_cache.PARSE_CACHE_VERSION}'])
+        self.assertEqual(self.entries(), ['abc'])
+
+    def test_least_recently_used_are_evicted(self):
+        for name in ('a', 'b', 'c'):
+            parse_cache.store_parsed_file(self.cache_dir, name, self.parsed, 10 ** 6)
+        version_dir = os.path.join(self.cache_dir, f'v{parse_cache.PARSE_CACHE_VERSION}')
+        for age, name in enumerate('abc'):
+            os.utime(os.path.join(version_dir, name), (1000 + age, 1000 + age))
+        size = parse_cache._entry_size(os.path.join(version_dir, 'a'))
+
+        # Loading a makes it the most recently used, so b is now the oldest
+        parse_cache.load_parsed_file(self.cache_dir, 'a')
+        parse_cache.store_parsed_file(self.cache_dir, 'd', self.parsed, 3 * size)
+
+        self.assertEqual(self.entries(), ['a', 'c', 'd'])
+
+        parse_cache.evict_least_recently_used(version_dir, 0)
+        self.assertEqual(self.entries(), [])
+
+
+class FixedPointTests(SimpleTestCase):
+
+    def test_to_fixed(self):
+        self.assertEqual(to_fixed(51710.27807), 5171027807000)
+        self.assertEqual(to_fixed(Decimal('51710.27807000')), 5171027807000)
+        self.assertEqual(to_fixed(-2.97468824), -297468824)
+        self.assertEqual(to_fixed(0), 0)
+
+    def test_to_fixed_rounds_to_the_nearest_1e8(self):
+        self.assertEqual(to_fixed(1e-8), 1)
+        self.assertEqual(to_fixed(-1e-8), -1)
+        self.assertEqual(to_fixed(0.49e-8), 0)
+        self.assertEqual(to_fixed(0.51e-8), 1)
+        self.assertEqual(to_fixed(-0.51e-8), -1)
+        # A stored 8 place Decimal read back as a float keeps its last place
+        self.assertEqual(to_fixed(float(Decimal('159199.31670019'))) - to_fixed(float(Decimal('159199.31670018'))), 1)
+
+    def test_from_fixed_rounds_half_to_even(self):
+        self.assertEqual(from_fixed(1234567891), 12.34567891)
+        self.assertEqual(from_fixed(1234550000, 3), 12.346)
+        self.assertEqual(from_fixed(1234650000, 3), 12.346)
+        self.assertEqual(from_fixed(-1234550000, 3), -12.346)
+
+    def test_fixed_mean_matches_decimal_mean(self):
+        rng = random.Random(2)
+        for _ in range(500):
+            decimals = [Decimal(rng.randint(-10 ** 13, 10 ** 13)) / 10 ** 8 for _ in range(rng.randint(1, 4))]
+            expected = float(round(sum(decimals) / len(decimals), 3))
+            self.assertEqual(fixed_mean([float(d) for d in decimals]), expected, decimals)
+
+        # Halves round to even, as round() does a Decimal
+        self.assertEqual(fixed_mean([0.0005, 0.0005]), 0.0)
+        self.assertEqual(fixed_mean([0.0015]), 0.002)
+        self.assertEqual(fixed_mean([-0.0025]), -0.002)
+
+    def test_fixed_delta(self):
+        self.assertNotEqual(0.3 - 0.1, 0.2)
+        self.assertEqual(fixed_delta(0.3, 0.1), 0.2)
+        self.assertEqual(fixed_delta(-3.459, -3.45896541), -0.00003459)
+        self.assertEqual(fixed_delta(51710.27807001, 51710.27807), 1e-8)
+        self.assertEqual(fixed_delta(51710.27807, 51710.27807), 0)
+
+    def test_format_fixed(self):
+        self.assertEqual(format_fixed(51710.279), '51710.27900000')
+        self.assertEqual(format_fixed(-0.00003459), '-0.00003459')
+        self.assertEqual(format_fixed(Decimal('-2.97468824')), '-2.97468824')
+        self.assertEqual(format_fixed(0.0020069769127720426), '0.00200698')
+
+    def test_point_keys(self):
+        points = [
+            ControlPoint('A', 51710.27807, 159199.31670018, 33.16902889, 'TAPE', 4, 4, 'file', False),
+            ControlPoint('B', float(Decimal('51710.27807000')), 159199.31670018, 33.16902889, 'TAPE', 4, 4, 'file', False),
+            ControlPoint('C', 51710.27807, 159199.31670019, 33.16902889, 'TAPE', 4, 4, 'file', False),
+            ControlPoint('D', -1e-8, -0.49e-8, -2.97468824, 'TAPE', 4, 4, 'file', False),
+        ]
+        keys = point_keys(points)
+
+        self.assertEqual(keys[0], (5171027807000, 15919931670018, 3316902889))
+        self.assertEqual(keys[0], keys[1])
+        # 1e-8 apart is a different point
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertEqual(keys[3], (-1, 0, -297468824))
+        self.assertEqual(point_keys([]), [])
+
+
+class EvaluateClustersTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.groups = []
+        for g in range(60):
+            x, y, z = rng.uniform(0, 1000), rng.uniform(0, 1000), rng.uniform(0, 50)
+            shots = []
+            for k in range(rng.randint(1, 4)):
+                pt = ControlPoint(rng.choice(['CP1', 'CP_1', 'TP2']), x + rng.uniform(-.004, .004), y + rng.uniform(-.004, .004),
+                                  z + rng.uniform(-.004, .004), rng.choice(['PRISM', 'TARGET']), 4, 4, 'file', False)
+                shots.append({(g, k): pt})
+            self.groups.append(shots)
+
+    def test_pool_matches_serial(self):
+        serial = cluster_pool.evaluate_clusters(self.groups, .0039, .0039)
+        with mock.patch.object(cluster_pool, 'POOL_MIN_CLUSTERS', 0):
+            pooled = cluster_pool.evaluate_clusters(cluster_pool.pack_clusters(self.groups), .0039, .0039, max_workers=2)
+
+        self.assertEqual(serial, pooled)
+        self.assertTrue(any(result is None for result in serial))
+        self.assertTrue(any(result is not None and result[4] is not None for result in serial))
+
+    def test_pair(self):
+        clusters = cluster_pool.pack_clusters(self.groups)
+        for k, result in enumerate(cluster_pool.evaluate_clusters(clusters, .0039, .0039)):
+            if result is not None:
+                i, j = result[:2]
+                shots = [pt for shot in self.groups[k] for pt in shot.values()]
+                self.assertEqual(clusters.pair(k, i, j), (shots[i], shots[j]))
+
+    def test_columns_match_control_points(self):
+        points = [pt for shots in self.groups for shot in shots for pt in shot.values()]
+        # A repeated shot with another id, which the grouping keeps once
+        points.append(dataclasses.replace(points[0], id='CP9'))
+        columns = ShotColumns([pt.id for pt in points], [pt.target_type for pt in points], ['file'] * len(points),
+                              np.array([(pt.easting, pt.northing, pt.elevation) for pt in points]))
+
+        one_shot, clusters = gm.group_control_points(columns.control_points(), .0039, .0039)
+        one_shot_rows, cluster_rows = gm.group_point_array(columns.point_array, .0039, .0039)
+
+        self.assertEqual({key: columns[row] for key, row in one_shot_rows.items()}, one_shot)
+        self.assertEqual({label: [{key: columns[row]} for key, row in group.items()] for label, group in cluster_rows.items()}, clusters)
+
+        packed = cluster_pool.pack_clusters(clusters.values())
+        packed_rows = cluster_pool.pack_clusters(cluster_rows.values(), columns=columns)
+        self.assertTrue(np.array_equal(packed.points, packed_rows.points))
+        self.assertEqual((packed.offsets, packed.keys, packed.ids, packed.target_types),
+                         (packed_rows.offsets, packed_rows.keys, packed_rows.ids, packed_rows.target_types))
+
+        serial = cluster_pool.evaluate_clusters(packed, .0039, .0039)
+        with mock.patch.object(cluster_pool, 'POOL_MIN_CLUSTERS', 0):
+            self.assertEqual(cluster_pool.evaluate_clusters(packed_rows, .0039, .0039, max_workers=2), serial)
+        for k, result in enumerate(serial):
+            if result is not None:
+                self.assertEqual(packed_rows.pair(k, *result[:2]), packed.pair(k, *result[:2]))
+
+
+def reference_labels(point_array, neighbours):
+    """
+    DBSCAN with min_samples=2 done by hand: every point with a neighbour is a core point, each group of core points
+    that reach each other is a cluster, numbered in order of its first point, and a point with no neighbours is -1.
+    """
+    n = len(point_array)
+    adjacent = [[j for j in range(n) if j != i and neighbours(point_array[i], point_array[j])] for i in range(n)]
+    labels = [-1] * n
+    cluster = 0
+    for i in range(n):
+        if labels[i] != -1 or not adjacent[i]:
+            continue
+        labels[i] = cluster
+        stack = [i]
+        while stack:
+            for j in adjacent[stack.pop()]:
+                if labels[j] == -1:
+                    labels[j] = cluster
+                    stack.append(j)
+        cluster += 1
+    return labels
+
+
+class NeighbourLabelsTests(SimpleTestCase):
+
+    def setUp(self):
+        # Shots of the same points a few mm apart, so groups chain, split and touch the tolerances
+        rng = np.random.default_rng(2)
+        centres = rng.uniform([0, 0, 0], [2, 2, .2], size=(40, 3))
+        self.point_array = centres[rng.integers(0, 40, 200)] + rng.normal(0, .02, (200, 3))
+
+    def test_sphere_matches_dbscan(self):
+        labels = gm.neighbour_labels(self.point_array, .05)
+        expected = reference_labels(self.point_array, lambda a, b: np.linalg.norm(a - b) <= .05)
+
+        self.assertEqual(labels.tolist(), expected)
+        self.assertIn(-1, expected)
+        self.assertGreater(max(expected), 10)
+
+    def test_cylinder_matches_dbscan(self):
+        labels = gm.neighbour_labels(self.point_array, .05, .02)
+        expected = reference_labels(self.point_array, lambda a, b: math.hypot(*(a - b)[:2]) <= .05 and abs(a[2] - b[2]) <= .02)
+
+        self.assertEqual(labels.tolist(), expected)
+        self.assertNotEqual(expected, reference_labels(self.point_array, lambda a, b: np.linalg.norm(a - b) <= .05))
+
+    @skipUnless(importlib.util.find_spec('sklearn'), 'scikit-learn is not installed')
+    def test_sphere_matches_sklearn(self):
+        from sklearn.cluster import DBSCAN
+
+        expected = DBSCAN(eps=.05, min_samples=2).fit(self.point_array).labels_
+        self.assertEqual(gm.neighbour_labels(self.point_array, .05).tolist(), expected.tolist())
+
+    def test_cylinder_edge(self):
+        # Point 3 is inside the scaled sphere but above the cylinder, the corner of the cylinder is hz_dist * sqrt(2) from its centre once the elevations are scaled
+        point_array = np.array([[0, 0, 0], [3, 0, 1.5], [0, 3, -1.5], [0, 0, 2], [-3.001, 0, 0], [0, -3, -1.501]], dtype=np.float64)
+
+        pairs = gm.cylinder_pairs(point_array, 3, 1.5)
+
+        self.assertEqual(sorted(map(tuple, pairs.tolist())), [(0, 1), (0, 2), (1, 3)])
+        self.assertEqual(gm.neighbour_labels(point_array, 3, 1.5).tolist(), [0, 0, 0, 0, -1, -1])
+
+    def test_flat_cylinder(self):
+        point_array = np.array([[0, 0, 0], [1, 0, 0], [0, 0, .001]], dtype=np.float64)
+
+        self.assertEqual(gm.cylinder_pairs(point_array, 1, 0).tolist(), [[0, 1]])
+
+
+# Ids and target types as they are shot, with the spaces, case, punctuation and blanks that token_sort_ratio cleans up
+SIMILARITY_STRINGS = ['CP1', 'CP 1', 'cp1', 'CP_1', 'CP1A', 'CHK CP1', 'TP2', '2 TP', '008C', 'S07', 'PRISM', 'Prism 360',
+                      '360 PRISM', 'TARGET', 'TARGET-PSHT', 'Ünïcode', '', '  ', '!!']
+
+
+def token_sort_average(string, string_list):
+    """
+    The average similarity as it was scored before the cache, straight from fuzz.token_sort_ratio.
+    """
+    scores = [fuzz.token_sort_ratio(string, s) for s in string_list]
+    return sum(scores) / len(scores)
+
+
+class SimilarityTests(SimpleTestCase):
+
+    def setUp(self):
+        rng = random.Random(3)
+        self.groups = [
+            (rng.choices(SIMILARITY_STRINGS, k=rng.randint(1, 6)), rng.choices(SIMILARITY_STRINGS, k=rng.randint(1, 6)))
+            for _ in range(200)
+        ]
+
+    def test_scores_match_token_sort_ratio(self):
+        for a in SIMILARITY_STRINGS:
+            for b in SIMILARITY_STRINGS:
+                self.assertEqual(similarity.token_sort_score(a, b), fuzz.token_sort_ratio(a, b), (a, b))
+                self.assertEqual(similarity.normalized_score(similarity.normalize(a), similarity.normalize(b)),
+                                 fuzz.token_sort_ratio(a, b), (a, b))
+
+    def test_most_similar_matches_token_sort_ratio(self):
+        for candidates, string_list in self.groups:
+            expected = max(candidates, key=lambda s: token_sort_average(s, string_list))
+            self.assertEqual(similarity.most_similar(candidates, string_list), expected)
+
+        with self.assertRaises(ValueError):
+            similarity.most_similar([], SIMILARITY_STRINGS)
+
+    def test_resolver_matches_token_sort_ratio(self):
+        def best_code(codes):
+            return max(codes, key=lambda s: token_sort_average(s, codes))
+
+        def best_name(names):
+            return max(names, key=lambda s: token_sort_average(s, names))
+
+        groups = [(codes, names) for codes, names in self.groups] * 2
+        resolved = similarity.BestMatchResolver(best_code, best_name).resolve(groups)
+
+        self.assertEqual(resolved, [(best_code(codes), best_name(names)) for codes, names in groups])
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(gm.resolve_best_codes_and_names(groups),
+                             [(gm.get_best_code(codes), gm.get_best_name(names)) for codes, names in groups])
+
+
+def save_samples():
+    """
+    Saves the sample files the way the upload does.
+    """
+    files = []
+    for name in SAMPLE_FILES:
+        with open(os.path.join(SAMPLE_DIR, name), 'rb') as f:
+            obj = TertiaryControlFile(file=File(f, name=name))
+            file_hash = obj.save()
+        if file_hash is not None:
+            obj = TertiaryControlFile.objects.get(file_hash=file_hash)
+        files.append(obj)
+    return files
+
+
+def ingest_samples():
+    """
+    Saves and ingests the sample files, returning the files and their points.
+    """
+    files = save_samples()
+    with contextlib.redirect_stdout(io.StringIO()):
+        points = [point for obj in files for point in create_control_point_objects(obj)]
+    return files, points
+
+
+def normalize_rows(rows):
+    """
+    Rows as strings, with the numbers rounded to 6 places so Decimal and float renderings of a value compare equal.
+    """
+    normalized = []
+    for row in rows:
+        cells = []
+        for cell in row:
+            try:
+                cells.append(round(float(cell), 6))
+            except (TypeError, ValueError):
+                # As the csv module writes it
+                cells.append('' if cell is None else str(cell))
+        normalized.append(cells)
+    return normalized
+
+
+class SampleTestCase(TestCase):
+    """
+    Gives each test its own media directory and turns the parse and report caches off.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, PARSE_CACHE_DIR=None, REPORT_CACHE_DIR=None)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+
+class IterAdjustmentTests(SampleTestCase):
+
+    def test_matches_expected_report(self):
+        _, points = ingest_samples()
+        queryset = UnAdjustedTertiaryControlPoint.objects.filter(pk__in=[point.pk for point in points]).order_by('pk')
+
+        sections = {section: io.StringIO() for section in REPORT_SECTIONS}
+        writers = {section: csv.writer(out) for section, out in sections.items()}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for section, row in iter_adjustment(queryset, 3, 3):
+                writers[section].writerow(row)
+
+        for section, out in sections.items():
+            with open(os.path.join(EXPECTED_3MM_DIR, f'{section}.csv'), newline='') as f:
+                expected = list(csv.reader(f))
+            actual = list(csv.reader(io.StringIO(out.getvalue())))
+            self.assertEqual(normalize_rows(actual), normalize_rows(expected), section)
+
+    def test_on_point_matches_yielded_rows(self):
+        _, points = ingest_samples()
+        queryset = UnAdjustedTertiaryControlPoint.objects.filter(pk__in=[point.pk for point in points]).order_by('pk')
+
+        found = {ONE_SHOT: [], PROPOSED: []}
+        yielded = {section: [] for section in REPORT_SECTIONS}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for section, row in iter_adjustment(queryset, 3, 3, on_point=lambda section, point: found[section].append(point)):
+                yielded[section].append(row)
+
+        self.assertEqual([point['control_id'] for point in found[ONE_SHOT]], [row[0] for row in yielded[ONE_SHOT][1:]])
+        self.assertEqual(
+            [(point['control_id'], round(point['easting'], 6)) for point in found[PROPOSED]],
+            [(row[0], round(float(row[1]), 6)) for row in yielded[PROPOSED]]
+        )
+
+    def test_coordinates_have_fixed_decimals(self):
+        _, points = ingest_samples()
+        queryset = UnAdjustedTertiaryControlPoint.objects.filter(pk__in=[point.pk for point in points]).order_by('pk')
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = list(iter_adjustment(queryset, 3, 3))
+
+        columns = [row[1:4] for section, row in rows if section in (ONE_SHOT, PROPOSED)][1:]
+        report = [row for section, row in rows if section == REPORT]
+        # The seed rows and the A-B deltas
+        columns += [row[1:4] for row in report if len(row) == 10 and row[0] and row[1] != 'Easting']
+        columns += [row[2:4] for row in report if len(row) == 4 and row[0] == '' and row[1] == '']
+
+        # 16 one shot points, then 4 proposed points with their two seeds and deltas
+        self.assertEqual(len(columns), 16 + 4 * 4)
+        for value in (value for values in columns for value in values):
+            self.assertRegex(value, r'^-?\d+\.\d{8}$')
+
+
+class WriteControlFileTests(SampleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.other, self.obj = save_samples()
+        self.parsed = parse_control_file(self.obj.file.path, self.obj.encoding)
+
+    def write(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return write_control_file(self.obj, self.parsed)
+
+    def counts(self):
+        return [model.objects.count() for model in (Coordinates, HelmertResection, ResectionPoint, OverPointStationSetup, UnAdjustedTertiaryControlPoint)]
+
+    def test_queries(self):
+        # The queries don't grow with the number of setups, resection points or control points
+        with self.assertNumQueries(QUERY_COUNT):
+            points = self.write()
+
+        self.assertEqual(len(points), 18)
+        self.assertEqual(self.counts(), [37, 8, 28, 0, 18])
+        self.assertEqual(sum(1 for point in points if point.resection_id is None), 0)
+
+    def test_writing_again_creates_nothing(self):
+        points = self.write()
+        counts = self.counts()
+
+        self.assertEqual([point.pk for point in self.write()], [point.pk for point in points])
+        self.assertEqual(self.counts(), counts)
+
+    def test_clashing_setup_is_skipped(self):
+        # A resection with the same id and coordinates, but from another file, breaks the unique constraint,
+        # so the points go to the next setup that can be created
+        setups = [value for kind, value in self.parsed.events if kind == 'setup']
+        with contextlib.redirect_stdout(io.StringIO()):
+            writer = SetupWriter(self.other, setups[:1], {})
+            writer.add(setups[0])
+            writer.save()
+
+            self.assertIsNone(SetupWriter(self.obj, setups[:1], {}).add(setups[0]))
+
+        points = self.write()
+        self.assertEqual(len(points), 18)
+        self.assertNotIn(HelmertResection.objects.get(source_file=self.other).pk, {point.resection_id for point in points})
+
+
+def add_shots(file_hash, eastings, northing=100):
+    """
+    Adds shots along a northing at elevation 10 to the file with file_hash, creating it if there isn't one.
+    """
+    source = TertiaryControlFile.objects.filter(file_hash=file_hash).first()
+    if source is None:
+        source, = TertiaryControlFile.objects.bulk_create([TertiaryControlFile(file=f'{file_hash}.12daz', file_hash=file_hash)])
+
+    shots = []
+    for easting in eastings:
+        coordinates = Coordinates(easting=easting, northing=northing, elevation=10, flavour='RW')
+        coordinates.save()
+        shots.append(UnAdjustedTertiaryControlPoint.objects.create(
+            control_id='CP1', target_type='PRISM', horizontal_quality=4, vertical_quality=4, adjusted=False,
+            source=source, coordinates=coordinates
+        ))
+    return shots
+
+
+class NeighbouringHistoryTests(TestCase):
+
+    def test_chained_shots_are_found(self):
+        # Each earlier shot is 8 mm from the one before, only the first is within 10 mm of the new shot
+        history = add_shots('old', [100.008, 100.016, 100.024, 100.5])
+        new = add_shots('new', [100])
+
+        found = find_neighbouring_history(new, radius=.01)
+        self.assertEqual(found, history[:3])
+
+
+class ToleranceHierarchyTests(SimpleTestCase):
+
+    def setUp(self):
+        # Shots of the same points a few mm apart, so the clusters change with the tolerance
+        rng = np.random.default_rng(4)
+        centres = rng.uniform([0, 0, 0], [5, 5, .5], size=(150, 3))
+        self.point_array = centres[rng.integers(0, 150, 400)] + rng.uniform(-.006, .006, (400, 3))
+        self.hierarchy = ToleranceHierarchy.from_point_array(self.point_array, .01)
+
+    def expected(self, hz_tolerance, vt_tolerance):
+        """
+        The counts as iter_adjustment finds them, clustering and evaluating the closest pairs at one pair of tolerances.
+        """
+        one_shot, clusters = gm.group_point_array(self.point_array, hz_tolerance * 3, vt_tolerance * 3)
+        closest = gm.closest_pairs([self.point_array[list(group.values())] for group in clusters.values()])
+        averaged = sum(hz <= hz_tolerance + .0009 and vt <= vt_tolerance + .0009 for _, _, hz, vt in closest)
+
+        return {
+            'hz_tolerance': hz_tolerance * 1000,
+            'vt_tolerance': vt_tolerance * 1000,
+            'shots': len(one_shot) + sum(map(len, clusters.values())),
+            'clusters': len(clusters),
+            'averaged': averaged,
+            'rejected': len(clusters) - averaged,
+            'one_shot': len(one_shot),
+        }
+
+    def test_summary_matches_adjustment(self):
+        summaries = []
+        for hz_tolerance, vt_tolerance in [(.001, .001), (.002, .005), (.003, .003), (.005, .002), (.01, .01)]:
+            summary = self.hierarchy.summary(hz_tolerance, vt_tolerance)
+            self.assertEqual(summary, self.expected(hz_tolerance, vt_tolerance))
+            summaries.append(summary)
+
+        self.assertGreater(len({(s['clusters'], s['averaged']) for s in summaries}), 3)
+
+    def test_control_points_match_point_array(self):
+        points = [{str(row): ControlPoint(str(row), *xyz, 'PRISM', 4, 4, 'file', False)} for row, xyz in enumerate(self.point_array.tolist())]
+        # Adjusted points are left out
+        points.append({'old': ControlPoint('old', 1, 1, 1, 'PRISM', 4, 4, 'file', True)})
+
+        hierarchy = ToleranceHierarchy.from_control_points(points, .01)
+
+        self.assertTrue(np.array_equal(hierarchy.point_array, self.hierarchy.point_array))
+
+    def test_tolerance_above_maximum(self):
+        with self.assertRaises(ValueError):
+            self.hierarchy.summary(.011, .003)
+
+
+class TolerancePreviewTests(TestCase):
+
+    def setUp(self):
+        process_files._preview_hierarchies.clear()
+
+    def preview(self, file_pks):
+        return process_files.tolerance_hierarchy_for_files(file_pks, 20, 3, 3)
+
+    def test_preview_follows_ingest(self):
+        new = add_shots('new', [100, 100.002])
+        file_pks = (new[0].source_id,)
+        hierarchy = self.preview(file_pks)
+        self.assertEqual(hierarchy.summary(.003, .003)['shots'], 2)
+        self.assertIs(self.preview(file_pks), hierarchy)
+
+        # More of the file is ingested
+        add_shots('new', [100.5])
+        self.assertEqual(self.preview(file_pks).summary(.003, .003)['shots'], 3)
+
+    def test_preview_includes_history(self):
+        new = add_shots('new', [100])
+        add_shots('old', [100.004, 105])
+
+        summary = self.preview((new[0].source_id,)).summary(.003, .003)
+        self.assertEqual((summary['shots'], summary['clusters']), (2, 1))
+
+    def test_view(self):
+        new = add_shots('new', [100, 100.002, 100.5])
+        url = reverse('tolerance-preview-view')
+
+        response = self.client.get(url, {'files': new[0].source_id, 'hz': [3, .5], 'vt': [3, .5]})
+        self.assertEqual(response.status_code, 200)
+        previews = response.json()['previews']
+        self.assertEqual([(p['hz_tolerance'], p['clusters'], p['one_shot']) for p in previews], [(3, 1, 1), (.5, 0, 3)])
+
+        for params in ({'files': new[0].source_id, 'hz': 3}, {'files': 'x', 'hz': 3, 'vt': 3}, {'files': new[0].source_id, 'hz': 30, 'vt': 3}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+
+
+class RecordedProgress:
+    """
+    Stands in for the ProgressPublisher of a job, keeping the points it is sent.
+    """
+
+    def __init__(self):
+        self.points = []
+
+    def __call__(self, stage, done, total):
+        pass
+
+    def point(self, section, point):
+        self.points.append((section, point))
+
+    def finish(self, status, error=''):
+        pass
+
+
+class ReportCacheTests(SampleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache_override = override_settings(REPORT_CACHE_DIR=self.cache_dir)
+        self.cache_override.enable()
+
+        self.files = save_samples()
+        self.job = ReportJob.objects.create(
+            kind=ReportJob.UPLOAD, report_name='report', hz_tolerance=3, vt_tolerance=3, file_ids=[obj.pk for obj in self.files]
+        )
+        self.key = report_key([obj.file_hash for obj in self.files], 3, 3)
+
+    def tearDown(self):
+        self.cache_override.disable()
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def report(self):
+        progress = RecordedProgress()
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = list(report_jobs.upload_report_rows(self.job, progress))
+        return rows, progress.points
+
+    def is_cached(self):
+        return os.path.exists(os.path.join(self.cache_dir, self.key))
+
+    def test_cached_report_is_replayed(self):
+        rows, points = self.report()
+        self.assertTrue(self.is_cached())
+
+        # A cached report is found from the uploaded files, before anything is ingested
+        with mock.patch.object(report_jobs, 'ingest_control_files') as ingest:
+            cached_rows, cached_points = self.report()
+        ingest.assert_not_called()
+
+        # A cached report comes back one section after the other
+        rows.sort(key=lambda pair: REPORT_SECTIONS.index(pair[0]))
+        self.assertEqual(
+            normalize_rows([(section, *row) for section, row in cached_rows]),
+            normalize_rows([(section, *row) for section, row in rows])
+        )
+        self.assertEqual(cached_points, [(section, point) for section, point in json.loads(json.dumps(points))])
+
+    def test_new_shots_nearby_invalidate(self):
+        self.report()
+        add_shots('far', [0])
+        self.assertTrue(self.is_cached())
+
+        # Next to the first proposed point, a report of the same files would now take it in as history
+        proposed = AveragedTertiaryControlPoint.objects.select_related('coordinates').first()
+        add_shots('near', [float(proposed.coordinates.easting)], float(proposed.coordinates.northing))
+        self.assertFalse(self.is_cached())
+
+    def test_averaged_point_delete_invalidates(self):
+        self.report()
+        with contextlib.redirect_stdout(io.StringIO()):
+            AveragedTertiaryControlPoint.objects.first().delete()
+        self.assertFalse(self.is_cached())
+
+
+class ReportJobTests(SampleTestCase):
+
+    def upload(self, **headers):
+        files = [open(os.path.join(SAMPLE_DIR, name), 'rb') for name in SAMPLE_FILES]
+        try:
+            return self.client.post(reverse('file-upload-view'), {
+                'files': files, 'horizontal_tolerance': 3, 'vertical_tolerance': 3, 'report_name': 'report'
+            }, **headers)
+        finally:
+            for f in files:
+                f.close()
+
+    def test_form_upload_goes_to_job_page(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = self.upload(HTTP_ACCEPT='text/html,application/xhtml+xml,*/*;q=0.8')
+        job = ReportJob.objects.get()
+        self.assertRedirects(response, reverse('report-job-page-view', args=[job.pk]))
+
+        page = self.client.get(reverse('report-job-page-view', args=[job.pk]))
+        self.assertContains(page, reverse('report-job-status-view', args=[job.pk]))
+
+    def test_json_upload(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = self.upload(HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], ReportJob.QUEUED)
+
+    def test_admin_job_uses_iter_adjustment(self):
+        _, points = ingest_samples()
+        job = ReportJob.objects.create(
+            kind=ReportJob.ADMIN, report_name='my_zip', hz_tolerance=3, vt_tolerance=3, point_ids=[point.pk for point in points]
+        )
+
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(report_jobs, 'ProgressPublisher') as publisher:
+            publisher.return_value = RecordedProgress()
+            report_jobs.run_report_job(job)
+        self.assertEqual(job.status, ReportJob.DONE, job.error)
+
+        with job.result.open('rb') as f, zipfile.ZipFile(f) as zip_file:
+            with zip_file.open('my_zip_proposed_new_control.csv') as proposed:
+                rows = list(csv.reader(io.TextIOWrapper(proposed, encoding='utf-8')))
+        with open(os.path.join(EXPECTED_3MM_DIR, 'proposed.csv'), newline='') as f:
+            self.assertEqual(normalize_rows(rows), normalize_rows(csv.reader(f)))
+
+    def test_failure_only_shows_a_short_message(self):
+        job = ReportJob.objects.create(kind=ReportJob.UPLOAD, report_name='report', file_ids=[])
+
+        def fail(job, out, progress):
+            raise RuntimeError('/srv/media/secret.12da is broken')
+
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch.dict(report_jobs.REPORT_WRITERS, {ReportJob.UPLOAD: fail}), \
+                mock.patch.object(report_jobs, 'ProgressPublisher') as publisher, self.assertLogs(report_jobs.logger, 'ERROR'):
+            publisher.return_value = RecordedProgress()
+            report_jobs.run_report_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReportJob.FAILED)
+        self.assertEqual(job.error, report_jobs.FAILED_MESSAGE)
+        self.assertIn('secret.12da', job.traceback)
+
+        response = self.client.get(reverse('report-job-status-view', args=[job.pk]))
+        self.assertEqual(response.json()['error'], report_jobs.FAILED_MESSAGE)
+        self.assertNotIn('secret.12da', response.content.decode())
+
+    def test_stale_jobs_are_requeued(self):
+        stale = timezone.now() - timedelta(seconds=report_jobs.STALE_AFTER + 60)
+        lost = ReportJob.objects.create(report_name='lost', status=ReportJob.RUNNING, heartbeat_at=stale, attempts=1)
+        given_up = ReportJob.objects.create(report_name='given up', status=ReportJob.RUNNING, heartbeat_at=stale,
+                                            attempts=report_jobs.MAX_ATTEMPTS)
+        running = ReportJob.objects.create(report_name='running', status=ReportJob.RUNNING, heartbeat_at=timezone.now(), attempts=1)
+
+        with self.assertLogs(report_jobs.logger, 'WARNING'):
+            job = report_jobs.claim_next_job()
+
+        self.assertEqual((job.pk, job.status, job.attempts), (lost.pk, ReportJob.RUNNING, 2))
+        given_up.refresh_from_db()
+        self.assertEqual((given_up.status, given_up.error), (ReportJob.FAILED, report_jobs.WORKER_LOST_MESSAGE))
+        running.refresh_from_db()
+        self.assertEqual(running.status, ReportJob.RUNNING)
+        self.assertIsNone(report_jobs.claim_next_job())
+
+    def test_progress_is_the_heartbeat(self):
+        job = ReportJob.objects.create(report_name='report', status=ReportJob.RUNNING)
+        job.set_progress('ingest', 10)
+
+        job.refresh_from_db()
+        self.assertIsNotNone(job.heartbeat_at)
+        self.assertEqual(report_jobs.requeue_stale_jobs(), 0)
+        with self.assertLogs(report_jobs.logger, 'WARNING'):
+            self.assertEqual(report_jobs.requeue_stale_jobs(stale_after=-1), 1)
@@ -4,5 +4,9 @@ from . import views
 
 urlpatterns = [
     path('file_upload/', views.file_upload_view, name='file-upload-view'),
+    path('tolerance_preview/', views.tolerance_preview_view, name='tolerance-preview-view'),
+    path('report_jobs/<int:job_id>/', views.report_job_status_view, name='report-job-status-view'),
+    path('report_jobs/<int:job_id>/page/', views.report_job_page_view, name='report-job-page-view'),
+    path('report_jobs/<int:job_id>/download/', views.report_job_download_view, name='report-job-download-view'),
     # ... other app-specific patterns
 ]
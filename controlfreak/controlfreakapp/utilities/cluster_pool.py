@@ -0,0 +1,188 @@
+import os
+import dataclasses
+from typing import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+from . import geometry_manipulation as gm
+from .job_progress import no_progress
+
+# Below this many clusters, starting the pool costs more than it saves
+POOL_MIN_CLUSTERS = 2000
+# Chunks per worker, so a chunk of large clusters doesn't leave the other workers idle
+CHUNKS_PER_WORKER = 4
+
+
+@dataclasses.dataclass
+class PackedClusters:
+    """
+    The shots of many clusters packed into one array, built once and used by both the serial and the pooled path
+    and by the report afterwards.
+
+    :args points: An (n, 3) float64 array of easting, northing and elevation of every shot, cluster after cluster.
+    :args offsets: The shots of cluster k are points[offsets[k]:offsets[k + 1]].
+    :args keys: The key of every shot in its {key: ControlPoint} dict.
+    :args ids: The control id of every shot.
+    :args target_types: The target type of every shot.
+    :args shots: Gives the ControlPoint of a shot by its position, a list or the ShotColumns of the shots.
+    """
+    points: np.ndarray
+    offsets: list
+    keys: list
+    ids: list
+    target_types: list
+    shots: Sequence
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def pair(self, k: int, i: int, j: int) -> tuple:
+        """
+        The shots at positions i and j of cluster k, as cluster_processing would look them up by key.
+        Shots with the same key are merged, the last one wins.
+        """
+        start, stop = self.offsets[k], self.offsets[k + 1]
+        last = {key: position for position, key in enumerate(self.keys[start:stop], start)}
+        return self.shots[last[self.keys[start + i]]], self.shots[last[self.keys[start + j]]]
+
+
+def pack_clusters(shot_groups, columns=None) -> PackedClusters:
+    """
+    Packs the clusters, lists of {key: ControlPoint} dicts, into a PackedClusters.
+
+    With columns, the ShotColumns the shots were loaded into, the clusters are instead {key: row} dicts of rows of
+    columns as gm.group_point_array gives them. Their coordinates are taken straight from the columns and a
+    ControlPoint is only built for the shots that PackedClusters.pair is asked for.
+    """
+    if columns is not None:
+        keys = []
+        rows = []
+        offsets = [0]
+        for shot_group in shot_groups:
+            keys.extend(shot_group)
+            rows.extend(shot_group.values())
+            offsets.append(len(rows))
+
+        shots = columns.take(rows)
+        return PackedClusters(shots.point_array, offsets, keys, shots.ids, shots.target_types, shots)
+
+    keys = []
+    shots = []
+    offsets = [0]
+    for shot_group in shot_groups:
+        for shot in shot_group:
+            for key, pt in shot.items():
+                keys.append(key)
+                shots.append(pt)
+        offsets.append(len(shots))
+
+    points = np.array([(pt.easting, pt.northing, pt.elevation) for pt in shots], dtype=np.float64).reshape(-1, 3)
+    return PackedClusters(points, offsets, keys, [pt.id for pt in shots], [pt.target_type for pt in shots], shots)
+
+
+def _evaluate(points, offsets, ids, target_types, pos_thresh, ht_thresh) -> list:
+    """
+    Evaluates the clusters whose shots run from offsets[k] to offsets[k + 1] in points.
+    ids and target_types cover the shots from offsets[0] to offsets[-1] only.
+    """
+    base = offsets[0]
+    closest = gm.closest_pairs([points[offsets[k]:offsets[k + 1]] for k in range(len(offsets) - 1)])
+
+    results = []
+    accepted = []
+    for start, pair in zip(offsets, closest):
+        if pair is None:
+            results.append(None)
+            continue
+
+        i, j, pos_value, ht_value = pair
+        results.append([i, j, pos_value, ht_value, None, None])
+
+        if pos_value <= pos_thresh and ht_value <= ht_thresh:
+            # Only the clusters that will be averaged need a name
+            a = start - base + i
+            b = start - base + j
+            accepted.append((len(results) - 1, [ids[a], ids[b]], [target_types[a], target_types[b]]))
+
+    best = gm.resolve_best_codes_and_names([(codes, names) for _, codes, names in accepted])
+    for (k, _, _), (best_code, best_name) in zip(accepted, best):
+        results[k][4:] = [best_code, best_name]
+
+    return [None if result is None else tuple(result) for result in results]
+
+
+def _evaluate_shared(shm_name, shape, offsets, ids, target_types, pos_thresh, ht_thresh) -> list:
+    """
+    _evaluate in a worker process, reading the coordinates from shared memory instead of having them pickled.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        points = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        results = _evaluate(points, offsets, ids, target_types, pos_thresh, ht_thresh)
+        # The results only hold plain values, so the view of the buffer can go before it is closed
+        del points
+        return results
+    finally:
+        shm.close()
+
+
+def evaluate_clusters(clusters, pos_thresh, ht_thresh, max_workers=None, progress=no_progress) -> list:
+    """
+    Finds the closest pair of every cluster and, for the pairs within tolerance, the best code and name.
+
+    The coordinates of every cluster are packed into one float64 array. With enough clusters the array is put in
+    shared memory and the clusters are split between a process pool, so only the cluster offsets and the point
+    ids and target types are sent to the workers. Nothing is written to the database here.
+
+    :param clusters: The PackedClusters, or the clusters as lists of {key: ControlPoint} dicts to pack.
+    :param pos_thresh: The largest horizontal distance of a pair that will be averaged.
+    :param ht_thresh: The largest height difference of a pair that will be averaged.
+    :param max_workers: The size of the pool, defaults to the number of CPUs.
+    :param progress: Called as progress('pair evaluation', clusters done, clusters) as the chunks finish.
+    :return: Per cluster, (i, j, pos_value, ht_value, best_code, best_name) with i and j the positions of the
+        closest pair in the cluster, best_code and best_name None if the pair isn't within tolerance.
+        None for a cluster of fewer than two shots.
+    """
+    if not isinstance(clusters, PackedClusters):
+        clusters = pack_clusters(clusters)
+
+    count = len(clusters)
+    if count == 0:
+        return []
+
+    points = clusters.points
+    offsets = clusters.offsets
+    ids = clusters.ids
+    target_types = clusters.target_types
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if count < POOL_MIN_CLUSTERS or max_workers == 1:
+        results = _evaluate(points, offsets, ids, target_types, pos_thresh, ht_thresh)
+        progress('pair evaluation', count, count)
+        return results
+
+    chunk_size = -(-count // (max_workers * CHUNKS_PER_WORKER))
+    shm = shared_memory.SharedMemory(create=True, size=max(points.nbytes, 1))
+    try:
+        np.ndarray(points.shape, dtype=np.float64, buffer=shm.buf)[:] = points
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for start in range(0, count, chunk_size):
+                stop = min(start + chunk_size, count)
+                shots = slice(offsets[start], offsets[stop])
+                futures.append(executor.submit(
+                    _evaluate_shared, shm.name, points.shape, offsets[start:stop + 1],
+                    ids[shots], target_types[shots], pos_thresh, ht_thresh
+                ))
+
+            results = []
+            for future in futures:
+                results.extend(future.result())
+                progress('pair evaluation', len(results), count)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return results
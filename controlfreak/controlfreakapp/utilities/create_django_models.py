@@ -1,69 +1,412 @@
 from typing import List, Dict, Any, Tuple
 from datetime import datetime
-from django.db.utils import IntegrityError
+from django.db import connection
+from django.db.models import Prefetch
 from django.utils import timezone
 from .CONSTANTS import DATE_FORMAT
-from .. models import Coordinates, HelmertResection, ReflectorType, InstrumentMeasureStyle, InstrumentSettings, ResectionPoint, OverPointStationSetup
+from .report_cache import invalidate_reports, invalidate_reports_near
+from .. models import report_cache_dir, invalidate_reports_of_points, Coordinates, HelmertResection, ReflectorType, InstrumentMeasureStyle, InstrumentSettings, ResectionPoint, OverPointStationSetup, UnAdjustedTertiaryControlPoint, AveragedTertiaryControlPoint
 
-def create_over_point_setup(data: dict) -> Any | None:
+# Keeps the number of parameters in a single IN (...) lookup under SQLite's limit
+LOOKUP_BATCH_SIZE = 500
+
+
+def coordinate_key(easting, northing, elevation) -> tuple:
+    """
+    A hashable key for a coordinate triple that is the same for a float read from a 12d file
+    and the Decimal it is stored as (8 decimal places).
+    """
+    return round(float(easting), 8), round(float(northing), 8), round(float(elevation), 8)
+
+
+def _batches(items: list, size: int = LOOKUP_BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def find_coordinates(triples: list, flavour: str) -> dict:
+    """
+    Selects the existing Coordinates rows of one flavour for a list of (easting, northing, elevation) triples,
+    with one query per batch.
+
+    :return: A dict of coordinate_key -> Coordinates, triples without a row are left out.
+    """
+    wanted = {coordinate_key(*triple): triple for triple in triples}
+    resolved = {}
+
+    eastings = sorted({triple[0] for triple in wanted.values()})
+    for batch in _batches(eastings):
+        for coordinates in Coordinates.objects.filter(flavour=flavour, easting__in=batch).order_by('-pk'):
+            key = coordinate_key(coordinates.easting, coordinates.northing, coordinates.elevation)
+            if key in wanted:
+                # Ordered so the oldest duplicate wins, as filter(...).first() would
+                resolved[key] = coordinates
+
+    return resolved
+
+
+def get_or_create_coordinates(triples: list, flavour: str) -> dict:
+    """
+    Resolves a list of (easting, northing, elevation) triples to Coordinates rows of one flavour,
+    selecting the existing rows with one query per batch and inserting the rest with bulk_create.
+
+    :return: A dict of coordinate_key -> Coordinates.
+    """
+    wanted = {coordinate_key(*triple): triple for triple in triples}
+    resolved = find_coordinates(triples, flavour)
+
+    missing = [
+        Coordinates(easting=triple[0], northing=triple[1], elevation=triple[2], flavour=flavour)
+        for key, triple in wanted.items() if key not in resolved
+    ]
+    for coordinates in missing:
+        coordinates.set_grid_cell()
+    Coordinates.objects.bulk_create(missing, batch_size=LOOKUP_BATCH_SIZE)
+
+    for coordinates in missing:
+        resolved[coordinate_key(coordinates.easting, coordinates.northing, coordinates.elevation)] = coordinates
+
+    return resolved
+
+
+def create_control_points(source_file_obj, points: list) -> list:
+    """
+    Writes the control points of one file with a fixed number of queries, rather than several per point.
+
+    Existing coordinates and control points are selected in bulk, and the new ones are inserted with
+    bulk_create with their resection or over-the-point setup already set. Must be run in a transaction.
+
+    :param source_file_obj: The TertiaryControlFile the points were read from.
+    :param points: A list of ([control_id, easting, northing, elevation, target_type], setup) pairs,
+        where setup is a HelmertResection or OverPointStationSetup.
+    :return: The UnAdjustedTertiaryControlPoint of every point, in the order given.
+    """
+    if not points:
+        return []
+
+    coordinates = get_or_create_coordinates([item[1:4] for item, setup in points], flavour='RW')
+
+    existing = {}
+    resection_coordinates = set()
+    coordinate_ids = sorted({c.pk for c in coordinates.values()})
+    for batch in _batches(coordinate_ids):
+        for cp in UnAdjustedTertiaryControlPoint.objects.filter(
+                source=source_file_obj,
+                coordinates_id__in=batch,
+                horizontal_quality=4,
+                vertical_quality=4,
+                adjusted=False
+        ).order_by('-pk'):
+            existing[(cp.control_id, cp.coordinates_id, cp.target_type)] = cp
+            resection_coordinates.add((cp.resection_id, cp.coordinates_id))
+
+    collector = []
+    new_points = []
+    for item, setup in points:
+        point_coordinates = coordinates[coordinate_key(*item[1:4])]
+        key = (item[0], point_coordinates.pk, item[4])
+
+        if key not in existing:
+            tertiary_cp_for_db = UnAdjustedTertiaryControlPoint(
+                control_id=item[0],
+                coordinates=point_coordinates,
+                target_type=item[4],
+                horizontal_quality=4,
+                vertical_quality=4,
+                source=source_file_obj,
+                adjusted=False,
+            )
+
+            if setup.setup_type == 'Helmert':
+                tertiary_cp_for_db.resection = setup
+            else:
+                tertiary_cp_for_db.otp_setup = setup
+
+            if (tertiary_cp_for_db.resection_id, point_coordinates.pk) in resection_coordinates \
+                    and tertiary_cp_for_db.resection_id is not None:
+                print(f'{item[0]} shares its coordinates and resection with another point, skipping')
+                continue
+
+            resection_coordinates.add((tertiary_cp_for_db.resection_id, point_coordinates.pk))
+            existing[key] = tertiary_cp_for_db
+            new_points.append(tertiary_cp_for_db)
+
+        collector.append(existing[key])
+
+    UnAdjustedTertiaryControlPoint.objects.bulk_create(new_points, batch_size=LOOKUP_BATCH_SIZE)
+    print(f'Created {len(new_points)} control points, {len(collector) - len(new_points)} already existed')
+
+    if new_points:
+        # bulk_create sends no post_save, so the cached reports the new points change are deleted here:
+        # the reports of the file itself and those that would now take the points in as history
+        invalidate_reports(report_cache_dir(), [source_file_obj.file_hash])
+        invalidate_reports_near(report_cache_dir(), [(cp.coordinates.easting, cp.coordinates.northing) for cp in new_points])
+
+    return collector
+
+def get_seeds(points: list) -> dict:
+    """
+    Finds the UnAdjustedTertiaryControlPoint each shot of an adjustment was read from, with a fixed number of queries.
+
+    Like the get_or_create / get / filter(...).first() lookups it replaces, the RW coordinates of each shot are
+    resolved first and the oldest matching point wins. The seeds come with their source, setup and resection points
+    (and the reflector, measure style and settings of those) already loaded for the report.
+
+    :param points: The ControlPoints of the shots.
+    :return: A dict of (control_id, target_type, coordinate_key) -> UnAdjustedTertiaryControlPoint,
+        shots that aren't in the database are left out.
+    """
+    coordinates = get_or_create_coordinates([(pt.easting, pt.northing, pt.elevation) for pt in points], flavour='RW')
+    keys_by_coordinates = {c.pk: key for key, c in coordinates.items()}
+    wanted = {(pt.id, pt.target_type, coordinate_key(pt.easting, pt.northing, pt.elevation)) for pt in points}
+
+    resection_points = ResectionPoint.objects.select_related('tps_reflector_type', 'tps_measure_style', 'tps_settings')
+
+    seeds = {}
+    for batch in _batches(sorted(keys_by_coordinates)):
+        for seed in UnAdjustedTertiaryControlPoint.objects.filter(
+                coordinates_id__in=batch
+        ).select_related('source', 'resection', 'otp_setup').prefetch_related(
+            Prefetch('resection__resectionpoint_set', queryset=resection_points)
+        ).order_by('-pk'):
+            key = (seed.control_id, seed.target_type, keys_by_coordinates[seed.coordinates_id])
+            if key in wanted:
+                seed.coordinates = coordinates[key[2]]
+                seeds[key] = seed
+
+    return seeds
+
+
+def get_or_create_averaged_points(points: list) -> list:
+    """
+    get_or_create for many AveragedTertiaryControlPoints, selecting the existing ones in bulk and inserting the rest
+    with bulk_create. Points with the same fields are only created once.
+
+    :param points: The unsaved AveragedTertiaryControlPoints, with their seeds and coordinates set.
+    :return: (point, created) for every point, in the order given.
+    """
+    def key(pt):
+        return pt.control_id, pt.target_type, pt.horizontal_quality, pt.vertical_quality, pt.a_seed_id, pt.b_seed_id, pt.coordinates_id
+
+    existing = {}
+    a_seed_ids = sorted({pt.a_seed_id for pt in points})
+    for batch in _batches(a_seed_ids):
+        for pt in AveragedTertiaryControlPoint.objects.filter(a_seed_id__in=batch).select_related('coordinates').order_by('-pk'):
+            existing[key(pt)] = pt
+
+    results = []
+    new_points = {}
+    for pt in points:
+        if key(pt) in existing:
+            results.append((existing[key(pt)], False))
+        elif key(pt) in new_points:
+            results.append((new_points[key(pt)], False))
+        else:
+            new_points[key(pt)] = pt
+            results.append((pt, True))
+
+    AveragedTertiaryControlPoint.objects.bulk_create(list(new_points.values()), batch_size=LOOKUP_BATCH_SIZE)
+
+    # The seeds are no longer history for other reports, and bulk_create sends no post_save
+    invalidate_reports_of_points([pk for pt in new_points.values() for pk in (pt.a_seed_id, pt.b_seed_id)])
+
+    return results
+
+
+def _get_or_create_cached(lookup_cache: dict | None, model, **kwargs):
+    """
+    get_or_create for the small lookup tables (reflectors, measure styles, instrument settings),
+    remembering the rows already resolved while ingesting one file.
+    """
+    if lookup_cache is None:
+        return model.objects.get_or_create(**kwargs)[0]
+
+    key = (model, tuple(sorted(kwargs.items())))
+    if key not in lookup_cache:
+        lookup_cache[key] = model.objects.get_or_create(**kwargs)[0]
+
+    return lookup_cache[key]
+
+
+def _prepared(model, values: dict) -> tuple:
+    """
+    The values as the database compares them, e.g. decimals rounded to the places of their field,
+    so rows can be matched in memory the way get_or_create would match them.
+    """
+    return tuple(model._meta.get_field(name).get_db_prep_value(value, connection) for name, value in sorted(values.items()))
+
+
+def _key(coordinates) -> tuple | None:
+    if coordinates is None:
+        return None
+    return coordinate_key(coordinates.easting, coordinates.northing, coordinates.elevation)
+
+
+def _fields(obj, names: tuple) -> dict:
+    return {name: getattr(obj, name) for name in names}
+
+
+RESECTION_FIELDS = (
+    'setup_type', 'source_file_id', 'origin_elevation', 'instrument_height', 'bearing_swing', 'utc_time',
+    'pos_error', 'scale_factor', 'level_diff'
+)
+
+OVER_POINT_FIELDS = (
+    'setup_type', 'origin_elevation', 'instrument_height', 'bearing_swing', 'utc_time', 'bs_id',
+    'bs_calc_elevation', 'bs_elevation_delta', 'bs_easting_delta', 'bs_northing_delta', 'bs_diff_z'
+)
+
+RESECTION_POINT_FIELDS = (
+    'helm_id', 'model_name', 'target_type', 'use_pos', 'use_ht', 'pos_error',
+    'tps_reflector_type_id', 'tps_measure_style_id', 'tps_settings_id'
+)
+
+
+def station_triples(setup_data) -> list:
+    """
+    :return: (flavour, (easting, northing, elevation)) of the coordinates a setup is stored with,
+        or an empty list if the setup is missing them.
+    """
+    data = setup_data.setup
     try:
-        coordinates, created = Coordinates.objects.get_or_create(
-            easting=float(data['is_x']),
-            northing=float(data['is_y']),
-            elevation=float(data['is_z']),
-            flavour='OP'
-        )
+        if setup_data.is_helmert_resection:
+            return [('HM', (float(data['is_x']), float(data['is_y']), float(data['is_z'])))]
 
-        bs_coordinates, created = Coordinates.objects.get_or_create(
-            easting=float(data['bs_x']),
-            northing=float(data['bs_y']),
-            elevation=float(data['bs_ht']),
-            flavour='BS'
-        )
+        return [
+            ('OP', (float(data['is_x']), float(data['is_y']), float(data['is_z']))),
+            ('BS', (float(data['bs_x']), float(data['bs_y']), float(data['bs_ht']))),
+        ]
+    except (KeyError, ValueError):
+        return []
+
+
+class SetupWriter:
+    """
+    Writes the station setups of one file with a fixed number of queries, rather than several per setup and resection point.
+
+    The coordinates and setups that already exist are selected up front for every setup of the file. add() matches
+    each setup in memory the way get_or_create would, and save() inserts the new coordinates, setups and resection
+    points with bulk_create. A setup that clashes with an existing one on its unique fields can't be created,
+    so add() returns None for it, as the IntegrityError did before. Must be run in a transaction.
+
+    :args source_file_obj (TertiaryControlFile): The file the setups were read from.
+    :args setups (list): Every StationSetupData of the file, whether or not it is added later.
+    :args lookup_cache (dict): Lookup table rows already resolved for this file, see _get_or_create_cached.
+    """
+
+    def __init__(self, source_file_obj, setups: list, lookup_cache: dict | None = None):
+        self.source_file_obj = source_file_obj
+        self.lookup_cache = lookup_cache
+
+        triples = {}
+        for setup_data in setups:
+            for flavour, triple in station_triples(setup_data):
+                triples.setdefault(flavour, []).append(triple)
+
+        # (flavour, coordinate_key) -> Coordinates, the new ones are unsaved until save()
+        self.coordinates = {
+            (flavour, key): coordinates
+            for flavour, flavour_triples in triples.items()
+            for key, coordinates in find_coordinates(flavour_triples, flavour).items()
+        }
+        self.new_coordinates = []
+
+        # (helmert_id, coordinate_key) -> (HelmertResection, prepared fields, keys of its resection points)
+        self.resections = {}
+        self.new_resections = []
+        # (ops_id, coordinate_key, backsight coordinate_key) -> (OverPointStationSetup, prepared fields)
+        self.over_points = {}
+        self.new_over_points = []
+        # (HelmertResection, (easting, northing, elevation), ResectionPoint fields) of the points to insert
+        self.new_resection_points = []
+
+        self._find_resections([c.pk for (flavour, key), c in self.coordinates.items() if flavour == 'HM'])
+        self._find_over_points([c.pk for (flavour, key), c in self.coordinates.items() if flavour == 'OP'])
+
+    def _find_resections(self, coordinate_ids: list):
+        by_pk = {}
+        for batch in _batches(sorted(coordinate_ids)):
+            for resection in HelmertResection.objects.filter(coordinates_id__in=batch).select_related('coordinates'):
+                point_keys = set()
+                self.resections[(resection.helmert_id, _key(resection.coordinates))] = \
+                    (resection, _prepared(HelmertResection, _fields(resection, RESECTION_FIELDS)), point_keys)
+                by_pk[resection.pk] = point_keys
+
+        for batch in _batches(sorted(by_pk)):
+            for point in ResectionPoint.objects.filter(resection_id__in=batch).select_related('coordinates'):
+                by_pk[point.resection_id].add((_key(point.coordinates), _prepared(ResectionPoint, _fields(point, RESECTION_POINT_FIELDS))))
+
+    def _find_over_points(self, coordinate_ids: list):
+        for batch in _batches(sorted(coordinate_ids)):
+            for otp in OverPointStationSetup.objects.filter(coordinates_id__in=batch).select_related('coordinates', 'bs_coordinates'):
+                self.over_points[(otp.ops_id, _key(otp.coordinates), _key(otp.bs_coordinates))] = \
+                    (otp, _prepared(OverPointStationSetup, _fields(otp, OVER_POINT_FIELDS)))
+
+    def _get_or_create_coordinates(self, flavour: str, triple: tuple) -> Coordinates:
+        key = (flavour, coordinate_key(*triple))
+        if key not in self.coordinates:
+            coordinates = Coordinates(easting=triple[0], northing=triple[1], elevation=triple[2], flavour=flavour)
+            coordinates.set_grid_cell()
+            self.coordinates[key] = coordinates
+            self.new_coordinates.append(coordinates)
 
-        otp_ob, created = OverPointStationSetup.objects.get_or_create(
-            ops_id=data['is_id'],
+        return self.coordinates[key]
+
+    def add(self, setup_data) -> Any | None:
+        """
+        Adds a parsed station setup.
+
+        :param setup_data: The StationSetupData read by StationSetupParser.
+        :return: The HelmertResection or OverPointStationSetup, which save() inserts if it is new,
+            or None if it could not be created.
+        """
+        if setup_data.is_helmert_resection:
+            return self._add_helmert_setup(setup_data.setup, setup_data.resection_points)
+        else:
+            return self._add_over_point_setup(setup_data.setup)
+
+    def _add_over_point_setup(self, data: dict) -> Any | None:
+        coordinates = self._get_or_create_coordinates('OP', (float(data['is_x']), float(data['is_y']), float(data['is_z'])))
+        bs_coordinates = self._get_or_create_coordinates('BS', (float(data['bs_x']), float(data['bs_y']), float(data['bs_ht'])))
+
+        fields = dict(
             setup_type=data['setup_type'],
-            coordinates=coordinates,
             origin_elevation=float(data['is_z_orig']),
             instrument_height=float(data['is_hi']),
             bearing_swing=float(data['is_bearing_swing']),
             utc_time=timezone.make_aware(datetime.strptime(data['is_utc_time_text'], DATE_FORMAT)),
             bs_id=data['bs_id'],
-            bs_coordinates=bs_coordinates,
             bs_calc_elevation=float(data['bs_z']),
             bs_elevation_delta=float(data['bs_diff_hd']),
             bs_easting_delta=float(data['bs_diff_x']),
             bs_northing_delta=float(data['bs_diff_y']),
             bs_diff_z=float(data['bs_diff_z'])
         )
+        prepared = _prepared(OverPointStationSetup, fields)
+        key = (data['is_id'], _key(coordinates), _key(bs_coordinates))
 
-        if created:
-            print(f"Created Over the point setup: {otp_ob}")
-        else:
-            print(f"Found Over-the-point: {otp_ob}")
+        if key in self.over_points:
+            otp_ob, existing = self.over_points[key]
+            if existing != prepared:
+                # Would break the unique constraint on ops_id and the coordinates
+                return None
 
-        return otp_ob
-
-    except IntegrityError:
-        return None
+            print(f"Found Over-the-point: {otp_ob}")
+            return otp_ob
 
+        otp_ob = OverPointStationSetup(ops_id=data['is_id'], coordinates=coordinates, bs_coordinates=bs_coordinates, **fields)
+        self.over_points[key] = (otp_ob, prepared)
+        self.new_over_points.append(otp_ob)
+        print(f"Created Over the point setup: {otp_ob}")
 
-def create_helmert_setup(data: dict, points: list, source_file_obj) -> Any | None:
+        return otp_ob
 
-    coordinates, created = Coordinates.objects.get_or_create(
-        easting=float(data['is_x']),
-        northing=float(data['is_y']),
-        elevation=float(data['is_z']),
-        flavour='HM'
-    )
+    def _add_helmert_setup(self, data: dict, points: list) -> Any | None:
+        coordinates = self._get_or_create_coordinates('HM', (float(data['is_x']), float(data['is_y']), float(data['is_z'])))
 
-    try:
-        resection, created = HelmertResection.objects.get_or_create(
-            helmert_id=data['is_id'],
+        fields = dict(
             setup_type=data['setup_type'],
-            source_file=source_file_obj,
-            coordinates=coordinates,
+            source_file_id=self.source_file_obj.pk,
             origin_elevation=float(data['is_z_orig']),
             instrument_height=float(data['is_hi']),
             bearing_swing=float(data['is_bearing_swing']),
@@ -72,64 +415,80 @@ def create_helmert_setup(data: dict, points: list, source_file_obj) -> Any | Non
             scale_factor=float(data['is_helm_scale_factor']),
             level_diff=float(data['is_helm_level_diff'])
         )
+        prepared = _prepared(HelmertResection, fields)
+        key = (data['is_id'], _key(coordinates))
+
+        if key in self.resections:
+            resection, existing, point_keys = self.resections[key]
+            if existing != prepared:
+                # Would break the unique constraint on helmert_id and the coordinates
+                print("Helmert resection integrity error")
+                return None
 
-        if created:
-            print(f"Created Helmert Resection: {resection}")
-        else:
             print(f"Found Helmert Resection: {resection}")
+        else:
+            resection = HelmertResection(helmert_id=data['is_id'], coordinates=coordinates, **fields)
+            point_keys = set()
+            self.resections[key] = (resection, prepared, point_keys)
+            self.new_resections.append(resection)
+            print(f"Created Helmert Resection: {resection}")
 
         for point in points:
-            use_pos = True if point['helm_use_xy'] == '1' else False
-            use_ht = True if point['helm_use_z'] == '1' else False
-            try:
-                pos_error = point['helm_pos_error']
-
-            except KeyError:
-                pos_error = None
-
-            coordinates, created = Coordinates.objects.get_or_create(
-                easting=point['helm_x'],
-                northing=point['helm_y'],
-                elevation=point['helm_z'],
-                flavour='Adjusted'
-            )
-
-            reflector_obj, created = ReflectorType.objects.get_or_create(
+            reflector_obj = _get_or_create_cached(
+                self.lookup_cache,
+                ReflectorType,
                 reflector_type_id=point['reflector_id'],
                 reflector_type_name=point['reflector_type'],
                 reflector_constant=point['reflector_constant']
             )
 
-            measure_style, created = InstrumentMeasureStyle.objects.get_or_create(
+            measure_style = _get_or_create_cached(
+                self.lookup_cache,
+                InstrumentMeasureStyle,
                 instrument_measure_style_id=point['ms_id'],
                 instrument_measure_style_name=point['ms_name']
             )
 
-            instrument_settings, created = InstrumentSettings.objects.get_or_create(
+            instrument_settings = _get_or_create_cached(
+                self.lookup_cache,
+                InstrumentSettings,
                 instrument_settings_id=point['set_id'],
                 instrument_settings_name=point['set_name']
             )
 
-            try:
-                ResectionPoint.objects.get_or_create(
-                    resection=resection,
-                    helm_id=point['helm_id'],
-                    model_name=point['helm_model_name'],
-                    target_type=point['helm_string_name'],
-                    coordinates=coordinates,
-                    use_pos=use_pos,
-                    use_ht=use_ht,
-                    pos_error=pos_error,
-                    tps_reflector_type=reflector_obj,
-                    tps_measure_style=measure_style,
-                    tps_settings=instrument_settings
-                )
-            except IntegrityError:
-                print('resection point integrity error')
-                pass
-        resection.save()
+            point_fields = dict(
+                helm_id=point['helm_id'],
+                model_name=point['helm_model_name'],
+                target_type=point['helm_string_name'],
+                use_pos=point['helm_use_xy'] == '1',
+                use_ht=point['helm_use_z'] == '1',
+                pos_error=point.get('helm_pos_error'),
+                tps_reflector_type_id=reflector_obj.pk,
+                tps_measure_style_id=measure_style.pk,
+                tps_settings_id=instrument_settings.pk
+            )
+            triple = (float(point['helm_x']), float(point['helm_y']), float(point['helm_z']))
+            point_key = (coordinate_key(*triple), _prepared(ResectionPoint, point_fields))
+
+            # The coordinates are created even when the resection point already exists
+            self.new_resection_points.append((resection, triple, None if point_key in point_keys else point_fields))
+            point_keys.add(point_key)
+
         return resection
 
-    except IntegrityError:
-        print("Helmert resection integrity error")
-        pass
\ No newline at end of file
+    def save(self):
+        """
+        Inserts the new coordinates, setups and resection points.
+        """
+        Coordinates.objects.bulk_create(self.new_coordinates, batch_size=LOOKUP_BATCH_SIZE)
+        HelmertResection.objects.bulk_create(self.new_resections, batch_size=LOOKUP_BATCH_SIZE)
+        OverPointStationSetup.objects.bulk_create(self.new_over_points, batch_size=LOOKUP_BATCH_SIZE)
+
+        coordinates = get_or_create_coordinates([triple for _, triple, _ in self.new_resection_points], flavour='Adjusted')
+        ResectionPoint.objects.bulk_create([
+            ResectionPoint(resection=resection, coordinates=coordinates[coordinate_key(*triple)], **fields)
+            for resection, triple, fields in self.new_resection_points if fields is not None
+        ], batch_size=LOOKUP_BATCH_SIZE)
+
+        print(f'Created {len(self.new_resections)} Helmert resections and {len(self.new_over_points)} over the point setups')
+        self.new_coordinates, self.new_resections, self.new_over_points, self.new_resection_points = [], [], [], []
@@ -0,0 +1,69 @@
+from fractions import Fraction
+from typing import Sequence
+
+import numpy as np
+
+# Coordinates.easting, northing and elevation are stored with 8 decimal places
+COORDINATE_PLACES = 8
+COORDINATE_SCALE = 10 ** COORDINATE_PLACES
+
+
+def to_fixed(value) -> int:
+    """
+    A coordinate as an integer number of 1e-8 m, the precision it is stored with.
+
+    A float read back from a stored Decimal is the nearest float to it, so it rounds back to the stored value for any
+    coordinate under about 5e7 m.
+    """
+    return int(round(float(value) * COORDINATE_SCALE))
+
+
+def to_fixed_array(point_array) -> np.ndarray:
+    """
+    to_fixed for a whole float64 array at once.
+    """
+    return np.rint(np.asarray(point_array, dtype=np.float64) * COORDINATE_SCALE).astype(np.int64)
+
+
+def from_fixed(value: int, places: int = COORDINATE_PLACES) -> float:
+    """
+    The float nearest to an integer number of 1e-8 m, rounded to places (half to even, as round() does a Decimal).
+    """
+    return float(Fraction(round(Fraction(value, 10 ** (COORDINATE_PLACES - places))), 10 ** places))
+
+
+def format_fixed(value, places: int = COORDINATE_PLACES) -> str:
+    """
+    A coordinate or delta for the report, with a fixed number of decimal places as the stored Decimals are written.
+    """
+    return f'{from_fixed(to_fixed(value), places):.{places}f}'
+
+
+def fixed_mean(values: Sequence[float], places: int = 3) -> float:
+    """
+    The mean of some coordinates rounded to places, worked out exactly in 1e-8 m so it matches
+    round(mean(<the stored Decimals>), places) without any Decimal arithmetic.
+    """
+    return from_fixed(Fraction(sum(to_fixed(value) for value in values), len(values)), places)
+
+
+def fixed_delta(a: float, b: float) -> float:
+    """
+    a - b for two stored coordinates, without the float noise of subtracting them directly.
+    """
+    return from_fixed(to_fixed(a) - to_fixed(b))
+
+
+def coordinate_keys(point_array) -> list:
+    """
+    A hashable key per row of an (n, 3) array of coordinates, worked out for the whole array at once.
+    The key is the (easting, northing, elevation) triple in 1e-8 m, so equal stored coordinates give equal keys.
+    """
+    return list(map(tuple, to_fixed_array(point_array).reshape(-1, 3).tolist()))
+
+
+def point_keys(points) -> list:
+    """
+    coordinate_keys of a list of ControlPoints.
+    """
+    return coordinate_keys(np.array([[pt.easting, pt.northing, pt.elevation] for pt in points], dtype=np.float64).reshape(-1, 3))
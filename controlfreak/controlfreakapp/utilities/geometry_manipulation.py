@@ -1,13 +1,13 @@
 import numpy as np
-from sklearn.cluster import DBSCAN
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import statistics
-
-from .string_parsing import create_hash
-
-from fuzzywuzzy import fuzz
-import itertools
 import math
 
+from .fixed_point import coordinate_keys, point_keys
+from .similarity import avg_similarity, most_similar, BestMatchResolver
+
 import os
 import re
 
@@ -44,155 +44,248 @@ def format_for_split(clust_data):
     return to_process_further
 
 
-def cluster_flat_data(input_array, euclidean_dist):
-    mod_input_array = []
+def cylinder_pairs(point_array, hz_dist, vt_dist):
+    """
+    Every pair of points within hz_dist of each other horizontally and vt_dist vertically.
 
-    for item in input_array:
-        key = item[0]
-        value = item[1][:4]
-        mod_input_array.append({key: value})
+    The elevations are scaled so the half height of the cylinder equals its radius, which puts it inside a sphere
+    of radius hz_dist * sqrt(2). One KD-tree pair query on that sphere gives the candidates,
+    and the exact horizontal and vertical tests are then applied to them as arrays.
 
-    pt_dict = {}
-    for pt_data in mod_input_array:
-        keys = pt_data.keys()
-        for key in keys:
-            if key in pt_dict:
-                mod_key = f'{key}_tert'
-                pt_dict[mod_key] = pt_data[key][:4]
-            pt_dict[key] = pt_data[key][:4]
+    Parameters:
+    point_array (np.ndarray): An (n, 3) array of easting, northing and elevation.
+    hz_dist (float): The radius of the cylinder.
+    vt_dist (float): The half height of the cylinder.
 
-    x_y_z = [value[:3] for value in pt_dict.values()]
-    print(x_y_z)
-    point_array = np.array(x_y_z)
+    Returns:
+    pairs (np.ndarray): An (m, 2) array of point indices (i < j).
+    """
+    if vt_dist <= 0:
+        scaled = point_array[:, :2]
+        radius = hz_dist
+    else:
+        scaled = point_array * np.array([1.0, 1.0, hz_dist / vt_dist])
+        radius = hz_dist * math.sqrt(2)
 
-    # define the DBSCAN model
-    dbscan = DBSCAN(eps=euclidean_dist, min_samples=50, metric='euclidean')
+    pairs = cKDTree(scaled).query_pairs(r=radius, output_type='ndarray')
+    deltas = point_array[pairs[:, 0]] - point_array[pairs[:, 1]]
+    inside = (np.hypot(deltas[:, 0], deltas[:, 1]) <= hz_dist) & (np.abs(deltas[:, 2]) <= vt_dist)
 
-    # fit the model to the data
-    dbscan.fit(point_array)
+    return pairs[inside]
 
-    # get the labels assigned to each point
-    labels = dbscan.labels_
 
-    # create a dictionary to store the clustered points
-    clusters = {}
+def neighbour_labels(point_array, euclidean_dist, vt_dist=None):
+    """
+    Labels every point with the group of points it can reach in steps of at most euclidean_dist.
 
-    for i, label in enumerate(labels):
-        key = list(mod_input_array[i].keys())[0]
+    This is what DBSCAN with min_samples=2 computes, but found with one KD-tree pair query and a
+    connected components pass instead of a neighbourhood search per point.
 
-        if label not in clusters:
-            clusters[label] = [{key: mod_input_array[i][key]}]
-        else:
-            clusters[label].append({key: mod_input_array[i][key]})
+    Parameters:
+    point_array (np.ndarray): An (n, 3) array of easting, northing and elevation.
+    euclidean_dist (float): The maximum distance between two neighbouring points.
+    vt_dist (float): If given, neighbours are instead within euclidean_dist horizontally and vt_dist vertically
+        (see cylinder_pairs), so the horizontal and vertical tolerances are applied separately.
 
-    return clusters
+    Returns:
+    labels (np.ndarray): The group of each point numbered in order of first appearance, or -1 for a point with no neighbours.
+    """
+    n = len(point_array)
+    if n == 0:
+        return np.empty(0, dtype=np.intp)
 
+    if vt_dist is None:
+        pairs = cKDTree(point_array).query_pairs(r=euclidean_dist, output_type='ndarray')
+    else:
+        pairs = cylinder_pairs(point_array, euclidean_dist, vt_dist)
+
+    graph = coo_matrix((np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, components = connected_components(graph, directed=False)
+
+    # Groups of one point are noise, number the rest from 0 in the order they first appear
+    sizes = np.bincount(components)
+    _, first_seen = np.unique(components, return_index=True)
+    group_order = np.argsort(first_seen)
+    kept = group_order[sizes[group_order] > 1]
+
+    new_label = np.full(len(sizes), -1, dtype=np.intp)
+    new_label[kept] = np.arange(len(kept))
 
-def cluster_data(input_array, euclidean_dist):
+    return new_label[components]
+
+
+def group_point_array(point_array, euclidean_dist, vt_dist=None):
     """
-    This function clusters a given set of geographical data points based on their Euclidean distance using the DBSCAN (Density-Based Spatial Clustering of Applications with Noise) algorithm. The function takes in two parameters: input_array and euclidean_dist.
+    group_control_points for shots held as an array, so the grouping never needs a ControlPoint per shot.
 
-    Parameters:
-    input_array (list of dict): The input data to be clustered. Each dictionary in the list represents a data point with the structure {key: value}, where key is a unique identifier and value is an object with properties: easting, northing, and elevation, representing the coordinates of the point.
-    euclidean_dist (float): The maximum distance between two samples for them to be considered as in the same neighborhood. This parameter is passed as the 'eps' argument in the DBSCAN model.
+    Shots with the same coordinates are kept once, at the position of the first and with the row of the last,
+    as a dict of them would keep them.
 
-    The function constructs a NumPy array from the coordinates in the input data, applies the DBSCAN algorithm to cluster the data based on the given Euclidean distance, and returns a dictionary of the resulting clusters. In the result, each key is a cluster label assigned by the DBSCAN model and the value is a list of data points in the cluster.
+    Parameters:
+    point_array (np.ndarray): An (n, 3) array of easting, northing and elevation of shots that haven't been adjusted.
+    euclidean_dist (float): The maximum distance between two shots of the same point.
+    vt_dist (float): See group_control_points.
 
     Returns:
-    clusters (dict): A dictionary where each key is a cluster label and each value is a list of data points that belong to the cluster. Each data point is represented as a dictionary similar to the input format.
+    one_shot (dict): {coordinate key: row} of the points with no other shot within euclidean_dist.
+    clusters (dict): {label: {coordinate key: row, ...}} of the repeated shots.
     """
+    rows = {}
+    for row, key in enumerate(coordinate_keys(point_array)):
+        rows[key] = row
 
-    coords = []
-    keys = []
+    labels = neighbour_labels(point_array[list(rows.values())].reshape(-1, 3), euclidean_dist, vt_dist)
 
-    for item in input_array:
-        key = list(item.keys())[0]
-        keys.append(key)
-        v = item[key]
-        easting = v.easting
-        northing = v.northing
-        elevation = v.elevation
-        coords.append([easting, northing, elevation])
+    one_shot = {}
+    clusters = {}
 
-    point_array = np.array(coords)
+    for (key, row), label in zip(rows.items(), labels.tolist()):
+        if label == -1:
+            one_shot[key] = row
+        else:
+            clusters.setdefault(label, {})[key] = row
 
-    # define the DBSCAN model
-    dbscan = DBSCAN(eps=euclidean_dist, min_samples=2, metric='euclidean')
+    return one_shot, clusters
 
-    # fit the model to the data
-    dbscan.fit(point_array)
 
-    # get the labels assigned to each point
-    labels = dbscan.labels_
+def group_control_points(input_array, euclidean_dist, vt_dist=None):
+    """
+    Splits control points into the ones that were only shot once and the clusters of repeated shots, in one pass.
 
-    # create a dictionary to store the clustered points
-    clusters = {}
+    Points that have already been adjusted are dropped and points with the same coordinates are kept once, then the
+    remaining points are grouped with neighbour_labels. This gives the same result as clustering with DBSCAN
+    (min_samples=2), removing the adjusted and repeated shots, then clustering again to split off the noise.
 
-    for i, label in enumerate(labels):
+    Parameters:
+    input_array (list of dict): The control points as {id: ControlPoint} dicts.
+    euclidean_dist (float): The maximum distance between two shots of the same point.
+    vt_dist (float): If given, euclidean_dist is the maximum horizontal distance and vt_dist the maximum height
+        difference between two shots of the same point.
 
-        key = keys[i]
+    Returns:
+    one_shot (dict): {coordinate key: ControlPoint} of the points with no other shot within euclidean_dist.
+    clusters (dict): {label: [{coordinate key: ControlPoint}, ...]} of the repeated shots.
+    """
+    points = [pt for item in input_array for pt in item.values() if not pt.adjusted]
+    point_array = np.array([[pt.easting, pt.northing, pt.elevation] for pt in points], dtype=np.float64).reshape(-1, 3)
 
-        if label not in clusters:
-            clusters[label] = [{key: input_array[i][key]}]
-        else:
-            clusters[label].append({key: input_array[i][key]})
+    one_shot, clusters = group_point_array(point_array, euclidean_dist, vt_dist)
 
-    return clusters
+    return (
+        {key: points[row] for key, row in one_shot.items()},
+        {label: [{key: points[row]} for key, row in group.items()] for label, group in clusters.items()},
+    )
 
 
-def cluster_data_split_noise(input_dict, euclidean_dist):
+def shot_group_array(shot_group):
     """
-    This function clusters a given set of geographical data points based on their Euclidean distance using the DBSCAN (Density-Based Spatial Clustering of Applications with Noise) algorithm. The function takes in two parameters: input_array and euclidean_dist.
+    Builds the (n, 3) float64 array of easting, northing and elevation of a shot group.
 
     Parameters:
-    input_array (list of dict): The input data to be clustered. Each dictionary in the list represents a data point with the structure {key: value}, where key is a unique identifier and value is an object with properties: easting, northing, and elevation, representing the coordinates of the point.
-    euclidean_dist (float): The maximum distance between two samples for them to be considered as in the same neighborhood. This parameter is passed as the 'eps' argument in the DBSCAN model.
+    shot_group (list of dict): The shots as {key: ControlPoint} dicts.
+
+    Returns:
+    keys (list): The key of each shot.
+    point_array (np.ndarray): The coordinates of each shot, in the same order.
+    """
+    keys = []
+    coords = []
+    for shot in shot_group:
+        for key, pt in shot.items():
+            keys.append(key)
+            coords.append((pt.easting, pt.northing, pt.elevation))
+
+    return keys, np.array(coords, dtype=np.float64).reshape(-1, 3)
 
-    The function constructs a NumPy array from the coordinates in the input data, applies the DBSCAN algorithm to cluster the data based on the given Euclidean distance, and returns a dictionary of the resulting clusters. In the result, each key is a cluster label assigned by the DBSCAN model and the value is a list of data points in the cluster.
+
+def pairwise_deltas(point_array):
+    """
+    The horizontal and vertical distance between every pair of points.
+
+    Parameters:
+    point_array (np.ndarray): An (n, 3) array of easting, northing and elevation.
 
     Returns:
-    clusters (dict): A dictionary where each key is a cluster label and each value is a list of data points that belong to the cluster. Each data point is represented as a dictionary similar to the input format.
+    hz_deltas (np.ndarray): (n, n) horizontal distances.
+    vt_deltas (np.ndarray): (n, n) absolute height differences.
     """
+    deltas = point_array[:, np.newaxis, :] - point_array[np.newaxis, :, :]
+    hz_deltas = np.hypot(deltas[..., 0], deltas[..., 1])
+    vt_deltas = np.abs(deltas[..., 2])
+    return hz_deltas, vt_deltas
 
-    coords = []
-    keys = []
 
-    for key, cp in input_dict.items():
-        keys.append(key)
-        coords.append([cp.easting, cp.northing, cp.elevation])
+def closest_pair(point_array):
+    """
+    The pair of points closest together horizontally, and the smallest height difference of any pair.
 
-    point_array = np.array(coords)
+    Ties go to the first pair in itertools.combinations order, as they did when the pairs were sorted.
 
-    # define the DBSCAN model
-    dbscan = DBSCAN(eps=euclidean_dist, min_samples=2, metric='euclidean')
+    Parameters:
+    point_array (np.ndarray): An (n, 3) array of easting, northing and elevation, with n >= 2.
 
-    # fit the model to the data
-    dbscan.fit(point_array)
+    Returns:
+    (i, j, hz_delta, vt_delta): The indices of the closest pair (i < j), their horizontal distance and the
+    smallest height difference of all the pairs.
+    """
+    return closest_pairs([point_array])[0]
 
-    # get the labels assigned to each point
-    labels = dbscan.labels_
 
-    # create a dictionary to store the clustered points
-    clusters = {}
-    noise_cluster = {-1: []}
+def closest_pairs(point_arrays):
+    """
+    closest_pair for many groups in one call. The pairs of every group are put into one array,
+    so the distances are computed in a single vectorised pass and the minimum of each group is found with one sort.
 
-    for i, label in enumerate(labels):
+    Parameters:
+    point_arrays (list of np.ndarray): An (n, 3) array of easting, northing and elevation per group.
 
-        key = keys[i]
-        if label == -1:
-            noise_cluster[label].append({key: input_dict[key]})
-        else:
-            if label not in clusters:
-                clusters[label] = [{key: input_dict[key]}]
-            else:
-                clusters[label].append({key: input_dict[key]})
+    Returns:
+    closest (list): (i, j, hz_delta, vt_delta) per group as in closest_pair, or None for a group of fewer than two points.
+    """
+    firsts = []
+    seconds = []
+    group_ids = []
+    offset = 0
+
+    for group_id, point_array in enumerate(point_arrays):
+        n = len(point_array)
+        i, j = np.triu_indices(n, k=1)
+        firsts.append(i + offset)
+        seconds.append(j + offset)
+        group_ids.append(np.full(len(i), group_id, dtype=np.intp))
+        offset += n
+
+    closest = [None] * len(point_arrays)
+    if offset == 0:
+        return closest
+
+    points = np.concatenate([np.asarray(a, dtype=np.float64).reshape(-1, 3) for a in point_arrays])
+    firsts = np.concatenate(firsts)
+    seconds = np.concatenate(seconds)
+    group_ids = np.concatenate(group_ids)
+
+    if len(group_ids) == 0:
+        return closest
+
+    deltas = points[firsts] - points[seconds]
+    hz_deltas = np.hypot(deltas[:, 0], deltas[:, 1])
+    vt_deltas = np.abs(deltas[:, 2])
+
+    # The pairs of each group are contiguous and in combinations order
+    starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]])
+    vt_mins = np.minimum.reduceat(vt_deltas, starts)
 
-    return noise_cluster, clusters
+    # Sort by group, then distance, then position so the first pair of each group is its closest
+    order = np.lexsort((np.arange(len(hz_deltas)), hz_deltas, group_ids))
+    group_firsts = order[np.flatnonzero(np.r_[True, group_ids[order][1:] != group_ids[order][:-1]])]
 
+    group_offsets = np.cumsum([0] + [len(a) for a in point_arrays])
+    for pair, vt_min in zip(group_firsts.tolist(), vt_mins.tolist()):
+        group_id = int(group_ids[pair])
+        base = group_offsets[group_id]
+        closest[group_id] = (int(firsts[pair] - base), int(seconds[pair] - base), float(hz_deltas[pair]), vt_min)
 
-def avg_similarity(string, string_list):
-    scores = [fuzz.token_sort_ratio(string, s) for s in string_list]
-    return sum(scores) / len(scores)
+    return closest
 
 
 def get_best_code(codes):
@@ -202,7 +295,7 @@ def get_best_code(codes):
         # TODO S07 vs 008C
         # if len(codes) == 2:
         #    print(codes)
-        best_code = max(codes, key=lambda s: avg_similarity(s, codes))
+        best_code = most_similar(codes, codes)
 
         try:
             last_char = best_code[-1]
@@ -227,7 +320,7 @@ def get_best_name(names):
     filtered_names = [item for item in names if not any(x in item for x in names_to_filter)]
 
     try:
-        best_name = max(filtered_names, key=lambda s: avg_similarity(s, names))
+        best_name = most_similar(filtered_names, names)
     except ValueError:
         # Filtered names is empty:
         return best_name
@@ -235,6 +328,16 @@ def get_best_name(names):
     return best_name
 
 
+def resolve_best_codes_and_names(groups):
+    """
+    get_best_code and get_best_name for many groups of shots at once, see BestMatchResolver.
+
+    :param groups: The (ids, target types) of every group.
+    :return: The (best code, best name) of every group, in the same order.
+    """
+    return BestMatchResolver(get_best_code, get_best_name).resolve(groups)
+
+
 def _render_mm(value):
     try:
         if 0.001 <= value <= 0.005:
@@ -389,20 +492,14 @@ def gather_additional_one_shot_wonders(shot_group):
         del shot_group[i][key]
     """
 
-    shot_combinations = list(itertools.combinations(shot_group, 2))
-
-    for p1, p2 in shot_combinations:
-
-        p1_key, p1_values = list(p1.items())[0]
-        p2_key, p2_values = list(p2.items())[0]
+    keys, point_array = shot_group_array(shot_group)
+    hz_deltas, vt_deltas = pairwise_deltas(point_array)
+    values = {key: value for shot in shot_group for key, value in shot.items()}
 
-        pos_dist = math.sqrt((p1_values.easting - p2_values.easting) ** 2
-                             + (p2_values.northing - p2_values.northing) ** 2)
-        ht_dist = abs(p1_values.elevation - p2_values.elevation)
-
-        # TODO: What is this for?
-        if pos_dist == 0.0 or ht_dist == 0.0:
-            pt_collector.update({p1_key: p1_values})
+    # TODO: What is this for?
+    for i, j in zip(*np.triu_indices(len(keys), k=1)):
+        if hz_deltas[i, j] == 0.0 or vt_deltas[i, j] == 0.0:
+            pt_collector.update({keys[i]: values[keys[i]]})
 
     return pt_collector
 
@@ -414,32 +511,9 @@ def ref_processing(shot_group, me_keys, vt_keys, flag='Engineering'):
     else:
         pos_thresh = ht_thresh = 0.002
 
-    shot_combinations = list(itertools.combinations(shot_group, 2))
-
-    pair_wise_ht_collector = []
-    pair_wise_pos_collector = []
-
-    # Calculate the distance between each pair of shots
-    for p1, p2 in shot_combinations:
-        p1_key, p1_values = list(p1.items())[0]
-        p2_key, p2_values = list(p2.items())[0]
-
-        pos_dist = math.sqrt((p1_values.easting - p2_values.easting) ** 2
-                             + (p2_values.northing - p2_values.northing) ** 2)
-
-        ht_dist = abs(p1_values.elevation - p2_values.elevation)
-
-        pos_deltas = {
-            f'{p1_key}|{p2_key}':
-                pos_dist}
-
-        pair_wise_pos_collector.append(pos_deltas)
-
-        ht_deltas = {f'{p1_key}|{p2_key}': ht_dist}
-        pair_wise_ht_collector.append(ht_deltas)
-
-    pos_key, pos_val = min_from_dict(pair_wise_pos_collector)
-    ht_key, ht_val = min_from_dict(pair_wise_ht_collector)
+    keys, point_array = shot_group_array(shot_group)
+    i, j, pos_val, ht_val = closest_pair(point_array)
+    pos_key = f'{keys[i]}|{keys[j]}'
 
     collector = []
     key_collector = set()
@@ -514,50 +588,30 @@ def ref_processing(shot_group, me_keys, vt_keys, flag='Engineering'):
     #    return None
 
 
-def cluster_processing(shot_group, pos_thresh=0.0029, ht_thresh=0.0029):
-    consolidation_dict = {}
-    for shot in shot_group:
-        consolidation_dict.update(shot.items())
-
-    shot_combinations = list(itertools.combinations(shot_group, 2))
-    no_of_shot_combinations = len(shot_combinations)
-
-    pair_wise_ht_collector = []
-    pair_wise_pos_collector = []
-
-    # Calculate the distance between each pair of shots
-    for p1, p2 in shot_combinations:
-        p1_key, p1_values = list(p1.items())[0]
-        p2_key, p2_values = list(p2.items())[0]
-
-        pos_dist = math.sqrt((p1_values.easting - p2_values.easting) ** 2
-                             + (p2_values.northing - p2_values.northing) ** 2)
-
-        ht_dist = abs(p1_values.elevation - p2_values.elevation)
-
-        pos_deltas = {
-            f'{p1_key}|{p2_key}':
-                pos_dist}
-
-        pair_wise_pos_collector.append(pos_deltas)
-
-        ht_deltas = {f'{p1_key}|{p2_key}': ht_dist}
-        pair_wise_ht_collector.append(ht_deltas)
+def cluster_processing(shot_group, pos_thresh=0.0029, ht_thresh=0.0029, closest=None, pair=None):
+    """
+    closest is the (i, j, hz_delta, vt_delta) of the group from closest_pairs, if it has already been computed.
+    pair is the two shots at i and j, if they have already been looked up (see cluster_pool.PackedClusters.pair),
+    in which case the group isn't read at all.
+    """
+    if closest is None or pair is None:
+        consolidation_dict = {}
+        for shot in shot_group:
+            consolidation_dict.update(shot.items())
 
-    ordered_pos_deltas = sorted(pair_wise_pos_collector, key=lambda x: list(x.values())[0])
-    ordered_ht_deltas = sorted(pair_wise_ht_collector, key=lambda x: list(x.values())[0])
+        keys, point_array = shot_group_array(shot_group)
+        if closest is None:
+            closest = closest_pair(point_array)
 
-    (pos_key, pos_value) = list(ordered_pos_deltas[0].items())[0]
-    (ht_key, ht_value) = list(ordered_ht_deltas[0].items())[0]
+    i, j, pos_value, ht_value = closest
 
     # if pos_key != ht_key:
     #    print("The minimum position delta is not the same as the minimum HT delta")
 
     # else:
-    a, b = pos_key.split('|')
-
-    a = consolidation_dict[a]
-    b = consolidation_dict[b]
+    if pair is None:
+        pair = consolidation_dict[keys[i]], consolidation_dict[keys[j]]
+    a, b = pair
 
     key_collector = set()
 
@@ -604,42 +658,20 @@ def gsheets_ref_processing(shot_group, me_keys, vt_keys, flag='Engineering'):
     else:
         pos_thresh = ht_thresh = 0.0035
 
-    shot_combinations = list(itertools.combinations(shot_group, 2))
-    no_of_shot_combinations = len(shot_combinations)
-
-    pair_wise_ht_collector = []
-    pair_wise_pos_collector = []
-
-    # Calculate the distance between each pair of shots
-    for p1, p2 in shot_combinations:
-        p1_key, p1_values = list(p1.items())[0]
-        p2_key, p2_values = list(p2.items())[0]
-
-        pos_dist = math.sqrt((p1_values.easting - p2_values.easting) ** 2
-                             + (p2_values.northing - p2_values.northing) ** 2)
+    keys, point_array = shot_group_array(shot_group)
+    hz_deltas, vt_deltas = pairwise_deltas(point_array)
+    i, j = np.triu_indices(len(keys), k=1)
 
-        ht_dist = abs(p1_values.elevation - p2_values.elevation)
-
-        pos_deltas = {
-            f'{p1_key}|{p2_key}':
-                pos_dist}
-
-        pair_wise_pos_collector.append(pos_deltas)
-
-        ht_deltas = {f'{p1_key}|{p2_key}': ht_dist}
-        pair_wise_ht_collector.append(ht_deltas)
-
-    ordered_pos_deltas = sorted(pair_wise_pos_collector, key=lambda x: list(x.values())[0])
-    ordered_ht_deltas = sorted(pair_wise_ht_collector, key=lambda x: list(x.values())[0])
-
-    (pos_key, pos_value) = list(ordered_pos_deltas[0].items())[0]
-    (ht_key, ht_value) = list(ordered_ht_deltas[0].items())[0]
+    pos_pair = int(np.argmin(hz_deltas[i, j]))
+    ht_pair = int(np.argmin(vt_deltas[i, j]))
+    pos_key, pos_value = (keys[i[pos_pair]], keys[j[pos_pair]]), float(hz_deltas[i[pos_pair], j[pos_pair]])
+    ht_key, ht_value = (keys[i[ht_pair]], keys[j[ht_pair]]), float(vt_deltas[i[ht_pair], j[ht_pair]])
 
     if pos_key != ht_key:
         print("The minimum position delta is not the same as the minimum HT delta")
 
     else:
-        a, b = pos_key.split('|')
+        a, b = pos_key
 
         a = consolidation_dict[a]
         b = consolidation_dict[b]
@@ -751,18 +783,21 @@ def remove_incorporated_shots_testing(clust_data):
     to_process = {}
     one_shot = {}
 
+    noise = []
+    clustered = []
     for k, v in clust_data.items():  # k is the cluster number, v is the list of dicts
 
         for i, item in enumerate(v):  # i is the index of the dict in the list, item is the dict
             pt_id, pt = list(item.items())[0]
             if k == -1:
                 if not pt.adjusted:
-                    hash_key = create_hash(pt.easting, pt.northing, pt.elevation)
-                    one_shot.update({hash_key: pt})
+                    noise.append(pt)
             else:
                 if not any([clustered_shot.adjusted for clustered_shot in item.values()]):
-                    hash_key = create_hash(pt.easting, pt.northing, pt.elevation)
-                    to_process.update({hash_key: pt})
+                    clustered.append(pt)
+
+    one_shot.update(zip(point_keys(noise), noise))
+    to_process.update(zip(point_keys(clustered), clustered))
 
     return one_shot, to_process
 
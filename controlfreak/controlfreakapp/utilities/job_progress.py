@@ -0,0 +1,131 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+# The stages of a report job and the part of its percent each one covers, in the order they run
+STAGE_PERCENTS = {
+    'ingest': (0, 30),
+    'history': (30, 35),
+    'clustering': (35, 45),
+    'pair evaluation': (45, 75),
+    'persistence': (75, 95),
+    'saving': (95, 100),
+}
+
+# The most progress messages a job sends per second unless REPORT_PROGRESS_EVENTS_PER_SECOND is set
+EVENTS_PER_SECOND = 4
+# The most points sent in one message, a site wide run can find thousands of one shot points at once
+POINTS_PER_MESSAGE = 500
+
+
+def job_group(job_id) -> str:
+    """
+    The channel layer group the progress of a report job is sent to.
+    """
+    return f'report_job_{job_id}'
+
+
+def no_progress(stage: str, done: int, total: int) -> None:
+    """
+    The progress callback of a run that nobody is watching.
+    """
+
+
+def no_point(section: str, point: dict) -> None:
+    """
+    The on_point callback of a run that nobody is watching.
+    """
+
+
+def stage_percent(stage: str, done: int, total: int) -> int:
+    start, end = STAGE_PERCENTS.get(stage, (0, 100))
+    if total <= 0:
+        return start
+    return start + (end - start) * min(done, total) // total
+
+
+class ProgressPublisher:
+    """
+    Sends the progress of a report job to its group on the channel layer and keeps job.stage and job.percent up to date.
+
+    It is called as progress(stage, done, total) from the pipeline as often as it likes. The latest update of each
+    stage is kept and they are sent together, at most events_per_second times a second, so a run over thousands of
+    clusters sends a handful of messages rather than one per cluster. An update that starts or finishes a stage is
+    always sent.
+    The one shot and proposed points the adjustment finds are passed to point() and sent along with the progress,
+    so the points can be reviewed before the report is finished.
+    A channel layer that can't be reached never stops the job, the progress is then only kept on the job.
+
+    :args job: The ReportJob.
+    :args events_per_second: The most messages sent per second, defaults to REPORT_PROGRESS_EVENTS_PER_SECOND.
+    :args channel_layer: The channel layer, defaults to the default one. None if CHANNEL_LAYERS isn't set.
+    """
+
+    def __init__(self, job, events_per_second: float | None = None, channel_layer=None):
+        self.job = job
+        self.group = job_group(job.pk)
+        events_per_second = events_per_second or getattr(settings, 'REPORT_PROGRESS_EVENTS_PER_SECOND', EVENTS_PER_SECOND)
+        self.min_interval = 1 / events_per_second
+        self.channel_layer = channel_layer if channel_layer is not None else get_channel_layer()
+        self.pending = {}
+        self.pending_points = []
+        self.last_sent = 0.0
+
+    def __call__(self, stage: str, done: int, total: int) -> None:
+        self.pending[stage] = {
+            'stage': stage,
+            'done': done,
+            'total': total,
+            'percent': stage_percent(stage, done, total),
+        }
+
+        if done == 0 or done >= total or time.monotonic() - self.last_sent >= self.min_interval:
+            self.flush()
+
+    def point(self, section: str, point: dict) -> None:
+        """
+        The on_point callback of iter_adjustment, section is ONE_SHOT or PROPOSED.
+        """
+        self.pending_points.append({'section': section, **point})
+
+        if time.monotonic() - self.last_sent >= self.min_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Sends the updates and points that have been held back by the throttle.
+        """
+        if not self.pending and not self.pending_points:
+            return
+
+        events = list(self.pending.values())
+        points = self.pending_points
+        self.pending = {}
+        self.pending_points = []
+        self.last_sent = time.monotonic()
+
+        if events:
+            self.job.set_progress(events[-1]['stage'], events[-1]['percent'])
+            self.send({'type': 'job.progress', 'events': events})
+
+        for start in range(0, len(points), POINTS_PER_MESSAGE):
+            self.send({'type': 'job.points', 'points': points[start:start + POINTS_PER_MESSAGE]})
+
+    def finish(self, status: str, error: str = '') -> None:
+        """
+        Sends what is left and then the final status of the job.
+        """
+        self.flush()
+        self.send({'type': 'job.status', 'status': status, 'error': error})
+
+    def send(self, message: dict) -> None:
+        if self.channel_layer is None:
+            return
+
+        try:
+            async_to_sync(self.channel_layer.group_send)(self.group, message)
+        except Exception as e:
+            # Redis being down or a full channel shouldn't fail the report
+            print(f'Could not send the progress of report job {self.job.pk}: {e}')
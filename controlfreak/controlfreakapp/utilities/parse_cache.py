@@ -0,0 +1,142 @@
+import os
+import json
+import shutil
+import dataclasses
+import tempfile
+import numpy as np
+
+from .station_setup_parser import StationSetupData
+from .twelve_da_parser import ParsedControlFile, PointBlock, parse_control_file
+
+# Bump whenever twelve_da_parser or station_setup_parser change what they return,
+# entries written under an older version are then ignored and cleared out.
+# 3: UTF-16 without a BOM was sniffed as UTF-8 before.
+PARSE_CACHE_VERSION = 3
+
+COORDINATES_FILE = 'coordinates.npy'
+METADATA_FILE = 'metadata.json'
+
+
+def _version_dir(cache_dir: str) -> str:
+    return os.path.join(cache_dir, f'v{PARSE_CACHE_VERSION}')
+
+
+def _entry_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def evict_least_recently_used(root: str, max_bytes: int) -> None:
+    """
+    Deletes the least recently used entries (sub directories) of root until they fit in max_bytes.
+    An entry is used when it is written or loaded, which updates its modification time.
+    """
+    try:
+        entries = [entry for entry in os.scandir(root) if entry.is_dir() and not entry.name.startswith('.')]
+    except FileNotFoundError:
+        return
+
+    sizes = {entry.path: _entry_size(entry.path) for entry in entries}
+    total = sum(sizes.values())
+
+    for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= sizes[entry.path]
+
+
+def load_parsed_file(cache_dir: str, file_hash: str) -> ParsedControlFile | None:
+    """
+    Loads a parsed 12d file from the cache. The coordinates are memory-mapped rather than read.
+
+    :param cache_dir: The root of the parse cache.
+    :param file_hash: The TertiaryControlFile.file_hash the entry was stored under.
+    :return: The parsed file, or None if there is no usable entry.
+    """
+    entry = os.path.join(_version_dir(cache_dir), file_hash)
+
+    try:
+        with open(os.path.join(entry, METADATA_FILE), 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        coordinates = np.load(os.path.join(entry, COORDINATES_FILE), mmap_mode='r')
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f'Ignoring unreadable parse cache entry {entry}: {e}')
+        return None
+
+    events = []
+    for event in metadata['events']:
+        if event[0] == 'points':
+            names, target_type, start, stop = event[1:]
+            events.append(('points', PointBlock(names, coordinates[start:stop], target_type)))
+        elif event[0] == 'setup':
+            events.append(('setup', StationSetupData(**event[1])))
+        else:
+            events.append((event[0], None))
+
+    # Mark the entry as recently used
+    os.utime(entry)
+
+    return ParsedControlFile(metadata['encoding'], events)
+
+
+def store_parsed_file(cache_dir: str, file_hash: str, parsed: ParsedControlFile, max_bytes: int) -> None:
+    """
+    Writes a parsed 12d file to the cache, then evicts old entries to keep the cache under max_bytes.
+
+    The coordinates of every block go into one float64 .npy file and everything else into a json file.
+    The entry is written to a temporary directory and renamed into place, so readers never see half an entry.
+    """
+    version_dir = _version_dir(cache_dir)
+    os.makedirs(version_dir, exist_ok=True)
+
+    blocks = []
+    events = []
+    start = 0
+    for kind, value in parsed.events:
+        if kind == 'points':
+            stop = start + len(value.names)
+            blocks.append(np.asarray(value.coordinates, dtype=np.float64).reshape(-1, 3))
+            events.append(['points', value.names, value.target_type, start, stop])
+            start = stop
+        elif kind == 'setup':
+            events.append(['setup', dataclasses.asdict(value)])
+        else:
+            events.append([kind])
+
+    coordinates = np.concatenate(blocks) if blocks else np.empty((0, 3))
+
+    temp_dir = tempfile.mkdtemp(prefix='.', dir=version_dir)
+    try:
+        np.save(os.path.join(temp_dir, COORDINATES_FILE), coordinates)
+        with open(os.path.join(temp_dir, METADATA_FILE), 'w', encoding='utf-8') as f:
+            json.dump({'encoding': parsed.encoding, 'events': events}, f)
+        os.replace(temp_dir, os.path.join(version_dir, file_hash))
+    except OSError as e:
+        # Another process stored the same file first, or the cache isn't writable
+        print(f'Could not store parse cache entry for {file_hash}: {e}')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+
+    # Entries from older parser versions will never be read again
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and entry.path != version_dir and entry.name.startswith('v'):
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    evict_least_recently_used(version_dir, max_bytes)
+
+
+def parse_control_file_cached(path: str, encoding: str | None, file_hash: str | None, cache_dir: str | None, max_bytes: int) -> ParsedControlFile:
+    """
+    parse_control_file, but reusing the parse of a file with the same hash when there is one.
+    Like parse_control_file it has no database access, so it can run in a worker process.
+    """
+    if not cache_dir or not file_hash:
+        return parse_control_file(path, encoding)
+
+    parsed = load_parsed_file(cache_dir, file_hash)
+    if parsed is None:
+        parsed = parse_control_file(path, encoding)
+        store_parsed_file(cache_dir, file_hash, parsed, max_bytes)
+
+    return parsed
@@ -1,432 +1,403 @@
 import os
-import re
 import zipfile
-import logging
 import math
-from io import BytesIO, StringIO
+from io import TextIOWrapper
 import csv
-from django.http import HttpResponse
-from typing import Optional
-from typing import List, Dict, Any, Tuple
-
-from .CONSTANTS import Helmert, OverPoint, ResectionPoint, ControlPoint, RESECTION_KEYS, OVER_POINT_KEYS
-from statistics import mean
-from .station_setup_parser import StationSetupParser
-from .text_from_12d import TextFrom12dConverter, split_string, remove_parenthesis
-from ..models import TertiaryControlFile, Coordinates, UnAdjustedTertiaryControlPoint, OverPointStationSetup, AveragedTertiaryControlPoint
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import OrderedDict
+from django.conf import settings
+from django.db import transaction
+
+from .create_django_models import SetupWriter, create_control_points, coordinate_key, get_or_create_coordinates, get_seeds, get_or_create_averaged_points
+from .twelve_da_parser import ParsedControlFile
+from .parse_cache import parse_control_file_cached
+from .tolerance_hierarchy import ToleranceHierarchy
+from .cluster_pool import evaluate_clusters, pack_clusters
+from .fixed_point import fixed_mean, fixed_delta, format_fixed
+from .shot_columns import load_shot_columns
+from .spatial_index import with_neighbouring_history
+from .job_progress import no_progress, no_point
+from ..models import TertiaryControlFile, UnAdjustedTertiaryControlPoint, AveragedTertiaryControlPoint
 from ..utilities import geometry_manipulation as gm
 
-
-def write_to_report_csv(rows):
-
-    output = StringIO()
-    writer = csv.writer(output)
-    for row in rows:
-        writer.writerow(row)
-
-    return output.getvalue()
-
-def adjust_tertiary_control_points(queryset, hz_tolerance, vz_tolerance) -> None:
+# The sections of an adjustment report, see iter_adjustment
+ONE_SHOT = 'one_shot'
+REPORT = 'report'
+PROPOSED = 'proposed'
+# The order iter_adjustment yields the sections in
+REPORT_SECTIONS = (ONE_SHOT, REPORT, PROPOSED)
+# Sections that are short enough to hold until the others have been streamed, as they are interleaved with them
+HELD_SECTIONS = (PROPOSED,)
+
+
+# The most hierarchies kept for the next preview, see tolerance_hierarchy_for_files
+PREVIEW_CACHE_SIZE = 16
+_preview_hierarchies = OrderedDict()
+
+
+def tolerance_hierarchy_for_files(file_pks: tuple, max_tolerance: float, hz_tolerance: float, vt_tolerance: float) -> ToleranceHierarchy:
+    """
+    The ToleranceHierarchy of the shots a report of some files at tolerances in mm would adjust: the files' shots and
+    the earlier shots near them, as upload_report_rows finds them.
+
+    The hierarchy is kept for the next preview of the same shots. It is looked up by the pks of the shots, so once
+    more of a file has been ingested, or earlier shots near it have been added or deleted, it is built again.
+    """
+    control_points = UnAdjustedTertiaryControlPoint.objects.filter(
+        source__in=file_pks, coordinates__isnull=False).select_related('coordinates', 'source')
+    control_points = with_neighbouring_history(list(control_points), hz_tolerance, vt_tolerance)
+
+    key = (tuple(sorted(cp.pk for cp in control_points)), max_tolerance)
+    hierarchy = _preview_hierarchies.pop(key, None)
+    if hierarchy is None:
+        hierarchy = ToleranceHierarchy.from_point_array(load_shot_columns(control_points).point_array, max_tolerance / 1000)
+
+    _preview_hierarchies[key] = hierarchy
+    while len(_preview_hierarchies) > PREVIEW_CACHE_SIZE:
+        _preview_hierarchies.popitem(last=False)
+
+    return hierarchy
+
+
+def coordinate_columns(coordinates) -> tuple[str, str, str]:
+    """
+    The easting, northing and elevation columns of a report row, to the 8 decimal places they are stored with.
+    """
+    return format_fixed(coordinates.easting), format_fixed(coordinates.northing), format_fixed(coordinates.elevation)
+
+
+def seed_setup_rows(seed) -> tuple[list, list]:
+    """
+    The report rows for the setup of a seed: [setup id, pos error, scale factor, level delta] and one row per resection point.
+    """
+    if seed.resection is None:
+        return [seed.otp_setup.ops_id, 'TBC', 'TBC', seed.otp_setup.bs_elevation_delta], []
+
+    resection_coords = [
+        (
+            rp.helm_id,
+            rp.target_type,
+            "Yes" if rp.use_pos else "No",
+            "Yes" if rp.use_ht else "No",
+            rp.pos_error,
+            rp.tps_reflector_type,
+            rp.tps_measure_style,
+            rp.tps_settings,
+            rp.model_name
+        ) for rp in seed.resection.resectionpoint_set.all()]
+
+    return [seed.resection.helmert_id, seed.resection.pos_error, seed.resection.scale_factor, seed.resection.level_diff], resection_coords
+
+
+def iter_adjustment(queryset, hz_tolerance, vz_tolerance, progress=no_progress, on_point=no_point):
+    """
+    Runs the adjustment and yields the rows of the three report CSVs as they are produced, as (section, row) with
+    section one of ONE_SHOT, REPORT and PROPOSED.
+    progress(stage, done, total) is called through the clustering, pair evaluation and persistence stages.
+    on_point(section, point) is called with each one shot point as soon as it is found, and with each proposed point
+    just before its rows are yielded. A pair whose shots have no seed in the database is never proposed.
+
+    The one shot rows are all yielded first, before anything is written to the database. The report and proposed
+    rows are yielded pair by pair after that.
+    """
     hz_tolerance = float(hz_tolerance/1000)
     vz_tolerance = float(vz_tolerance/1000)
 
-    tertiary_control = []
-
-    for cp in queryset:
-        tertiary_control_point = {
-            cp.control_id:
-                ControlPoint(
-                    id=cp.control_id,
-                    easting=cp.coordinates.easting,
-                    northing=cp.coordinates.northing,
-                    elevation=cp.coordinates.elevation,
-                    target_type=cp.target_type,
-                    horizontal_quality=4,
-                    vertical_quality=4,
-                    file_source=str(cp.source),
-                    adjusted=False,
-                ),
-        }
-        tertiary_control.append(tertiary_control_point)
-
-    clustered = gm.cluster_data(tertiary_control, euclidean_dist=hz_tolerance*3)
-    one_shot, to_process = gm.remove_incorporated_shots_testing(clustered)
-
-    noise, shots_to_investigate = gm.cluster_data_split_noise(to_process, euclidean_dist=hz_tolerance*3)
-
-    for cp_list in noise.values():
-        for cp_dict in cp_list:
-            one_shot.update(cp_dict)
+    # The shots stay in columns, a ControlPoint is only built for the ones a row is written for
+    tertiary_control = load_shot_columns(queryset)
+
+    progress('clustering', 0, len(tertiary_control))
+    one_shot, shots_to_investigate = gm.group_point_array(tertiary_control.point_array, euclidean_dist=hz_tolerance*3, vt_dist=vz_tolerance*3)
+    progress('clustering', len(tertiary_control), len(tertiary_control))
 
     print(f'There are {len(one_shot)} points that will need additional observations.')
     print(f'Compared the euclidian distance and Hz delta of {len(shots_to_investigate)} shots.')
 
-    rows = []
-    proposed_rows = []
-    one_shot_rows = []
-    one_shot_rows.append(['Name', 'Easting', 'Northing', 'Elevation', 'Target Type','Original Source'])
-    for k,v in one_shot.items():
-
-        one_shot_rows.append((v.id, v.easting, v.northing, v.elevation, v.target_type, v.file_source))
-
-    for i, (label, shots) in enumerate(shots_to_investigate.items()):
-        res = gm.cluster_processing(shots, pos_thresh=hz_tolerance+.0009, ht_thresh=vz_tolerance+.0009)
+    yield ONE_SHOT, ['Name', 'Easting', 'Northing', 'Elevation', 'Target Type','Original Source']
+    for row in one_shot.values():
+        v = tertiary_control[row]
+        on_point(ONE_SHOT, {
+            'control_id': v.id, 'target_type': v.target_type,
+            'easting': v.easting, 'northing': v.northing, 'elevation': v.elevation,
+            'sources': [v.file_source],
+        })
+        yield ONE_SHOT, (v.id, format_fixed(v.easting), format_fixed(v.northing), format_fixed(v.elevation), v.target_type, v.file_source)
+
+    progress('pair evaluation', 0, len(shots_to_investigate))
+    # Packed once, for the pair evaluation and to look the closest pairs up afterwards
+    clusters = pack_clusters(shots_to_investigate.values(), columns=tertiary_control)
+    # The closest pair, code and name of every cluster, found across a process pool for large reports
+    evaluated = evaluate_clusters(clusters, pos_thresh=hz_tolerance+.0009, ht_thresh=vz_tolerance+.0009, progress=progress)
+
+    accepted = []
+    for i in range(len(clusters)):
+        if evaluated[i] is None:
+            continue
+        closest = evaluated[i][:4]
+        # The pair is looked up already, so the shots of the cluster aren't needed
+        res = gm.cluster_processing(None, pos_thresh=hz_tolerance+.0009, ht_thresh=vz_tolerance+.0009, closest=closest, pair=clusters.pair(i, *closest[:2]))
         if res is not None:
             tab, shots_to_average, pos_val, ht_val, file_a, file_b = res
-            a, b = shots_to_average
-
-            shot_col = [
-                [cp.id,
-                 cp.easting,
-                 cp.northing,
-                 cp.elevation,
-                 cp.target_type,
-                 cp.file_source] for cp in shots_to_average]
-
-            averages = [round(mean([item[i] for item in shot_col]), 3) for i in range(1, 4)]
-            codes = [item[0] for item in shot_col]
-            names = [item[4] for item in shot_col]
-            best_code = gm.get_best_code(codes)
-            best_name = gm.get_best_name(names)
-
-            try:
-                a_coords, created = Coordinates.objects.get_or_create(
-                    easting=a.easting,
-                    northing=a.northing,
-                    elevation=a.elevation,
-                    flavour='RW'
-                )
-
-            except Coordinates.MultipleObjectsReturned:
-                a_coords = Coordinates.objects.filter(
-                    easting=a.easting,
-                    northing=a.northing,
-                    elevation=a.elevation,
-                    flavour='RW').first()
-            try:
-                b_coords, created = Coordinates.objects.get_or_create(
-                    easting=b.easting,
-                    northing=b.northing,
-                    elevation=b.elevation,
-                    flavour='RW'
-                )
-
-            except Coordinates.MultipleObjectsReturned:
-                b_coords = Coordinates.objects.filter(
-                    easting=b.easting,
-                    northing=b.northing,
-                    elevation=b.elevation,
-                    flavour='RW'
-                ).first()
-
-            try:
-                try:
-                    a_seed = UnAdjustedTertiaryControlPoint.objects.get(
-                        control_id=a.id,
-                        target_type=a.target_type,
-                        coordinates=a_coords
-                    )
-                except UnAdjustedTertiaryControlPoint.MultipleObjectsReturned:
-                    a_seed = UnAdjustedTertiaryControlPoint.objects.filter(
-                        control_id=a.id,
-                        target_type=a.target_type,
-                        coordinates=a_coords
-                    ).first()
-
-                try:
-                    b_seed = UnAdjustedTertiaryControlPoint.objects.get(
-                        control_id=b.id,
-                        target_type=b.target_type,
-                        coordinates=b_coords)
-
-                except UnAdjustedTertiaryControlPoint.MultipleObjectsReturned:
-                    b_seed = UnAdjustedTertiaryControlPoint.objects.filter(
-                        control_id=b.id,
-                        target_type=b.target_type,
-                        coordinates=b_coords
-                    ).first()
-
-                averaged_coords, created = Coordinates.objects.get_or_create(
-                    easting=averages[0],
-                    northing=averages[1],
-                    elevation=averages[2],
-                    flavour='ME'
-                )
-
-                pc, created = AveragedTertiaryControlPoint.objects.get_or_create(
-                    control_id=best_code,
-                    target_type=best_name,
-                    horizontal_quality=4,
-                    vertical_quality=4,
-                    a_seed=a_seed,
-                    b_seed=b_seed,
-                    coordinates=averaged_coords,
-                )
-                if created:
-                    print(f'Created {pc}')
-                else:
-                    print(f'Already exists {pc}')
-
-                if a_seed.resection is None:
-                    a_setup_id = a_seed.otp_setup.ops_id
-                    a_pos_error = 'TBC'
-                    a_scale_factor = 'TBC'
-                    a_level_diff = a_seed.otp_setup.bs_elevation_delta
-                else:
-                    a_resection_coords = [
-                        (
-                            rp.helm_id,
-                            rp.target_type,
-                            "Yes" if rp.use_pos else "No",
-                            "Yes" if rp.use_ht else "No",
-                            rp.pos_error,
-                            rp.tps_reflector_type,
-                            rp.tps_measure_style,
-                            rp.tps_settings,
-                            rp.model_name
-                        ) for rp in a_seed.resection.resectionpoint_set.all()]
-
-                    a_setup_id = a_seed.resection.helmert_id
-                    a_pos_error = a_seed.resection.pos_error
-                    a_scale_factor = a_seed.resection.scale_factor
-                    a_level_diff = a_seed.resection.level_diff
-
-                if b_seed.resection is None:
-                    b_setup_id = b_seed.otp_setup.ops_id
-                    b_pos_error = 'TBC'
-                    b_scale_factor = 'TBC'
-                    b_level_diff = b_seed.otp_setup.bs_elevation_delta
-                else:
-                    b_resection_coords =  [
-                        (
-                            rp.helm_id,
-                            rp.target_type,
-                            "Yes" if rp.use_pos else "No",
-                            "Yes" if rp.use_ht else "No",
-                            rp.pos_error,
-                            rp.tps_reflector_type,
-                            rp.tps_measure_style,
-                            rp.tps_settings,
-                            rp.model_name
-                        ) for rp in b_seed.resection.resectionpoint_set.all()]
-
-                    b_setup_id = b_seed.resection.helmert_id
-                    b_pos_error = b_seed.resection.pos_error
-                    b_scale_factor = b_seed.resection.scale_factor
-                    b_level_diff = b_seed.resection.level_diff
-
-                proposed_cp_row = (pc.control_id, pc.coordinates.easting, pc.coordinates.northing, pc.coordinates.elevation, pc.target_type)
-                # Resection / OTP setup for control point shot.
-                a_seed_row = [a_seed.control_id, a.easting, a.northing, a.elevation, a_seed.target_type,'','','','', a_seed.source]
-                b_seed_row = [b_seed.control_id, b.easting, b.northing, b.elevation, b_seed.target_type,'','','','',  b_seed.source]
-
-                a_setup_row = [a_setup_id, a_pos_error, a_scale_factor, a_level_diff]
-                b_setup_row = [b_setup_id, b_pos_error, b_scale_factor, b_level_diff]
-
-                a_b_deltas_row = ['','', math.sqrt((a.easting - b.easting)**2 + (a.northing - b.northing)**2), a.elevation - b.elevation]
-
-                rows.append(['Proposed Name', 'Easting', 'Northing', 'Elevation', 'Target Type'])
-                proposed_rows.append(proposed_cp_row)
-                rows.append(proposed_cp_row)
-                rows.append([" "])
-
-                rows.append(['', 'A-B Deltas:', 'Hz Euclidian', 'Vz Delta'])
-                rows.append(a_b_deltas_row)
-                rows.append([" "])
-
-                rows.append(['Seed A Name', 'Easting', 'Northing', 'Elevation','Target Type', '','','','', 'Source'])
-                rows.append(a_seed_row)
-                rows.append([''])
-                rows.append(['', 'Resection', 'Pos Error', 'Scale Factor', 'Level Delta',])
-
-                rows.append([''] + a_setup_row)
-                rows.append([''])
-                rows.append([''] +['Resection Points'])
-                                # (rp.helm_id, rp.target_type, rp.use_pos, rp.use_ht, rp.pos_error, rp.tps_reflector_type, rp.tps_measure_style, rp.tps_settings, rp.model_name)
-                rows.append(['']+ ['Name','Type & Quality','Pos Held','Ht Held',  'Pos Error', 'Reflector Type','Measure Style','TPS setting','Source'])
-                for row in a_resection_coords:
-                    rows.append([''] + list(row))
-
-
-                rows.append([" "])
-                rows.append(['Seed B Name', 'Easting', 'Northing', 'Elevation','Target Type','','','','', 'Source'])
-                rows.append(b_seed_row)
-                rows.append([''])
-                rows.append(['', 'Resection', 'Pos Error', 'Scale Factor', 'Level Delta'])
-                rows.append([''] + b_setup_row)
-                rows.append([''])
-                rows.append([''] + ['Resection Points'])
-                rows.append([''] + ['Name', 'Type & Quality', 'Pos Held', 'Ht Held', 'Pos Error', 'Reflector Type',
-                                    'Measure Style', 'TPS setting', 'Source'])
-                for row in b_resection_coords:
-                    rows.append([''] + list(row))
-
-                rows.append([" "])
-                rows.append([" "])
-
-            except UnAdjustedTertiaryControlPoint.DoesNotExist:
-                pass
-
-
-    return rows, one_shot_rows, proposed_rows
-
-def create_internet_zip(report_data, one_shot_data, proposed_data, report_name) -> HttpResponse:
-    buffer = BytesIO()
-    with zipfile.ZipFile(buffer, 'w') as zip_file:
-        if report_data:
-            zip_file.writestr(f'{report_name}_averaging_report.csv', report_data)
-        if one_shot_data:
-            zip_file.writestr(f'{report_name}_additional_obs_required.csv', one_shot_data)
-        if proposed_data:
-            zip_file.writestr(f'{report_name}_proposed_new_control.csv', proposed_data)
-
-    response = HttpResponse(buffer.getvalue(), content_type='application/zip')
-    response['Content-Disposition'] = f'attachment; filename=f{report_name}.zip'
-
-    # Important: close the buffer
-    buffer.close()
-
-    return response
-
-def create_control_point_objects(obj) -> list[dict[Any, Any] | dict[Any, ControlPoint]]:
-    print(f'Processing {obj}...')
-    path = obj.file.path
-    raw_12da = TextFrom12dConverter(path).get_12da_text()
-
-    lines = raw_12da.splitlines()
-    tertiary_control_point = {}
-    coordinates_collector = []
-    point_data_collector = []
-    final_collector = []
-    query_set_collector = []
-    has_setup_data = False
-    target_type = 'Not specified'
-
-    for i in range(len(lines)):
-
-        if 'super ' in lines[i]:
-            # if lines[i].startswith('super '):
-            # Check if the next line starts with 'name'
-            if i + 1 < len(lines) and 'name ' in lines[i + 1]:
-                # try:
-                target_type = remove_parenthesis(lines[i + 1].split()[1].strip())
-                if target_type == '':
-                    target_type = 'Not specified'
-
-        # Collect the coordinates
-        if 'data_3d' in lines[i]:
-            has_setup_data = False
-            # if lines[i].startswith('data_3d'):
-            # will have as many lines as there are points
-            coordinates_iterator = 1
-
-            while True:
-                line = lines[i + coordinates_iterator]
-
-                try:
-                    coordinates = [float(item) for item in line.split()]
-                    coordinates_collector.append(coordinates + [target_type])
-                    coordinates_iterator += 1
-
-                except ValueError:
-                    # Could not convert to float, so it must be the end of the coordinates
-                    # if lines[i + coordinates_iterator + 1] == '}':
-                    if '}' in lines[i + coordinates_iterator + 1]:
-                        coordinates_collector.pop(-1)
-
-                    point_data_iterator = coordinates_iterator + 2
-                    break
-
-            while True:
-                # Got to the end of the set of coordinates or to the end of a file
-                try:
-                    if '}' in lines[i + point_data_iterator]:
-                        # if lines[i + point_data_iterator] == '}':
-                        break
-
-                except IndexError:
-                    break
-
-                point_data = lines[i + point_data_iterator]  # get the next line
-                point_data = split_string(point_data)  # split the line into a list of strings
-                point_data_collector.extend(point_data)
-                point_data_iterator += 1
-
-        if "Inst Stat Setup" in lines[i]:
-            # Get the setup data
-            if not has_setup_data:
-
-                setup_data = StationSetupParser(lines, i, obj).return_setup_object()
-
-                has_setup_data = setup_data is not None
-
-                if setup_data is not None:
-
-                    merged = zip(point_data_collector, coordinates_collector)
-
-                    collector = []
-
-                    for point_data, coordinate in merged:
-                        # As long as the coordinate is not already in the collector, add it and the point id
-                        if coordinate not in collector:
-                            # Create the control point using the class
-                            collector.append([point_data] + coordinate)  # + [setup_hash_key])
-
-                    for j, item in enumerate(collector):
-                        pt_id = item[0]
-                        #hash_key = create_hash(item[1:4])
-                        if pt_id not in tertiary_control_point:
-                            tertiary_control_point = {
-                                pt_id:
-                                    ControlPoint(
-                                        id=item[0],
-                                        easting=item[1],
-                                        northing=item[2],
-                                        elevation=item[3],
-                                        target_type=item[4],
-                                        horizontal_quality=4,
-                                        vertical_quality=4,
-                                        file_source=obj,
-                                        adjusted=False,
-                                    ),
-                            }
-
-                            final_collector.append(tertiary_control_point)
-
-                    print(f'{len(final_collector)} control points for each setup')
-
-                    for item in final_collector:
-
-                        for key, tcp in item.items():
-                            coordinates, created = Coordinates.objects.get_or_create(
-                                easting=tcp.easting,
-                                northing=tcp.northing,
-                                elevation=tcp.elevation,
-                                flavour='RW'
-                            )
-
-                            tertiary_cp_for_db, created = UnAdjustedTertiaryControlPoint.objects.get_or_create(
-                                control_id=key,
-                                coordinates=coordinates,
-                                target_type=tcp.target_type,
-                                horizontal_quality=4,
-                                vertical_quality=4,
-                                source=obj,
-                                adjusted=False,
-                            )
-
-                            if created:
-                                if setup_data.setup_type == 'Helmert':
-                                    tertiary_cp_for_db.resection = setup_data
-                                    tertiary_cp_for_db.save()
-                                else:
-                                    tertiary_cp_for_db.otp_setup = setup_data
-                                    tertiary_cp_for_db.save()
-
-                                print(f'Created {tertiary_cp_for_db}')
-                            else:
-                                print(setup_data.setup_type)
-                                print(f'Already exists {tertiary_cp_for_db}')
-                            query_set_collector.append(tertiary_cp_for_db)
+
+            averages = [fixed_mean([getattr(cp, axis) for cp in shots_to_average]) for axis in ('easting', 'northing', 'elevation')]
+            best_code, best_name = evaluated[i][4:]
+            accepted.append((shots_to_average, averages, best_code, best_name))
+
+    progress('persistence', 0, len(accepted))
+    # Every seed is found, with its setup and resection points, in a fixed number of queries rather than several per cluster
+    seeds = get_seeds([cp for shots_to_average, *_ in accepted for cp in shots_to_average])
+
+    seeded = []
+    for (a, b), averages, best_code, best_name in accepted:
+        a_seed = seeds.get((a.id, a.target_type, coordinate_key(a.easting, a.northing, a.elevation)))
+        b_seed = seeds.get((b.id, b.target_type, coordinate_key(b.easting, b.northing, b.elevation)))
+        # A shot that isn't in the database can't seed an averaged point
+        if a_seed is not None and b_seed is not None:
+            seeded.append((a, b, a_seed, b_seed, averages, best_code, best_name))
+
+    averaged_coords = get_or_create_coordinates([averages for a, b, a_seed, b_seed, averages, best_code, best_name in seeded], flavour='ME')
+    averaged_points = get_or_create_averaged_points([
+        AveragedTertiaryControlPoint(
+            control_id=best_code,
+            target_type=best_name,
+            horizontal_quality=4,
+            vertical_quality=4,
+            a_seed=a_seed,
+            b_seed=b_seed,
+            coordinates=averaged_coords[coordinate_key(*averages)],
+        ) for a, b, a_seed, b_seed, averages, best_code, best_name in seeded
+    ])
+
+    for done, ((a, b, a_seed, b_seed, *_), (pc, created)) in enumerate(zip(seeded, averaged_points), 1):
+        progress('persistence', done, len(seeded))
+        if created:
+            print(f'Created {pc}')
+        else:
+            print(f'Already exists {pc}')
+
+        proposed_cp_row = (pc.control_id, *coordinate_columns(pc.coordinates), pc.target_type)
+        # Resection / OTP setup for control point shot.
+        a_seed_row = [a_seed.control_id, *coordinate_columns(a_seed.coordinates), a_seed.target_type,'','','','', a_seed.source]
+        b_seed_row = [b_seed.control_id, *coordinate_columns(b_seed.coordinates), b_seed.target_type,'','','','',  b_seed.source]
+
+        a_setup_row, a_resection_coords = seed_setup_rows(a_seed)
+        b_setup_row, b_resection_coords = seed_setup_rows(b_seed)
+
+        a_b_deltas_row = ['','', format_fixed(math.hypot(fixed_delta(a.easting, b.easting), fixed_delta(a.northing, b.northing))), format_fixed(fixed_delta(a.elevation, b.elevation))]
+
+        on_point(PROPOSED, {
+            'control_id': pc.control_id, 'target_type': pc.target_type,
+            # Floats, as the channel layer can't send the Decimals of a point that already existed
+            'easting': float(pc.coordinates.easting), 'northing': float(pc.coordinates.northing), 'elevation': float(pc.coordinates.elevation),
+            'sources': [a.file_source, b.file_source],
+        })
+        yield REPORT, ['Proposed Name', 'Easting', 'Northing', 'Elevation', 'Target Type']
+        yield PROPOSED, proposed_cp_row
+        yield REPORT, proposed_cp_row
+        yield REPORT, [" "]
+
+        yield REPORT, ['', 'A-B Deltas:', 'Hz Euclidian', 'Vz Delta']
+        yield REPORT, a_b_deltas_row
+        yield REPORT, [" "]
+
+        yield REPORT, ['Seed A Name', 'Easting', 'Northing', 'Elevation','Target Type', '','','','', 'Source']
+        yield REPORT, a_seed_row
+        yield REPORT, ['']
+        yield REPORT, ['', 'Resection', 'Pos Error', 'Scale Factor', 'Level Delta',]
+
+        yield REPORT, [''] + a_setup_row
+        yield REPORT, ['']
+        yield REPORT, [''] +['Resection Points']
+                        # (rp.helm_id, rp.target_type, rp.use_pos, rp.use_ht, rp.pos_error, rp.tps_reflector_type, rp.tps_measure_style, rp.tps_settings, rp.model_name)
+        yield REPORT, ['']+ ['Name','Type & Quality','Pos Held','Ht Held',  'Pos Error', 'Reflector Type','Measure Style','TPS setting','Source']
+        for row in a_resection_coords:
+            yield REPORT, [''] + list(row)
+
+
+        yield REPORT, [" "]
+        yield REPORT, ['Seed B Name', 'Easting', 'Northing', 'Elevation','Target Type','','','','', 'Source']
+        yield REPORT, b_seed_row
+        yield REPORT, ['']
+        yield REPORT, ['', 'Resection', 'Pos Error', 'Scale Factor', 'Level Delta']
+        yield REPORT, [''] + b_setup_row
+        yield REPORT, ['']
+        yield REPORT, [''] + ['Resection Points']
+        yield REPORT, [''] + ['Name', 'Type & Quality', 'Pos Held', 'Ht Held', 'Pos Error', 'Reflector Type', 'Measure Style', 'TPS setting', 'Source']
+        for row in b_resection_coords:
+            yield REPORT, [''] + list(row)
+
+        yield REPORT, [" "]
+        yield REPORT, [" "]
+
+
+class _ZipStream:
+    """
+    A write-only file for ZipFile that hands the bytes on as they are written instead of keeping them.
+    It can't seek, so ZipFile writes a data descriptor after each entry rather than going back to its header.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_report_zip(adjustment, report_name):
+    """
+    Writes the (section, row) pairs of iter_adjustment into a zip of one CSV per section, yielding the zip's bytes
+    as they are written. Only the held sections and a write buffer are kept in memory.
+
+    The rows of each streamed section must come together, its CSV is closed when the next section starts.
+    The held sections are written last. A section with no rows gets no CSV.
+    """
+    file_names = {
+        REPORT: f'{report_name}_averaging_report.csv',
+        ONE_SHOT: f'{report_name}_additional_obs_required.csv',
+        PROPOSED: f'{report_name}_proposed_new_control.csv',
+    }
+    stream = _ZipStream()
+    held = {section: [] for section in HELD_SECTIONS}
+
+    def open_csv(zip_file, section):
+        return TextIOWrapper(zip_file.open(file_names[section], 'w', force_zip64=True), encoding='utf-8', newline='')
+
+    with zipfile.ZipFile(stream, 'w') as zip_file:
+        current_section = text = writer = None
+
+        for section, row in adjustment:
+            if section in held:
+                held[section].append(row)
+                continue
+
+            if section != current_section:
+                if text is not None:
+                    text.close()
+                current_section = section
+                text = open_csv(zip_file, section)
+                writer = csv.writer(text)
+
+            writer.writerow(row)
+            data = stream.pop()
+            if data:
+                yield data
+
+        if text is not None:
+            text.close()
+
+        for section, rows in held.items():
+            if rows:
+                with open_csv(zip_file, section) as text:
+                    csv.writer(text).writerows(rows)
+
+    yield stream.pop()
+
+
+@transaction.atomic
+def write_control_file(obj, parsed: ParsedControlFile) -> list[UnAdjustedTertiaryControlPoint]:
+    """
+    Writes a parsed 12d file to the database in one transaction.
+
+    Points are attached to the first station setup after their data_3d block that can be created.
+    If none can, they carry over to the setup of the next block.
+    """
+    print(f'Writing {obj}...')
+    points_with_setups = []
+    pending_points = []
+    setup_writer = SetupWriter(obj, [value for kind, value in parsed.events if kind == 'setup'], lookup_cache={})
+    capture_setups = True
+
+    for kind, value in parsed.events:
+
+        if kind == 'coordinates':
+            # A new set of points needs its own station setup
+            capture_setups = True
+
+        elif kind == 'points':
+            pending_points.extend(value.as_rows())
+
+        elif kind == 'setup' and capture_setups:
+            setup_obj = setup_writer.add(value)
+
+            if setup_obj is None:
+                # Try the next setup instead
+                continue
+
+            print(f'{len(pending_points)} control points for this setup')
+            points_with_setups.extend((item, setup_obj) for item in pending_points)
+            pending_points = []
+            capture_setups = False
+
+    setup_writer.save()
+    query_set_collector = create_control_points(obj, points_with_setups)
+
+    if parsed.encoding != obj.encoding:
+        # Record the sniffed encoding against the file hash so it is never sniffed again
+        TertiaryControlFile.objects.filter(pk=obj.pk).update(encoding=parsed.encoding)
+        obj.encoding = parsed.encoding
+
     return query_set_collector
-    #return final_collector
\ No newline at end of file
+
+
+def parse_arguments(obj) -> tuple:
+    """
+    The arguments of parse_control_file_cached for a TertiaryControlFile. They are plain values so they can go to a worker process.
+    """
+    return (
+        obj.file.path,
+        obj.encoding,
+        obj.file_hash,
+        getattr(settings, 'PARSE_CACHE_DIR', None),
+        getattr(settings, 'PARSE_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+    )
+
+
+def create_control_point_objects(obj) -> list[UnAdjustedTertiaryControlPoint]:
+    print(f'Processing {obj}...')
+    return write_control_file(obj, parse_control_file_cached(*parse_arguments(obj)))
+
+
+def ingest_control_files(objs: list, max_workers: int | None = None, progress=no_progress) -> list[UnAdjustedTertiaryControlPoint]:
+    """
+    Parses the uploaded files in a process pool and writes them from this process as each one finishes.
+
+    Decoding and parsing run side by side, so a batch takes about as long as its slowest file.
+    All database writes stay in the calling process, one file at a time.
+
+    :param objs: The saved TertiaryControlFile objects.
+    :param max_workers: The size of the pool, defaults to one worker per file up to the number of CPUs.
+    :param progress: Called as progress('ingest', files written, files) as each file is written.
+    :return: The control points of every file, in the order the files were given.
+    """
+    progress('ingest', 0, len(objs))
+    if len(objs) <= 1:
+        points = [point for obj in objs for point in create_control_point_objects(obj)]
+        progress('ingest', len(objs), len(objs))
+        return points
+
+    max_workers = max_workers or min(len(objs), os.cpu_count() or 1)
+    written = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(parse_control_file_cached, *parse_arguments(obj)): i for i, obj in enumerate(objs)}
+
+        for future in as_completed(futures):
+            i = futures[future]
+            written[i] = write_control_file(objs[i], future.result())
+            progress('ingest', len(written), len(objs))
+
+    return [point for i in range(len(objs)) for point in written[i]]
@@ -0,0 +1,217 @@
+import os
+import csv
+import json
+import shutil
+import hashlib
+import tempfile
+from typing import Iterable, Sequence
+import numpy as np
+
+from .parse_cache import evict_least_recently_used
+
+# Bump whenever the adjustment or the report layout changes, reports made by an older version are then ignored
+# 2: Keyed on the uploaded files alone, with the area and points of the report stored alongside it.
+# 3: Coordinates and deltas written with a fixed 8 decimal places.
+REPORT_CACHE_VERSION = 3
+
+METADATA_FILE = 'metadata.json'
+POINTS_FILE = 'points.json'
+
+
+def report_key(file_hashes: Iterable[str], hz_tolerance, vt_tolerance) -> str:
+    """
+    The cache key of a report: the uploaded files, the tolerances and the report version.
+    The earlier shots a report takes in aren't part of the key, a cached report is invalidated instead when they
+    change or when new shots are added near it, see invalidate_reports and invalidate_reports_near.
+    """
+    key = json.dumps([REPORT_CACHE_VERSION, sorted(set(file_hashes)), float(hz_tolerance), float(vt_tolerance)])
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def report_bounds(coordinates: Iterable, radius: float) -> list | None:
+    """
+    The area a new shot has to fall in to change a report, see invalidate_reports_near.
+
+    :param coordinates: The (easting, northing) of every shot in the report.
+    :param radius: The radius the history is searched within for the report.
+    :return: [min easting, min northing, max easting, max northing], None for a report with no shots.
+    """
+    point_array = np.asarray(list(coordinates), dtype=np.float64).reshape(-1, 2)
+    if not len(point_array):
+        return None
+
+    return [*(point_array.min(axis=0) - radius).tolist(), *(point_array.max(axis=0) + radius).tolist()]
+
+
+def _section_file(entry: str, section: str) -> str:
+    return os.path.join(entry, f'{section}.csv')
+
+
+def load_report(cache_dir: str | None, key: str) -> str | None:
+    """
+    :return: The directory of the cached report, or None if there isn't one.
+    """
+    if not cache_dir:
+        return None
+
+    entry = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(entry, METADATA_FILE)):
+        return None
+
+    # Mark the entry as recently used
+    os.utime(entry)
+    return entry
+
+
+def load_cached_points(entry: str) -> list:
+    """
+    The (section, point) pairs iter_adjustment passed to on_point when a cached report was made, in the same order.
+    """
+    try:
+        with open(os.path.join(entry, POINTS_FILE), 'r', encoding='utf-8') as f:
+            return [(section, point) for section, point in json.load(f)]
+    except (OSError, ValueError) as e:
+        print(f'Could not read the points of cached report {entry}: {e}')
+        return []
+
+
+def iter_cached_rows(entry: str, sections: Sequence[str]):
+    """
+    Yields the (section, row) pairs of a cached report, one section after the other in the order given.
+    """
+    for section in sections:
+        try:
+            f = open(_section_file(entry, section), 'r', encoding='utf-8', newline='')
+        except FileNotFoundError:
+            # The section had no rows
+            continue
+
+        with f:
+            for row in csv.reader(f):
+                yield section, row
+
+
+def _store_entry(temp_dir: str, cache_dir: str, key: str, file_hashes: Iterable[str], points: list, bounds: list | None) -> None:
+    with open(os.path.join(temp_dir, POINTS_FILE), 'w', encoding='utf-8') as f:
+        json.dump(points, f)
+    with open(os.path.join(temp_dir, METADATA_FILE), 'w', encoding='utf-8') as f:
+        json.dump({'version': REPORT_CACHE_VERSION, 'file_hashes': sorted(set(file_hashes)), 'bounds': bounds}, f)
+
+    entry = os.path.join(cache_dir, key)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(temp_dir, entry)
+
+
+def cache_rows(rows, cache_dir: str | None, key: str, file_hashes: Iterable[str], max_bytes: int,
+               points: list | None = None, bounds: list | None = None):
+    """
+    Passes the (section, row) pairs of a report through, writing each section to its own CSV as it goes.
+    The report is stored once the last row has gone. A report that isn't read to the end, because the client went
+    away or the adjustment failed, isn't stored. Failing to write the copy never interrupts the report.
+
+    :param file_hashes: Every file the report's shots came from, the uploaded ones and the earlier ones.
+    :param points: The (section, point) pairs passed to on_point while the rows were made, stored with the report.
+    :param bounds: The report_bounds of the report's shots.
+    """
+    if not cache_dir:
+        yield from rows
+        return
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='.', dir=cache_dir)
+    except OSError as e:
+        print(f'Could not cache report {key}: {e}')
+        yield from rows
+        return
+
+    files = {}
+    writers = {}
+    failed = False
+    complete = False
+
+    try:
+        for section, row in rows:
+            if not failed:
+                try:
+                    if section not in writers:
+                        files[section] = open(_section_file(temp_dir, section), 'w', encoding='utf-8', newline='')
+                        writers[section] = csv.writer(files[section])
+                    writers[section].writerow(row)
+                except OSError as e:
+                    print(f'Could not cache report {key}: {e}')
+                    failed = True
+            yield section, row
+
+        if not failed:
+            try:
+                for f in files.values():
+                    f.close()
+                _store_entry(temp_dir, cache_dir, key, file_hashes, points or [], bounds)
+                complete = True
+            except OSError as e:
+                print(f'Could not cache report {key}: {e}')
+    finally:
+        for f in files.values():
+            f.close()
+        if not complete:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if complete:
+        evict_least_recently_used(cache_dir, max_bytes)
+
+
+def _invalidate(cache_dir: str | None, is_stale) -> None:
+    """
+    Deletes the cached reports whose metadata is_stale. Unreadable entries can't be checked, so they go too.
+    """
+    if not cache_dir:
+        return
+
+    try:
+        entries = [entry for entry in os.scandir(cache_dir) if entry.is_dir() and not entry.name.startswith('.')]
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        try:
+            with open(os.path.join(entry.path, METADATA_FILE), 'r', encoding='utf-8') as f:
+                stale = is_stale(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError):
+            stale = True
+
+        if stale:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def invalidate_reports(cache_dir: str | None, file_hashes: Iterable[str]) -> None:
+    """
+    Deletes the cached reports that used any of the files, after their points have changed.
+    """
+    file_hashes = {file_hash for file_hash in file_hashes if file_hash}
+    if not file_hashes:
+        return
+
+    _invalidate(cache_dir, lambda metadata: bool(set(metadata['file_hashes']) & file_hashes))
+
+
+def invalidate_reports_near(cache_dir: str | None, coordinates: Iterable) -> None:
+    """
+    Deletes the cached reports that new shots fall within the report_bounds of, as a report would have taken them in.
+
+    :param coordinates: The (easting, northing) of the new shots.
+    """
+    point_array = np.asarray(list(coordinates), dtype=np.float64).reshape(-1, 2)
+    if not len(point_array):
+        return
+
+    def is_near(metadata):
+        if metadata['bounds'] is None:
+            return False
+        min_easting, min_northing, max_easting, max_northing = metadata['bounds']
+        return bool((
+            (point_array[:, 0] >= min_easting) & (point_array[:, 0] <= max_easting)
+            & (point_array[:, 1] >= min_northing) & (point_array[:, 1] <= max_northing)
+        ).any())
+
+    _invalidate(cache_dir, is_near)
@@ -0,0 +1,213 @@
+import time
+import logging
+import tempfile
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .process_files import ingest_control_files, iter_adjustment, iter_report_zip, REPORT_SECTIONS
+from .report_cache import report_key, report_bounds, load_report, load_cached_points, iter_cached_rows, cache_rows
+from .spatial_index import history_radius, with_neighbouring_history
+from .job_progress import ProgressPublisher
+from ..models import ReportJob, TertiaryControlFile, UnAdjustedTertiaryControlPoint
+
+# Seconds the worker waits before looking for new jobs when the queue is empty
+POLL_INTERVAL = 2
+# The Hz and Vt tolerances in mm of an admin report, pairs are accepted within 2.9 mm as the admin action always did
+ADMIN_TOLERANCE = 2
+# Seconds a running job can go without a heartbeat (see ReportJob.set_progress) before its worker is taken to have died,
+# unless REPORT_JOB_STALE_SECONDS is set
+STALE_AFTER = 30 * 60
+# How many times a job is started before it is given up on, so a job that kills its worker isn't run forever
+MAX_ATTEMPTS = 2
+
+# What the client is told when a job fails, the traceback is logged and kept on the job for the admin
+FAILED_MESSAGE = 'The report could not be made, the error has been logged.'
+DECODE_FAILED_MESSAGE = 'A file could not be read, it may be truncated or corrupt.'
+WORKER_LOST_MESSAGE = 'The report was stopped before it finished.'
+
+logger = logging.getLogger(__name__)
+
+
+def failure_message(error: Exception) -> str:
+    """
+    The short message a client is shown for the error that failed a job.
+    """
+    if isinstance(error, UnicodeDecodeError):
+        return DECODE_FAILED_MESSAGE
+    return FAILED_MESSAGE
+
+
+def requeue_stale_jobs(stale_after: float | None = None) -> int:
+    """
+    Puts the running jobs whose worker has stopped sending heartbeats back in the queue.
+    A job that has already been started MAX_ATTEMPTS times is failed instead.
+
+    :param stale_after: Seconds without a heartbeat, defaults to REPORT_JOB_STALE_SECONDS.
+    :return: The number of jobs put back in the queue.
+    """
+    if stale_after is None:
+        stale_after = getattr(settings, 'REPORT_JOB_STALE_SECONDS', STALE_AFTER)
+
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=stale_after)
+    stale = ReportJob.objects.filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff),
+        status=ReportJob.RUNNING,
+    )
+
+    failed = stale.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=ReportJob.FAILED, error=WORKER_LOST_MESSAGE, finished_at=now
+    )
+    requeued = stale.filter(attempts__lt=MAX_ATTEMPTS).update(status=ReportJob.QUEUED, stage='', percent=0)
+
+    if failed or requeued:
+        logger.warning('%s report jobs had lost their worker, %s were queued again and %s failed', failed + requeued, requeued, failed)
+
+    return requeued
+
+
+def claim_next_job() -> ReportJob | None:
+    """
+    Takes the oldest queued job and marks it as running, after putting the jobs of workers that died back in the queue.
+    The status is checked and set in a single update, so two workers never take the same job.
+    """
+    requeue_stale_jobs()
+
+    for pk in ReportJob.objects.filter(status=ReportJob.QUEUED).values_list('pk', flat=True)[:10]:
+        now = timezone.now()
+        claimed = ReportJob.objects.filter(pk=pk, status=ReportJob.QUEUED).update(
+            status=ReportJob.RUNNING, stage='starting', percent=0, started_at=now, heartbeat_at=now, attempts=F('attempts') + 1
+        )
+        if claimed:
+            return ReportJob.objects.get(pk=pk)
+
+    return None
+
+
+def upload_report_rows(job: ReportJob, progress: ProgressPublisher):
+    """
+    The (section, row) pairs of the report of an UPLOAD job, as file_upload_view used to work out in the request.
+    """
+    files = TertiaryControlFile.objects.in_bulk(job.file_ids or [])
+    files = [files[pk] for pk in job.file_ids or []]
+
+    # The same files at the same tolerances give the same report until it is invalidated, so a cached one is used
+    # as it is, without ingesting the files again
+    key = report_key([obj.file_hash for obj in files], job.hz_tolerance, job.vt_tolerance)
+    cached = load_report(settings.REPORT_CACHE_DIR, key)
+    if cached is not None:
+        print(f'Using the cached report {key}')
+        for section, point in load_cached_points(cached):
+            progress.point(section, point)
+        return iter_cached_rows(cached, REPORT_SECTIONS)
+
+    collector = ingest_control_files(files, progress=progress)
+
+    # Earlier shots of the same points are found through the spatial index rather than by reclustering the whole history
+    progress('history', 0, 1)
+    uploaded = len(collector)
+    collector = with_neighbouring_history(collector, job.hz_tolerance, job.vt_tolerance)
+    print(f'{len(collector) - uploaded} earlier shots are near the uploaded shots')
+    progress('history', 1, 1)
+
+    # The points are kept with the report, to be sent again when it is used from the cache
+    points = []
+
+    def on_point(section, point):
+        points.append((section, point))
+        progress.point(section, point)
+
+    return cache_rows(
+        iter_adjustment(collector, job.hz_tolerance, job.vt_tolerance, progress=progress, on_point=on_point),
+        settings.REPORT_CACHE_DIR, key, {cp.source.file_hash for cp in collector}, settings.REPORT_CACHE_MAX_BYTES,
+        points=points,
+        bounds=report_bounds(
+            [(cp.coordinates.easting, cp.coordinates.northing) for cp in collector],
+            history_radius(job.hz_tolerance, job.vt_tolerance)
+        ),
+    )
+
+
+def admin_report_rows(job: ReportJob, progress: ProgressPublisher):
+    """
+    The (section, row) pairs of the report of an ADMIN job, the adjustment of the points selected in the admin.
+    """
+    queryset = UnAdjustedTertiaryControlPoint.objects.filter(pk__in=job.point_ids or []).order_by('pk')
+    hz_tolerance = ADMIN_TOLERANCE if job.hz_tolerance is None else job.hz_tolerance
+    vt_tolerance = ADMIN_TOLERANCE if job.vt_tolerance is None else job.vt_tolerance
+
+    return iter_adjustment(queryset, hz_tolerance, vt_tolerance, progress=progress, on_point=progress.point)
+
+
+def write_upload_report(job: ReportJob, out, progress: ProgressPublisher) -> None:
+    for chunk in iter_report_zip(upload_report_rows(job, progress), job.report_name):
+        out.write(chunk)
+
+
+def write_admin_report(job: ReportJob, out, progress: ProgressPublisher) -> None:
+    for chunk in iter_report_zip(admin_report_rows(job, progress), job.report_name):
+        out.write(chunk)
+
+
+REPORT_WRITERS = {
+    ReportJob.UPLOAD: write_upload_report,
+    ReportJob.ADMIN: write_admin_report,
+}
+
+
+def run_report_job(job: ReportJob) -> None:
+    """
+    Works out the report of a running job and stores its zip in job.result.
+    The zip is written to a temporary file as it is produced, so only the write buffer is ever held in memory.
+    Any error fails the job rather than stopping the worker. The client only gets a short message,
+    the traceback is logged and kept in job.traceback.
+    Progress is sent to the job's group on the channel layer as the stages run, see ProgressPublisher.
+    """
+    print(f'Running report job {job.pk}: {job}')
+    progress = ProgressPublisher(job)
+    try:
+        with tempfile.TemporaryFile() as out:
+            REPORT_WRITERS[job.kind](job, out, progress)
+
+            progress('saving', 0, 1)
+            out.seek(0)
+            job.result.save(f'{job.report_name}.zip', File(out), save=False)
+
+        job.status = ReportJob.DONE
+        job.stage = 'done'
+        job.percent = 100
+    except Exception as e:
+        logger.exception('Report job %s failed', job.pk)
+        job.status = ReportJob.FAILED
+        job.error = failure_message(e)
+        job.traceback = traceback.format_exc()
+
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'stage', 'percent', 'result', 'error', 'traceback', 'finished_at'])
+    progress.finish(job.status, job.error)
+    print(f'Report job {job.pk} {job.status}')
+
+
+def run_worker(once: bool = False, poll_interval: float = POLL_INTERVAL) -> int:
+    """
+    Runs queued jobs one after the other, waiting poll_interval seconds whenever the queue is empty.
+
+    :param once: Stop as soon as the queue is empty instead of waiting for more jobs.
+    :return: The number of jobs that were run.
+    """
+    ran = 0
+    while True:
+        job = claim_next_job()
+        if job is None:
+            if once:
+                return ran
+            time.sleep(poll_interval)
+            continue
+
+        run_report_job(job)
+        ran += 1
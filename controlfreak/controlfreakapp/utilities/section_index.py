@@ -0,0 +1,108 @@
+from bisect import bisect_left
+from typing import Dict, List, Iterable, Tuple
+
+from .text_from_12d import remove_parenthesis
+
+INST_STAT_SETUP = 'Inst Stat Setup'
+GROUP = 'group {'
+CHECK_SHOT = 'Check Shot'
+DATA_3D = 'data_3d'
+SUPER = 'super'
+
+SECTION_MARKERS = (INST_STAT_SETUP, GROUP, CHECK_SHOT, DATA_3D, SUPER)
+
+
+class SectionIndex:
+    """
+    The line offsets of the sections of a 12da file, so a parser can jump straight to the section it needs
+    instead of walking forward until it finds it.
+
+    The index is filled in while the file is read (see TwelveDaParser), or built from a list of lines with from_lines.
+    window() gives the part of the index that falls inside a slice of the lines, with offsets relative to the slice.
+
+    Records:
+        Inst Stat Setup: The name line of every station setup group.
+        group {: Every group opener.
+        Check Shot: Every line naming a check shot.
+        data_3d: Every data_3d block opener.
+        super: Every super string opener.
+    """
+
+    def __init__(self, offsets: Dict[str, List[int]] | None = None):
+        self.offsets = offsets or {marker: [] for marker in SECTION_MARKERS}
+
+    @classmethod
+    def from_lines(cls, lines: List[str]) -> 'SectionIndex':
+        """
+        Builds the index of a list of lines in one pass.
+        """
+        index = cls()
+        for offset, line in enumerate(lines):
+            if line.endswith('{'):
+                stripped = line.lstrip()
+                if stripped.startswith(GROUP):
+                    index.add(GROUP, offset)
+                elif stripped.startswith(DATA_3D):
+                    index.add(DATA_3D, offset)
+                elif SUPER + ' ' in stripped:
+                    # Super strings open as 'string super {'
+                    index.add(SUPER, offset)
+            elif INST_STAT_SETUP in line:
+                index.add(INST_STAT_SETUP, offset)
+            elif CHECK_SHOT in line:
+                index.add(CHECK_SHOT, offset)
+        return index
+
+    def add(self, marker: str, offset: int) -> None:
+        """
+        Records a section. Offsets must be added in increasing order.
+        """
+        self.offsets[marker].append(offset)
+
+    def find(self, marker: str, start: int = 0, stop: int | None = None) -> int | None:
+        """
+        :return: The offset of the first marker at or after start and before stop, or None if there isn't one.
+        """
+        offsets = self.offsets[marker]
+        i = bisect_left(offsets, start)
+        if i < len(offsets) and (stop is None or offsets[i] < stop):
+            return offsets[i]
+        return None
+
+    def window(self, start: int, stop: int) -> 'SectionIndex':
+        """
+        :return: The sections between start and stop, with offsets relative to start.
+        """
+        return SectionIndex({
+            marker: [offset - start for offset in offsets[bisect_left(offsets, start):bisect_left(offsets, stop)]]
+            for marker, offsets in self.offsets.items()
+        })
+
+
+def parse_attribute(line: str) -> Tuple[str, str] | None:
+    """
+    Splits an attribute line such as `real    "is_x"   51701.2472907` into its name and value.
+
+    :return: (name, value) with the quotes removed, or None if the line isn't an attribute.
+    """
+    parts = line.split(None, 1)
+    if len(parts) < 2:
+        return None
+
+    name = remove_parenthesis(parts[1].split(None, 1)[0]).strip()
+    if not name:
+        return None
+
+    return name, remove_parenthesis(line.split(name, 1)[1]).strip()
+
+
+def parse_attributes(lines: Iterable[str]) -> Dict[str, str]:
+    """
+    :return: The attributes of the lines as a dict of name -> value. A repeated name keeps its last value.
+    """
+    attributes = {}
+    for line in lines:
+        attribute = parse_attribute(line)
+        if attribute is not None:
+            attributes[attribute[0]] = attribute[1]
+    return attributes
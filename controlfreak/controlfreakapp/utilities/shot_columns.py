@@ -0,0 +1,133 @@
+import dataclasses
+from typing import List
+
+import numpy as np
+from django.db.models import QuerySet
+
+from .CONSTANTS import ControlPoint
+from ..models import TertiaryControlFile
+
+# Rows fetched per round trip when streaming a queryset of shots
+LOAD_CHUNK_SIZE = 5000
+
+SHOT_FIELDS = (
+    'control_id',
+    'target_type',
+    'coordinates__easting',
+    'coordinates__northing',
+    'coordinates__elevation',
+    'source__file',
+    'source__revision',
+)
+
+
+@dataclasses.dataclass
+class ShotColumns:
+    """
+    The shots an adjustment works on, one column per field rather than one model instance per shot.
+
+    :args ids: The control id of every shot.
+    :args target_types: The target type of every shot.
+    :args file_sources: The str() of the TertiaryControlFile of every shot.
+    :args point_array: An (n, 3) float64 array of easting, northing and elevation.
+    """
+    ids: List[str]
+    target_types: List[str]
+    file_sources: List[str]
+    point_array: np.ndarray
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row: int) -> ControlPoint:
+        """
+        The shot at row as a ControlPoint, built when it is asked for rather than for every shot.
+        """
+        easting, northing, elevation = self.point_array[row].tolist()
+        return ControlPoint(
+            id=self.ids[row],
+            easting=easting,
+            northing=northing,
+            elevation=elevation,
+            target_type=self.target_types[row],
+            horizontal_quality=4,
+            vertical_quality=4,
+            file_source=self.file_sources[row],
+            adjusted=False,
+        )
+
+    def take(self, rows: List[int]) -> 'ShotColumns':
+        """
+        The shots at rows, in that order.
+        """
+        return ShotColumns(
+            ids=[self.ids[row] for row in rows],
+            target_types=[self.target_types[row] for row in rows],
+            file_sources=[self.file_sources[row] for row in rows],
+            point_array=self.point_array[rows].reshape(-1, 3),
+        )
+
+    def control_points(self) -> list[dict[str, ControlPoint]]:
+        """
+        The shots as the {id: ControlPoint} dicts group_control_points takes.
+        """
+        return [{self.ids[row]: self[row]} for row in range(len(self))]
+
+
+def _columns_from_instances(control_points) -> ShotColumns:
+    rows = [
+        (cp.control_id, cp.target_type, str(cp.source),
+         (cp.coordinates.easting, cp.coordinates.northing, cp.coordinates.elevation))
+        for cp in control_points
+    ]
+    return ShotColumns(
+        ids=[row[0] for row in rows],
+        target_types=[row[1] for row in rows],
+        file_sources=[row[2] for row in rows],
+        point_array=np.array([row[3] for row in rows], dtype=np.float64).reshape(-1, 3),
+    )
+
+
+def load_shot_columns(control_points, chunk_size: int = LOAD_CHUNK_SIZE) -> ShotColumns:
+    """
+    Loads the shots of an adjustment into columns.
+
+    A queryset is read with a single values_list join streamed in chunks of chunk_size, so no model instances are
+    built and memory only grows by the columns themselves. Shots without coordinates are skipped.
+    A list of UnAdjustedTertiaryControlPoints that have already been loaded is read from the instances.
+
+    :param control_points: A queryset or list of UnAdjustedTertiaryControlPoints.
+    :param chunk_size: The rows fetched per round trip.
+    """
+    if not isinstance(control_points, QuerySet):
+        return _columns_from_instances(control_points)
+
+    ids = []
+    target_types = []
+    file_sources = []
+    blocks = []
+    block = []
+    # One str per file rather than per shot
+    source_names = {}
+
+    rows = control_points.filter(coordinates__isnull=False).values_list(*SHOT_FIELDS).iterator(chunk_size=chunk_size)
+    for control_id, target_type, easting, northing, elevation, file_name, revision in rows:
+        ids.append(control_id)
+        target_types.append(target_type)
+
+        source_name = source_names.get((file_name, revision))
+        if source_name is None:
+            source_name = source_names[(file_name, revision)] = TertiaryControlFile.display_name(file_name, revision)
+        file_sources.append(source_name)
+
+        block.append((easting, northing, elevation))
+        if len(block) == chunk_size:
+            blocks.append(np.array(block, dtype=np.float64))
+            block = []
+
+    if block:
+        blocks.append(np.array(block, dtype=np.float64))
+
+    point_array = np.concatenate(blocks) if blocks else np.empty((0, 3), dtype=np.float64)
+
+    return ShotColumns(ids, target_types, file_sources, point_array)
@@ -0,0 +1,89 @@
+from functools import lru_cache
+from typing import List, Sequence, Tuple
+
+from fuzzywuzzy import fuzz, utils
+
+# Control ids and target types repeat across every file and report, so a few thousand distinct pairs cover most of them
+SCORE_CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=SCORE_CACHE_SIZE)
+def normalize(string: str) -> str:
+    """
+    The form fuzz.token_sort_ratio compares a string in: letters and numbers only, lower case, tokens sorted.
+    """
+    return ' '.join(sorted(utils.full_process(string, force_ascii=True).split()))
+
+
+@lru_cache(maxsize=SCORE_CACHE_SIZE)
+def normalized_score(a: str, b: str) -> int:
+    """
+    fuzz.token_sort_ratio of two already normalized strings.
+    """
+    return fuzz.ratio(a, b)
+
+
+def token_sort_score(a: str, b: str) -> int:
+    """
+    fuzz.token_sort_ratio(a, b), with the normalized strings and the score of every pair cached.
+    """
+    return normalized_score(normalize(a), normalize(b))
+
+
+def avg_similarity(string: str, string_list: Sequence[str]) -> float:
+    scores = [token_sort_score(string, s) for s in string_list]
+    return sum(scores) / len(scores)
+
+
+def most_similar(candidates: Sequence[str], string_list: Sequence[str]) -> str:
+    """
+    The candidate with the highest average similarity to string_list, the first one on a tie.
+    Candidates that appear more than once are only scored once.
+
+    :raises ValueError: If there are no candidates.
+    """
+    averages = {}
+    for candidate in candidates:
+        if candidate not in averages:
+            averages[candidate] = avg_similarity(candidate, string_list)
+
+    return max(candidates, key=averages.__getitem__)
+
+
+class BestMatchResolver:
+    """
+    Resolves the best code and name of many groups of shots, scoring each distinct group only once.
+
+    get_best_code and get_best_name look for the id and target type most like the others in a group, which is
+    quadratic in the size of the group. A report asks the same question for thousands of clusters that mostly share
+    the same few ids and target types, so the answers are kept per group and the pair scores are cached by normalize
+    and normalized_score.
+
+    :args code_resolver: The function that picks the best code of a list of ids, geometry_manipulation.get_best_code.
+    :args name_resolver: The function that picks the best name of a list of target types, geometry_manipulation.get_best_name.
+    """
+
+    def __init__(self, code_resolver, name_resolver):
+        self.code_resolver = code_resolver
+        self.name_resolver = name_resolver
+        self.codes = {}
+        self.names = {}
+
+    def best_code(self, codes: Sequence[str]) -> str:
+        key = tuple(codes)
+        if key not in self.codes:
+            self.codes[key] = self.code_resolver(list(codes))
+        return self.codes[key]
+
+    def best_name(self, names: Sequence[str]) -> str:
+        key = tuple(names)
+        if key not in self.names:
+            self.names[key] = self.name_resolver(list(names))
+        return self.names[key]
+
+    def resolve(self, groups: Sequence[Tuple[Sequence[str], Sequence[str]]]) -> List[Tuple[str, str]]:
+        """
+        :param groups: The (ids, target types) of every group.
+        :return: The (best code, best name) of every group, in the same order.
+        """
+        return [(self.best_code(codes), self.best_name(names)) for codes, names in groups]
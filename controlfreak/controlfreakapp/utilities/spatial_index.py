@@ -0,0 +1,148 @@
+import math
+import numpy as np
+from django.db.models import Q
+from scipy.spatial import cKDTree
+
+from .tolerance_hierarchy import CLUSTER_TOLERANCE_FACTOR
+from ..models import Coordinates, UnAdjustedTertiaryControlPoint, SPATIAL_GRID_SIZE
+
+# Keeps the number of cells in a single query well under SQLite's parameter limit
+CELL_BATCH_SIZE = 200
+
+
+def neighbouring_cells(point_array, radius) -> set:
+    """
+    The grid cells that any point within radius of the points could fall in.
+
+    :param point_array: An (n, 3) array of easting, northing and elevation.
+    :param radius: The search radius in metres.
+    :return: A set of (grid_x, grid_y) cells.
+    """
+    rings = max(1, math.ceil(radius / SPATIAL_GRID_SIZE))
+    cells = {Coordinates.grid_cell(easting, northing) for easting, northing in point_array[:, :2].tolist()}
+
+    return {
+        (x + dx, y + dy)
+        for x, y in cells
+        for dx in range(-rings, rings + 1)
+        for dy in range(-rings, rings + 1)
+    }
+
+
+def _cell_filters(cells: set, prefix: str = ''):
+    """
+    Yields a Q per batch of cells, with the cells of each grid_x column folded into one grid_y__in.
+    """
+    columns = {}
+    for x, y in cells:
+        columns.setdefault(x, []).append(y)
+
+    batch = Q()
+    size = 0
+    for x, ys in columns.items():
+        batch |= Q(**{f'{prefix}grid_x': x, f'{prefix}grid_y__in': ys})
+        size += len(ys)
+        if size >= CELL_BATCH_SIZE:
+            yield batch
+            batch = Q()
+            size = 0
+
+    if size:
+        yield batch
+
+
+def coordinates_near(point_array, radius, prefix: str, queryset) -> list:
+    """
+    Finds the rows of queryset whose coordinates are within radius (in 3D) of any of the points.
+
+    Only the grid cells around the points are read, then the candidates are checked against a KD-tree of the points,
+    so the cost follows the number of points rather than the number of rows in the table.
+
+    :param point_array: An (n, 3) array of easting, northing and elevation.
+    :param radius: The search radius in metres.
+    :param prefix: The lookup from the queryset's model to Coordinates, e.g. 'coordinates__'.
+    :param queryset: The rows to search.
+    :return: The pks of the matching rows.
+    """
+    if len(point_array) == 0:
+        return []
+
+    tree = cKDTree(point_array)
+    found = []
+
+    for cell_filter in _cell_filters(neighbouring_cells(point_array, radius), prefix):
+        candidates = list(queryset.filter(cell_filter).values_list(
+            'pk', f'{prefix}easting', f'{prefix}northing', f'{prefix}elevation'
+        ))
+        if not candidates:
+            continue
+
+        candidate_array = np.array([row[1:] for row in candidates], dtype=np.float64)
+        distances, _ = tree.query(candidate_array, distance_upper_bound=radius)
+        found.extend(row[0] for row, distance in zip(candidates, distances.tolist()) if distance <= radius)
+
+    return found
+
+
+def history_radius(hz_tolerance, vt_tolerance) -> float:
+    """
+    The radius in metres the history is searched within for a report at tolerances in mm, which takes in the whole
+    Hz x Vt cylinder the shots are clustered with.
+    """
+    return math.hypot(hz_tolerance, vt_tolerance) * CLUSTER_TOLERANCE_FACTOR / 1000
+
+
+def with_neighbouring_history(control_points, hz_tolerance, vt_tolerance) -> list:
+    """
+    The shots a report of some newly ingested shots at tolerances in mm adjusts: the shots themselves and the earlier
+    shots near them, see find_neighbouring_history.
+    """
+    return list(control_points) + find_neighbouring_history(control_points, history_radius(hz_tolerance, vt_tolerance))
+
+
+def find_neighbouring_history(control_points, radius):
+    """
+    Finds the shots already in the database that could be repeats of newly ingested shots.
+
+    Shots are clustered by chaining neighbours together, so the search is repeated around each round of earlier shots
+    it finds until a round finds nothing new. Every shot that could end up in the same cluster as a new shot is found,
+    and the search still only reads the cells around those shots.
+    Existing AveragedTertiaryControlPoints aren't searched for, a pair that was averaged before is matched to its
+    averaged point by its seeds when the report is persisted.
+
+    :param control_points: The newly ingested UnAdjustedTertiaryControlPoints.
+    :param radius: The search radius in metres, the same eps the report clusters with.
+    :return: The earlier shots within radius of a new shot, or of another earlier shot found, that haven't been
+        averaged yet.
+    """
+    new_sources = {cp.source_id for cp in control_points}
+    history = UnAdjustedTertiaryControlPoint.objects.exclude(source__in=new_sources).filter(
+        a_seed__isnull=True,
+        b_seed__isnull=True
+    )
+
+    point_array = np.array(
+        [[cp.coordinates.easting, cp.coordinates.northing, cp.coordinates.elevation] for cp in control_points],
+        dtype=np.float64
+    ).reshape(-1, 3)
+
+    shots = []
+    found_pks = set()
+    while len(point_array):
+        shot_pks = [pk for pk in coordinates_near(point_array, radius, 'coordinates__', history) if pk not in found_pks]
+        found_pks.update(shot_pks)
+
+        found = []
+        for i in range(0, len(shot_pks), CELL_BATCH_SIZE):
+            found.extend(UnAdjustedTertiaryControlPoint.objects.filter(
+                pk__in=shot_pks[i:i + CELL_BATCH_SIZE]).select_related('coordinates', 'source'))
+        shots.extend(found)
+
+        # The next round searches around the shots this one found
+        point_array = np.array(
+            [[cp.coordinates.easting, cp.coordinates.northing, cp.coordinates.elevation] for cp in found],
+            dtype=np.float64
+        ).reshape(-1, 3)
+
+    shots.sort(key=lambda cp: cp.pk)
+    return shots
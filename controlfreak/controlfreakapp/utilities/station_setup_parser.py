@@ -1,9 +1,12 @@
+import dataclasses
 from typing import List, Dict, Any, Tuple
 from .CONSTANTS import Helmert, OverPoint, ResectionPoint, ControlPoint, RESECTION_KEYS, OVER_POINT_KEYS, HELMERT_PT_KEYS
-from .text_from_12d import remove_parenthesis
-from .create_django_models import create_helmert_setup, create_over_point_setup
+from .section_index import SectionIndex, GROUP, CHECK_SHOT, parse_attributes
 import re
 
+# A numbered Helmert Details attribute, e.g. helm_x_12
+HELMERT_ATTRIBUTE = re.compile(r'^(helm_\w+?)_(\d+)$')
+
 
 def split_number_at_end(string):
     match = re.search(r'(-?\d+(\.\d+)?)$', string)
@@ -14,45 +17,64 @@ def split_number_at_end(string):
     else:
         return string, None
 
+
+@dataclasses.dataclass
+class StationSetupData:
+    """
+    The values read from one station setup, before anything is written to the database.
+    create_django_models.SetupWriter turns it into a HelmertResection or OverPointStationSetup.
+    """
+    is_helmert_resection: bool
+    setup: Dict[str, str]
+    resection_points: List[Dict[str, Any]]
+
+
 class StationSetupParser:
+    """
+    Reads a station setup out of 12da lines. It has no database access, so it can run in a worker process.
+
+    The sections of the lines are found through a SectionIndex and the attributes are read once into a dict,
+    so each key is a dict lookup rather than a scan of every line.
+
+    :args data (List[str]): The lines of the setup, or of the whole file.
+    :args index (int): The offset of the "Inst Stat Setup" name line in data.
+    :args section_index (SectionIndex): The index of data, built from data if not given.
+    """
 
-    def __init__(self, data: List[str], index: int, obj):
-        self.setup_object = None
+    def __init__(self, data: List[str], index: int, section_index: SectionIndex | None = None):
+        self.setup_data = None
         self.data = data
+        self.section_index = section_index if section_index is not None else SectionIndex.from_lines(data)
         self.sliced_data = None
         self.index = index
         self.line_tracking = 0
         self.is_helmert_resection = False
         self.is_resection()
-        self.obj = obj
         self.extract_setup_data()
 
-    def return_setup_object(self) -> dict[str, Helmert] | dict[str, OverPoint]:
+    def return_setup_data(self) -> StationSetupData:
         """
-        Returns the setup object.
+        Returns the setup data.
         :return:
         """
-        return self.setup_object
+        return self.setup_data
 
     def is_resection(self):
         """
         Checks if the setup is a resection or an over the point setup.
+        The setup attributes end at the first group after the name line, or at the end of data if there isn't one.
         :return:
         """
+        group_offset = self.section_index.find(GROUP, self.index + 2, len(self.data))
+        if group_offset is None:
+            group_offset = len(self.data)
 
-        iterator = 1
+        # A resection has its Helmert Details group straight after the setup attributes,
+        # an over the point setup has 29 lines of attributes first
+        self.is_helmert_resection = group_offset - self.index <= 20
 
-        while True:
-            iterator += 1
-            if 'group {' in self.data[self.index + iterator]:
-                break
-
-        # 29 is the number of lines in an otp setup
-
-        self.is_helmert_resection = iterator <= 20
-
-        self.line_tracking = self.index + iterator
-        self.sliced_data = self.data[self.index + 2:self.index + iterator]
+        self.line_tracking = group_offset
+        self.sliced_data = self.data[self.index + 2:group_offset]
 
     def extract_setup_data(self):
 
@@ -61,70 +83,51 @@ class StationSetupParser:
         else:
             keys = OVER_POINT_KEYS
 
-        setup_dict = {}
-
-        for key in keys:
-            for line in self.sliced_data:
-                if key in line:
-                    key = remove_parenthesis(line.split()[1]).strip()
-                    value = remove_parenthesis(line.split(key)[1]).strip()
-                    setup_dict[key] = value
+        attributes = parse_attributes(self.sliced_data)
+        setup_dict = {key: attributes[key] for key in keys if key in attributes}
 
         if self.is_helmert_resection:
-            iterator = 1
-            pt_dict = {}
-            resection_points = []
-
-            while True:
-                iterator += 1
-                line = self.data[self.line_tracking + iterator]
-                if "Check Shot" in line:
-                #print(setup_dict, resection_points)
-                    self.setup_object = create_helmert_setup(setup_dict, resection_points, self.obj)
-                    break
-                else:
-                    for key in HELMERT_PT_KEYS:
-
-                        if key in line:
-                            if 'helm_tps_reflector_type_as_text_' in line:
-                                reflector_type_key = remove_parenthesis(line.split()[1]).strip()
-                                reflector = remove_parenthesis(line.split(reflector_type_key)[1]).strip()
-                                reflector_id_key = self.data[self.line_tracking + iterator - 1].split()[1].strip()
-                                pt_dict['reflector_id'] = remove_parenthesis(
-                                    self.data[self.line_tracking + iterator - 1].split(reflector_id_key)[1]).strip()
-                                reflector_type, reflector_constant = split_number_at_end(reflector)
-                                pt_dict['reflector_type'] = reflector_type
-                                pt_dict['reflector_constant'] = reflector_constant
-
-                            elif 'helm_inst_meas_style_text_' in line:
-                                instrument_measure_style_key = remove_parenthesis(line.split()[1]).strip()
-                                pt_dict['ms_name'] = remove_parenthesis(
-                                    line.split(instrument_measure_style_key)[1]).strip()
-                                instrument_measure_style_name_key = \
-                                self.data[self.line_tracking + iterator - 1].split()[1].strip()
-                                pt_dict['ms_id'] = remove_parenthesis(
-                                    self.data[self.line_tracking + iterator - 1].split(
-                                        instrument_measure_style_name_key)[1]).strip()
-
-                            elif 'helm_tps_settings_text_' in line:
-                                instrument_setting_key = remove_parenthesis(line.split()[1]).strip()
-                                pt_dict['set_name'] = remove_parenthesis(
-                                    line.split(instrument_setting_key)[1]).strip()
-                                instrument_setting_name_key = self.data[self.line_tracking + iterator - 1].split()[
-                                    1].strip()
-                                pt_dict['set_id'] = remove_parenthesis(
-                                    self.data[self.line_tracking + iterator - 1].split(instrument_setting_name_key)[
-                                        1]).strip()
-
-                            zkey = remove_parenthesis(line.split()[1]).strip()
-                            value = remove_parenthesis(line.split(zkey)[1]).strip()
-                            zkey = key[:-1]
-                            pt_dict.update({zkey: value})
-
-                            if zkey == 'helm_tps_settings_text':
-                                resection_points.append(pt_dict)
-                                pt_dict = {}
+            # The resection points run from the Helmert Details group to the check shot, or to the end of the setup
+            start = self.line_tracking + 2
+            stop = self.section_index.find(CHECK_SHOT, start, len(self.data))
+            if stop is None:
+                stop = len(self.data)
 
-        else:
-            self.setup_object = create_over_point_setup(setup_dict)
+            resection_points = extract_helmert_points(parse_attributes(self.data[start:stop]))
+            self.setup_data = StationSetupData(True, setup_dict, resection_points)
 
+        else:
+            self.setup_data = StationSetupData(False, setup_dict, [])
+
+
+def extract_helmert_points(attributes: Dict[str, str]) -> List[Dict[str, Any]]:
+    """
+    Groups the numbered Helmert Details attributes (helm_id_1, helm_x_1, ...) into one dict per resection point.
+
+    Each dict holds the attributes without their number, plus the reflector, measure style and settings
+    split out of their text attributes. A point is only complete once it has its helm_tps_settings_text.
+
+    :param attributes: The attributes of the Helmert Details group.
+    :return: The resection points, in the order they are numbered in the file.
+    """
+    numbered = {}
+    for name, value in attributes.items():
+        match = HELMERT_ATTRIBUTE.match(name)
+        if match:
+            numbered.setdefault(match.group(2), {})[match.group(1)] = value
+
+    resection_points = []
+    for point in numbered.values():
+        if 'helm_tps_settings_text' not in point:
+            continue
+
+        reflector = point.get('helm_tps_reflector_type_as_text', '')
+        point['reflector_id'] = point.get('helm_tps_reflector_type')
+        point['reflector_type'], point['reflector_constant'] = split_number_at_end(reflector)
+        point['ms_id'] = point.get('helm_inst_meas_style')
+        point['ms_name'] = point.get('helm_inst_meas_style_text')
+        point['set_id'] = point.get('helm_tps_settings')
+        point['set_name'] = point['helm_tps_settings_text']
+        resection_points.append(point)
+
+    return resection_points
@@ -1,37 +1,23 @@
 import os
 import re
-import chardet
-import hashlib
 from typing import Optional
 
 from zipfile import ZipFile, BadZipfile
 
+from .text_from_12d import create_hash, get_file_encoding as sniff_file_encoding
+
 # REGEX
 PATTERN = re.compile("\\b(text|real|integer|string)\\W", re.I)
 
 
-def create_hash(*item):
-    string_for_hash_bytes = "".join([str(item) for item in item]).encode()
-    hash_object = hashlib.md5(string_for_hash_bytes)
-    hash_key = hash_object.hexdigest()
-    return hash_key
-
-
 def get_file_encoding(file_path: str) -> tuple[str, float]:
     """
-    Detects the encoding and confidence level of a file.
+    Detects the encoding and confidence level of a file from a bounded prefix.
 
     :param file_path: The path to the file.
     :return: A tuple containing the encoding and confidence level.
     """
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()
-
-    result = chardet.detect(raw_data)
-    encoding = result['encoding']
-    confidence = result['confidence']
-
-    return encoding, confidence
+    return sniff_file_encoding(file_path)
 
 
 def split_string(input_string: str) -> list[str]:
@@ -117,14 +103,7 @@ class TextFrom12dConverter:
 
         """
 
-        with open(self.file_path, 'rb') as file:
-            raw_data = file.read()
-
-        result = chardet.detect(raw_data)
-        encoding = result['encoding']
-        confidence = result['confidence']
-
-        return encoding, confidence
+        return sniff_file_encoding(self.file_path)
 
     def convert_12da_to_text(self) -> Optional[str]:
         """
@@ -1,14 +1,51 @@
+import codecs
+import io
 import os
 import re
 import chardet
 import hashlib
-from typing import Optional
+import zipfile
+from typing import Iterator, Optional
 
 from zipfile import ZipFile, BadZipfile
 
 # REGEX
 PATTERN = re.compile("\\b(text|real|integer|string)\\W", re.I)
 
+# Bytes pulled from the archive member per read when streaming a .12daz
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Bytes read from the start of a file when sniffing its encoding
+ENCODING_SNIFF_SIZE = 64 * 1024
+
+# Longest BOMs first, so a UTF-32 LE BOM is not mistaken for UTF-16 LE
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# 12d writes .12daz members as UTF-16, so that is what a member is read as when its prefix doesn't say otherwise
+ZIP_MEMBER_ENCODING = 'utf-16'
+
+# The share of the high (or low) bytes that have to be NUL for a prefix without a BOM to be taken as UTF-16.
+# ASCII text in UTF-16 has a NUL in every other byte.
+UTF16_NUL_RATIO = 0.4
+
+
+class EncodingRestart(Exception):
+    """
+    Raised by stream_12da_lines when the encoding sniffed from the prefix turns out to be wrong after some lines have
+    already been handed out. The lines read so far can't be trusted, so the caller has to start again with encoding.
+    """
+
+    def __init__(self, file_path: str, encoding: str):
+        super().__init__(f'{file_path} is {encoding}, not the encoding sniffed from its prefix')
+        self.file_path = file_path
+        self.encoding = encoding
+
 
 def create_hash(*item):
     string_for_hash_bytes = "".join([str(item) for item in item]).encode()
@@ -17,23 +54,95 @@ def create_hash(*item):
     return hash_key
 
 
-def get_file_encoding(file_path: str) -> tuple[str, float]:
+def detect_encoding(prefix: bytes, fallback: Optional[str] = None) -> tuple[str, float]:
     """
-    Detects the encoding and confidence level of a file.
+    Detects the encoding of a file from the first bytes of its content.
 
-    :param file_path: The path to the file.
+    The BOM is checked first, then the NULs of UTF-16 without a BOM, then whether the prefix decodes as UTF-8.
+    NULs are valid UTF-8, so a prefix with any in it is never taken as UTF-8.
+    chardet is only used when none of those settles it.
+
+    :param prefix: The first bytes of the file, at most ENCODING_SNIFF_SIZE of them.
+    :param fallback: The encoding returned instead of asking chardet, if the kind of file implies one.
     :return: A tuple containing the encoding and confidence level.
     """
-    with open(file_path, 'rb') as file:
-        raw_data = file.read()
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if prefix.startswith(bom):
+            return encoding, 1.0
+
+    if b'\x00' in prefix:
+        encoding = detect_utf16_without_bom(prefix)
+        if encoding is not None:
+            return encoding, 0.95
+        return (fallback, 0.5) if fallback else chardet_encoding(prefix)
+
+    try:
+        # A multibyte character may be cut off at the end of the prefix, so don't finalise the decode.
+        # Plain ASCII passes here too.
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+        return 'utf-8', 0.99
+    except UnicodeDecodeError:
+        pass
+
+    return (fallback, 0.5) if fallback else chardet_encoding(prefix)
+
+
+def detect_utf16_without_bom(prefix: bytes) -> Optional[str]:
+    """
+    The byte order of UTF-16 text without a BOM, from where its NULs fall.
+
+    :return: 'utf-16-le' when the odd bytes are NUL, 'utf-16-be' when the even ones are, otherwise None.
+    """
+    units = len(prefix) // 2
+    if units == 0:
+        return None
+
+    even_nuls = prefix[0:units * 2:2].count(0)
+    odd_nuls = prefix[1:units * 2:2].count(0)
+
+    if odd_nuls >= units * UTF16_NUL_RATIO and even_nuls * 4 <= odd_nuls:
+        return 'utf-16-le'
+    if even_nuls >= units * UTF16_NUL_RATIO and odd_nuls * 4 <= even_nuls:
+        return 'utf-16-be'
+    return None
 
-    result = chardet.detect(raw_data)
+
+def chardet_encoding(data: bytes) -> tuple[str, float]:
+    result = chardet.detect(data)
     encoding = result['encoding']
     confidence = result['confidence']
 
     return encoding, confidence
 
 
+def get_file_encoding(file_path: str, sniff_size: int = ENCODING_SNIFF_SIZE) -> tuple[str, float]:
+    """
+    Detects the encoding and confidence level of a file from a bounded prefix.
+
+    :param file_path: The path to the file.
+    :param sniff_size: The number of bytes read from the start of the file.
+    :return: A tuple containing the encoding and confidence level.
+    """
+    with open(file_path, 'rb') as file:
+        prefix = file.read(sniff_size)
+
+    return detect_encoding(prefix)
+
+
+def get_full_file_encoding(file_path: str) -> tuple[str, float]:
+    """
+    Detects the encoding and confidence level of a file by passing all of it to chardet.
+    Only used when the prefix based detection turns out to be wrong further into the file.
+
+    :param file_path: The path to the file.
+    :return: A tuple containing the encoding and confidence level.
+    """
+    with open(file_path, 'rb') as file:
+        raw_data = file.read()
+
+    return chardet_encoding(raw_data)
+
+
 def split_string(input_string: str) -> list[str]:
     """
     Splits a string into substrings, using the space between quoted text as the delimiter.
@@ -84,17 +193,23 @@ class TextFrom12dConverter:
     A class for converting 12d files (.12da or .12daz) to text format.
 
     :args file_path (str): The path to the 12d file.
+    :args encoding (Optional[str]): The encoding of the file if it is already known, e.g. from
+        TertiaryControlFile.encoding. When None it is sniffed and stored on self.encoding.
 
     methods:
         get_12da_text(): Retrieves the raw text data from the 12d file.
+        iter_12da_lines(): Yields the lines of the 12d file one at a time.
         get_file_encoding(): Determines the encoding of the 12d file.
         convert_12da_to_text(): Converts a .12da file to text based on its encoding.
         convert_12daz_to_text(): Extracts and converts a .12daz file to text based on its encoding.
+        stream_12da_lines(): Streams the lines of a .12da file.
+        stream_12daz_lines(): Streams the lines of a .12daz archive member, decoding it chunk by chunk.
     """
 
-    def __init__(self, file_path: str):
+    def __init__(self, file_path: str, encoding: Optional[str] = None):
         file_path = file_path.replace(' ', '_')
         self.file_path = file_path
+        self.encoding = encoding
 
     def get_12da_text(self) -> Optional[str]:
         """
@@ -110,20 +225,35 @@ class TextFrom12dConverter:
         else:
             return self.convert_12daz_to_text()
 
+    def iter_12da_lines(self) -> Iterator[str]:
+        """
+        Yields the lines of the 12d file (.12da or .12daz) without holding the whole file in memory.
+
+        :return Iterator[str]: The lines of the file, without line endings or trailing whitespace.
+
+        """
+
+        _, ext = os.path.splitext(self.file_path)
+        # A .12daz saved as .12da is streamed from the archive instead of failing part way through as text
+        if ext == '.12da' and not zipfile.is_zipfile(self.file_path):
+            return self.stream_12da_lines()
+        else:
+            return self.stream_12daz_lines()
+
     def get_file_encoding(self):
         """
-        Determines the encoding of the 12d file.
+        Determines the encoding of the 12d file, sniffing only a bounded prefix of it.
+        A known encoding passed to the constructor is returned without reading the file.
 
         :return Tuple[str, float]: The encoding of the file and the confidence level.
 
         """
 
-        with open(self.file_path, 'rb') as file:
-            raw_data = file.read()
+        if self.encoding is not None:
+            return self.encoding, 1.0
 
-        result = chardet.detect(raw_data)
-        encoding = result['encoding']
-        confidence = result['confidence']
+        encoding, confidence = get_file_encoding(self.file_path)
+        self.encoding = encoding
 
         return encoding, confidence
 
@@ -168,3 +298,75 @@ class TextFrom12dConverter:
             raw_data = self.convert_12da_to_text()
 
         return raw_data
+
+    def stream_12da_lines(self) -> Iterator[str]:
+        """
+        Streams a .12da file line by line based on its encoding.
+
+        If the encoding sniffed from the prefix fails further into the file, the whole file is sniffed instead.
+        When no lines have been handed out yet the file is streamed again with that encoding, otherwise
+        EncodingRestart is raised so the caller can start over rather than mix lines of two decodings.
+        A file that can't be decoded to the end is never handed out cut short, the UnicodeDecodeError is raised.
+
+        :return Iterator[str]: The lines of the file, without line endings or trailing whitespace.
+        :raises EncodingRestart: If the encoding changed after some lines were yielded.
+        :raises UnicodeDecodeError: If the file doesn't decode with the encoding of the whole file either.
+
+        """
+
+        encoding = self.get_file_encoding()[0]
+        lines_read = 0
+
+        with open(self.file_path, 'r', encoding=encoding) as file:
+            try:
+                for line in file:
+                    lines_read += 1
+                    yield line.rstrip()
+                return
+            except UnicodeDecodeError as e:
+                print(f"UnicodeDecodeError: {self.file_path}")
+                error = e
+
+        # The prefix didn't represent the rest of the file. Fall back to sniffing all of it.
+        full_encoding = get_full_file_encoding(self.file_path)[0]
+        if full_encoding is None or codecs.lookup(full_encoding) == codecs.lookup(encoding):
+            raise error
+
+        self.encoding = full_encoding
+        if lines_read:
+            raise EncodingRestart(self.file_path, full_encoding)
+
+        with open(self.file_path, 'r', encoding=full_encoding) as file:
+            for line in file:
+                yield line.rstrip()
+
+    def stream_12daz_lines(self) -> Iterator[str]:
+        """
+        Streams the first member of a .12daz archive line by line.
+
+        The member is decompressed and decoded in STREAM_CHUNK_SIZE pieces, so memory use does not grow
+        with the size of the archive and the caller can start parsing before decompression finishes.
+        It is read as ZIP_MEMBER_ENCODING unless its prefix has a BOM, the NULs of UTF-16 without one, or is
+        plain UTF-8, as a member is UTF-16 unless it shows otherwise.
+
+        :return Iterator[str]: The lines of the archive member, without line endings or trailing whitespace.
+
+        """
+        try:
+            zip_file = ZipFile(self.file_path, 'r')
+        except BadZipfile:
+            print(f"BadZipfile: {self.file_path}")
+            yield from self.stream_12da_lines()
+            return
+
+        with zip_file:
+            file_name = zip_file.namelist()[0]
+
+            with zip_file.open(file_name) as member:
+                buffered = io.BufferedReader(member, buffer_size=STREAM_CHUNK_SIZE)
+                if self.encoding is None:
+                    self.encoding = detect_encoding(buffered.peek(ENCODING_SNIFF_SIZE), fallback=ZIP_MEMBER_ENCODING)[0]
+
+                with io.TextIOWrapper(buffered, encoding=self.encoding) as file:
+                    for line in file:
+                        yield line.rstrip()
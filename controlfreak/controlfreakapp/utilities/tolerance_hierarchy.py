@@ -0,0 +1,136 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from .fixed_point import point_keys, to_fixed_array
+from .geometry_manipulation import cylinder_pairs
+
+# iter_adjustment clusters within 3 x the tolerances and accepts a pair up to the tolerances plus this margin
+CLUSTER_TOLERANCE_FACTOR = 3
+ACCEPTANCE_MARGIN = .0009
+
+
+class ToleranceHierarchy:
+    """
+    The linkage of a set of shots, built once so the report for any tolerance can be previewed
+    without rerunning the clustering.
+
+    Every pair of shots close enough to be clustered at the largest tolerances that will be asked about is found with
+    one cylinder pair query. The clusters for a pair of tolerances are then the connected components of the pairs that
+    fit inside the smaller cylinder. Whether a cluster would be averaged is found from the horizontally close pairs
+    inside it and from its sorted elevations, without looking at every pair.
+
+    :args point_array (np.ndarray): An (n, 3) array of easting, northing and elevation, one row per distinct shot.
+    :args max_hz_tolerance (float): The largest Hz tolerance in metres that can be previewed.
+    :args max_vt_tolerance (float): The largest Vt tolerance in metres that can be previewed, max_hz_tolerance if not given.
+    """
+
+    def __init__(self, point_array: np.ndarray, max_hz_tolerance: float, max_vt_tolerance: float | None = None):
+        self.point_array = np.asarray(point_array, dtype=np.float64).reshape(-1, 3)
+        self.max_hz_tolerance = max_hz_tolerance
+        self.max_vt_tolerance = max_hz_tolerance if max_vt_tolerance is None else max_vt_tolerance
+
+        # The pairs that can link shots into a cluster
+        pairs = cylinder_pairs(
+            self.point_array,
+            self.max_hz_tolerance * CLUSTER_TOLERANCE_FACTOR,
+            self.max_vt_tolerance * CLUSTER_TOLERANCE_FACTOR
+        )
+        deltas = self.point_array[pairs[:, 0]] - self.point_array[pairs[:, 1]]
+        self.firsts = pairs[:, 0]
+        self.seconds = pairs[:, 1]
+        self.link_hz_deltas = np.hypot(deltas[:, 0], deltas[:, 1])
+        self.link_vt_deltas = np.abs(deltas[:, 2])
+
+        # The pairs that can pass the Hz check, whatever their height difference
+        hz_pairs = cKDTree(self.point_array[:, :2]).query_pairs(r=max_hz_tolerance + ACCEPTANCE_MARGIN, output_type='ndarray')
+        self.hz_firsts = hz_pairs[:, 0]
+        self.hz_seconds = hz_pairs[:, 1]
+        self.hz_deltas = np.hypot(*(self.point_array[hz_pairs[:, 0], :2] - self.point_array[hz_pairs[:, 1], :2]).T)
+
+    @classmethod
+    def from_control_points(cls, input_array, max_hz_tolerance: float, max_vt_tolerance: float | None = None) -> 'ToleranceHierarchy':
+        """
+        Builds the hierarchy from {id: ControlPoint} dicts. Like group_control_points, points that have already been
+        adjusted are dropped and points with the same coordinates are kept once.
+        """
+        points = [pt for item in input_array for pt in item.values() if not pt.adjusted]
+        unadjusted = dict(zip(point_keys(points), points))
+
+        return cls(
+            np.array([[pt.easting, pt.northing, pt.elevation] for pt in unadjusted.values()], dtype=np.float64),
+            max_hz_tolerance,
+            max_vt_tolerance
+        )
+
+    @classmethod
+    def from_point_array(cls, point_array: np.ndarray, max_hz_tolerance: float, max_vt_tolerance: float | None = None) -> 'ToleranceHierarchy':
+        """
+        Builds the hierarchy from an (n, 3) array of shots that haven't been adjusted, keeping shots with the same
+        coordinates once as from_control_points does.
+        """
+        point_array = np.asarray(point_array, dtype=np.float64).reshape(-1, 3)
+        _, first = np.unique(to_fixed_array(point_array), axis=0, return_index=True)
+        return cls(point_array[np.sort(first)], max_hz_tolerance, max_vt_tolerance)
+
+    def labels(self, hz_tolerance: float, vt_tolerance: float) -> np.ndarray:
+        """
+        The cluster of every shot at a pair of tolerances (in metres), numbered as the connected components of the
+        pairs inside the cylinder iter_adjustment clusters with.
+        """
+        if hz_tolerance > self.max_hz_tolerance or vt_tolerance > self.max_vt_tolerance:
+            raise ValueError(
+                f'The hierarchy was built for tolerances up to {self.max_hz_tolerance * 1000} mm Hz'
+                f' and {self.max_vt_tolerance * 1000} mm Vt'
+            )
+
+        n = len(self.point_array)
+        linked = (
+            (self.link_hz_deltas <= hz_tolerance * CLUSTER_TOLERANCE_FACTOR)
+            & (self.link_vt_deltas <= vt_tolerance * CLUSTER_TOLERANCE_FACTOR)
+        )
+        graph = coo_matrix(
+            (np.ones(int(linked.sum()), dtype=np.int8), (self.firsts[linked], self.seconds[linked])),
+            shape=(n, n)
+        )
+        return connected_components(graph, directed=False)[1]
+
+    def summary(self, hz_tolerance: float, vt_tolerance: float) -> dict:
+        """
+        What iter_adjustment would report at a pair of tolerances (in metres).
+
+        :return: The number of shots, clusters of repeated shots, clusters whose closest pair is within tolerance
+            (averaged), clusters that aren't (rejected) and shots that need additional observations (one_shot).
+        """
+        n = len(self.point_array)
+        labels = self.labels(hz_tolerance, vt_tolerance)
+        sizes = np.bincount(labels)
+
+        # The closest pair of a cluster passes the Hz check if any pair inside it does
+        hz_inside = (
+            (labels[self.hz_firsts] == labels[self.hz_seconds])
+            & (self.hz_deltas <= hz_tolerance + ACCEPTANCE_MARGIN)
+        )
+        hz_good = np.zeros(len(sizes), dtype=bool)
+        hz_good[labels[self.hz_firsts[hz_inside]]] = True
+
+        # The smallest height difference in a cluster is between neighbours once its shots are sorted by elevation
+        order = np.lexsort((self.point_array[:, 2], labels))
+        same_cluster = labels[order][1:] == labels[order][:-1]
+        gaps = np.diff(self.point_array[order, 2])
+        vt_good = np.zeros(len(sizes), dtype=bool)
+        vt_good[labels[order][1:][same_cluster & (gaps <= vt_tolerance + ACCEPTANCE_MARGIN)]] = True
+
+        clustered = sizes > 1
+        accepted = clustered & hz_good & vt_good
+
+        return {
+            'hz_tolerance': hz_tolerance * 1000,
+            'vt_tolerance': vt_tolerance * 1000,
+            'shots': n,
+            'clusters': int(clustered.sum()),
+            'averaged': int(accepted.sum()),
+            'rejected': int(clustered.sum() - accepted.sum()),
+            'one_shot': int((sizes == 1).sum()),
+        }
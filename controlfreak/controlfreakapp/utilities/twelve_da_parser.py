@@ -0,0 +1,277 @@
+import dataclasses
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+from .text_from_12d import TextFrom12dConverter, EncodingRestart, split_string, remove_parenthesis
+from .station_setup_parser import StationSetupParser, StationSetupData
+from .section_index import SectionIndex, INST_STAT_SETUP, GROUP, CHECK_SHOT, DATA_3D as DATA_3D_MARKER, SUPER as SUPER_MARKER
+
+def parse_coordinate_block(lines: List[str]) -> np.ndarray:
+    """
+    Converts the lines of a data_3d block to an (n, 3) float64 array in one call.
+
+    :param lines: The lines between 'data_3d {' and its closing brace.
+    :return: The coordinates, one row per line. Parsing stops at the first line that isn't a coordinate.
+    """
+    values = " ".join(lines).split()
+
+    if len(values) == 3 * len(lines):
+        try:
+            return np.array(values, dtype=np.float64).reshape(-1, 3)
+        except ValueError:
+            pass
+
+    # Ragged or non numeric lines, so find where the coordinates stop one line at a time
+    coordinates = []
+    for line in lines:
+        try:
+            coordinates.append([float(item) for item in line.split()][:3])
+        except ValueError:
+            break
+
+    return np.array(coordinates, dtype=np.float64).reshape(-1, 3)
+
+
+# Parser states
+OUTSIDE = 0
+SUPER_NAME = 1
+DATA_3D = 2
+POINT_DATA = 3
+STATION_SETUP = 4
+
+
+@dataclasses.dataclass
+class SuperStringRecord:
+    line_number: int
+    name: str
+
+
+@dataclasses.dataclass
+class CoordinateBlockRecord:
+    line_number: int
+    coordinates: np.ndarray  # (n, 3) float64 of easting, northing, elevation
+
+
+@dataclasses.dataclass
+class PointNameBlockRecord:
+    line_number: int
+    names: List[str]
+
+
+@dataclasses.dataclass
+class StationSetupRecord:
+    line_number: int
+    lines: List[str]
+    section_index: SectionIndex  # The sections within lines, offsets relative to the first line
+
+
+class TwelveDaParser:
+    """
+    A single pass tokenizer for 12da text.
+
+    Every line is visited once. The parser tracks which block it is in and yields typed records
+    as each block closes, so it can consume the lines straight from TextFrom12dConverter.iter_12da_lines().
+
+    :args lines (Iterable[str]): The lines of the 12da file, without trailing whitespace.
+
+    Records:
+        SuperStringRecord: The name of a super string, used as the target type of its points.
+        CoordinateBlockRecord: The coordinates of a data_3d block, as an (n, 3) float64 array.
+        PointNameBlockRecord: The point names of a point_data block.
+        StationSetupRecord: The lines of an "Inst Stat Setup" group, starting at its name line.
+
+    While it reads, the parser fills in section_index with the line offset of every section of the file,
+    and each StationSetupRecord carries the part of that index covering its own lines.
+
+    Only the first station setup after each data_3d block is captured, as that is the setup the
+    points were observed from. A consumer that cannot use the captured setup can set
+    capture_setups back to True to have the next one captured as well.
+    """
+
+    def __init__(self, lines: Iterable[str]):
+        self.lines = lines
+        self.capture_setups = True
+        self.section_index = SectionIndex()
+
+    def __iter__(self) -> Iterator[SuperStringRecord | CoordinateBlockRecord | PointNameBlockRecord | StationSetupRecord]:
+        state = OUTSIDE
+        block_start = 0
+        collector = []
+        depth = 0
+        index = self.section_index
+
+        for line_number, line in enumerate(self.lines):
+            # Most lines are attributes outside any block of interest, so keep that path to one or two tests.
+            # Block openers end in '{' and closers end in '}'.
+            if state == OUTSIDE:
+                if line.endswith('{'):
+                    stripped = line.lstrip()
+                    if stripped.startswith(GROUP):
+                        index.add(GROUP, line_number)
+                    elif stripped.startswith('data_3d'):
+                        index.add(DATA_3D_MARKER, line_number)
+                        # A new set of points needs its own station setup
+                        self.capture_setups = True
+                        state = DATA_3D
+                        block_start = line_number
+                        collector = []
+                    elif stripped.startswith('point_data'):
+                        state = POINT_DATA
+                        block_start = line_number
+                        collector = []
+                    elif 'super ' in stripped:
+                        index.add(SUPER_MARKER, line_number)
+                        state = SUPER_NAME
+
+                elif INST_STAT_SETUP in line:
+                    index.add(INST_STAT_SETUP, line_number)
+                    if self.capture_setups:
+                        state = STATION_SETUP
+                        block_start = line_number
+                        collector = [line]
+                        depth = 1
+
+                elif CHECK_SHOT in line:
+                    index.add(CHECK_SHOT, line_number)
+
+            elif state == STATION_SETUP:
+                if line.endswith('{'):
+                    depth += 1
+                    if line.lstrip().startswith(GROUP):
+                        index.add(GROUP, line_number)
+                elif line.endswith('}'):
+                    depth -= 1
+                    if depth == 0:
+                        # The group holding the setup has closed
+                        state = OUTSIDE
+                        self.capture_setups = False
+                        yield StationSetupRecord(block_start, collector, index.window(block_start, line_number))
+                        continue
+                elif CHECK_SHOT in line:
+                    index.add(CHECK_SHOT, line_number)
+
+                collector.append(line)
+
+            elif state == DATA_3D:
+                # Only find the end of the block here, the coordinates are converted all at once
+                if line.endswith('}'):
+                    state = OUTSIDE
+                    yield CoordinateBlockRecord(block_start, parse_coordinate_block(collector))
+                elif line:
+                    collector.append(line)
+
+            elif state == POINT_DATA:
+                if '}' in line:
+                    state = OUTSIDE
+                    yield PointNameBlockRecord(block_start, collector)
+                else:
+                    collector.extend(split_string(line))
+
+            elif state == SUPER_NAME:
+                state = OUTSIDE
+                if 'name ' in line:
+                    target_type = remove_parenthesis(line.split()[1].strip())
+                    if target_type == '':
+                        target_type = 'Not specified'
+                    yield SuperStringRecord(line_number, target_type)
+
+        # Close off a block left open at the end of the file
+        if state == DATA_3D:
+            yield CoordinateBlockRecord(block_start, parse_coordinate_block(collector))
+        elif state == POINT_DATA:
+            yield PointNameBlockRecord(block_start, collector)
+        elif state == STATION_SETUP:
+            self.capture_setups = False
+            yield StationSetupRecord(block_start, collector, index.window(block_start, block_start + len(collector)))
+
+
+@dataclasses.dataclass
+class PointBlock:
+    """
+    The points of one point_data block, paired with the coordinates of its data_3d block.
+    """
+    names: List[str]
+    coordinates: np.ndarray  # (n, 3) float64, may be a view of a memory-mapped cache file
+    target_type: str
+
+    def as_rows(self) -> List[list]:
+        """
+        :return: The points as [id, easting, northing, elevation, target_type] lists.
+        """
+        return [[name] + coordinate + [self.target_type] for name, coordinate in zip(self.names, self.coordinates.tolist())]
+
+
+@dataclasses.dataclass
+class ParsedControlFile:
+    """
+    Everything create_control_point_objects needs from a 12d file, read without touching the database.
+
+    :args encoding (str): The text encoding the file was decoded with.
+    :args events (list): In file order, one of
+        ('coordinates', None) when a data_3d block starts a new set of points,
+        ('points', PointBlock) for each point_data block,
+        ('setup', StationSetupData) for each station setup that could be read.
+    """
+    encoding: str
+    events: List[tuple]
+
+
+def parse_control_file(path: str, encoding: str | None = None) -> ParsedControlFile:
+    """
+    Decodes and parses a 12d file. This is pure, so it can run in a worker process.
+
+    Every station setup is parsed, not only the first one after each data_3d block. Which setup the points
+    get attached to depends on whether it can be written to the database, so that is left to the writer.
+
+    :param path: The path of the .12da or .12daz file.
+    :param encoding: The encoding sniffed on a previous upload, if known.
+    :return: The parsed file.
+    """
+    try:
+        return _parse_control_file(path, encoding)
+    except EncodingRestart as e:
+        # Part of the file had been parsed with the wrong encoding, so nothing parsed so far is kept
+        print(f'Parsing {path} again as {e.encoding}')
+        return _parse_control_file(path, e.encoding)
+
+
+def _parse_control_file(path: str, encoding: str | None) -> ParsedControlFile:
+    converter = TextFrom12dConverter(path, encoding=encoding)
+    parser = TwelveDaParser(converter.iter_12da_lines())
+
+    events = []
+    coordinates_block = np.empty((0, 3))
+    previous_id = None
+    target_type = block_target_type = 'Not specified'
+
+    for record in parser:
+
+        if isinstance(record, SuperStringRecord):
+            target_type = record.name
+
+        elif isinstance(record, CoordinateBlockRecord):
+            coordinates_block = record.coordinates
+            block_target_type = target_type
+            events.append(('coordinates', None))
+
+        elif isinstance(record, PointNameBlockRecord):
+            names = []
+            keep = []
+            # Pair the names with the coordinates of the block they belong to
+            for i, point_data in enumerate(record.names[:len(coordinates_block)]):
+                # Repeated shots on the same point id are only kept once
+                if point_data != previous_id:
+                    names.append(point_data)
+                    keep.append(i)
+                previous_id = point_data
+            events.append(('points', PointBlock(names, coordinates_block[keep], block_target_type)))
+            coordinates_block = np.empty((0, 3))
+
+        elif isinstance(record, StationSetupRecord):
+            parser.capture_setups = True
+            setup_data = StationSetupParser(record.lines, 0, record.section_index).return_setup_data()
+            if setup_data is not None:
+                events.append(('setup', setup_data))
+
+    return ParsedControlFile(converter.encoding, events)
@@ -1,11 +1,34 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import JsonResponse, FileResponse
+from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from .forms import FileUploadForm
-from .models import TertiaryControlFile
-from .utilities.process_files import create_control_point_objects, adjust_tertiary_control_points, create_internet_zip, write_to_report_csv
-import time
+from .models import TertiaryControlFile, ReportJob
+from .utilities.process_files import tolerance_hierarchy_for_files
+
+
+def report_job_json(job):
+    return {
+        'job_id': job.pk,
+        'status': job.status,
+        'stage': job.stage,
+        'percent': job.percent,
+        'error': job.error,
+        'page_url': reverse('report-job-page-view', args=[job.pk]),
+        'status_url': reverse('report-job-status-view', args=[job.pk]),
+        'download_url': reverse('report-job-download-view', args=[job.pk]),
+        'progress_url': f'/ws/report_jobs/{job.pk}/',
+    }
+
+
+def wants_json(request) -> bool:
+    """
+    Whether the client asked for JSON rather than a page, a browser asks for text/html first.
+    """
+    return request.accepts('application/json') and not request.accepts('text/html')
+
 
 def file_upload_view(request):
-    collector = []
     if request.method == 'POST':
         form = FileUploadForm(request.POST, request.FILES)
         if form.is_valid():
@@ -14,25 +37,87 @@ def file_upload_view(request):
 
             vt_tol = form.cleaned_data['vertical_tolerance']
             report_name = form.cleaned_data['report_name']
+            uploaded_files = []
             for file in files:
                 uploaded_file = TertiaryControlFile(file=file)
                 file_hash = uploaded_file.save()
-                time.sleep(1)
                 if file_hash is not None:
                     uploaded_file = TertiaryControlFile.objects.get(file_hash=file_hash)
 
                 print(uploaded_file.file.path)
+                uploaded_files.append(uploaded_file)
 
-                collector.extend(create_control_point_objects(uploaded_file)) # Replace with your processing function
-            # Redirect or respond after processing
-            #return render(request, 'upload.html', {'form': form, 'collector': collector})
-            #for item in collector:
-            #    print(item)
-            report, one_shot, proposed_rows = adjust_tertiary_control_points(collector, hz_tol, vt_tol)
-            report_csv = write_to_report_csv(report)
-            one_shot_csv = write_to_report_csv(one_shot)
-            proposed_csv = write_to_report_csv(proposed_rows)
-            return(create_internet_zip(report_csv, one_shot_csv, proposed_csv, report_name))
+            # The files are ingested and adjusted by the run_report_jobs worker, the form goes on to a page that
+            # follows the job and a client that asks for JSON polls status_url itself
+            job = ReportJob.objects.create(
+                kind=ReportJob.UPLOAD,
+                report_name=report_name,
+                hz_tolerance=hz_tol,
+                vt_tolerance=vt_tol,
+                file_ids=[uploaded_file.pk for uploaded_file in uploaded_files],
+            )
+            if wants_json(request):
+                return JsonResponse(report_job_json(job), status=202)
+            return redirect('report-job-page-view', job_id=job.pk)
     else:
         form = FileUploadForm()
     return render(request, 'upload.html', {'form': form})
+
+
+def tolerance_preview_view(request):
+    """
+    Previews the report of some already uploaded files at one or more tolerances, without writing anything.
+
+    GET ?files=1,2&hz=3&vt=3&hz=5&vt=5 (tolerances in mm, paired in order)
+    returns {"previews": [{"hz_tolerance": 3.0, "vt_tolerance": 3.0, "shots": ..., "clusters": ...,
+    "averaged": ..., "rejected": ..., "one_shot": ...}, ...]}
+    """
+    try:
+        file_pks = tuple(sorted({int(pk) for pk in request.GET.get('files', '').split(',') if pk}))
+        hz_tols = [float(value) for value in request.GET.getlist('hz')]
+        vt_tols = [float(value) for value in request.GET.getlist('vt')]
+    except ValueError:
+        return JsonResponse({'error': 'files must be a comma separated list of ids and hz/vt must be numbers'}, status=400)
+
+    if not file_pks or not hz_tols or len(hz_tols) != len(vt_tols):
+        return JsonResponse({'error': 'files and at least one hz/vt pair are required'}, status=400)
+
+    max_tolerance = getattr(settings, 'PREVIEW_MAX_TOLERANCE', 20)
+    if max(hz_tols + vt_tols) > max_tolerance:
+        return JsonResponse({'error': f'hz and vt can be at most {max_tolerance} mm'}, status=400)
+
+    # Built once per set of shots, each tolerance is then a query against it. The earlier shots near the files
+    # depend on the tolerance, but are usually the same for all of them.
+    previews = [
+        tolerance_hierarchy_for_files(file_pks, max_tolerance, hz_tol, vt_tol).summary(hz_tol / 1000, vt_tol / 1000)
+        for hz_tol, vt_tol in zip(hz_tols, vt_tols)
+    ]
+
+    return JsonResponse({'files': list(file_pks), 'previews': previews})
+
+
+def report_job_page_view(request, job_id):
+    """
+    A page that follows a job, polling report_job_status_view until the zip can be downloaded.
+    """
+    job = get_object_or_404(ReportJob, pk=job_id)
+    return render(request, 'report_job.html', {'job': job, 'job_json': report_job_json(job)})
+
+
+def report_job_status_view(request, job_id):
+    """
+    GET returns {"job_id": ..., "status": "queued" | "running" | "done" | "failed", "stage": ..., "percent": ...,
+    "error": ..., "status_url": ..., "download_url": ..., "progress_url": <the websocket of ReportJobConsumer>}
+    """
+    return JsonResponse(report_job_json(get_object_or_404(ReportJob, pk=job_id)))
+
+
+def report_job_download_view(request, job_id):
+    """
+    The zip of a finished job. A job that hasn't finished gets a 409 with its status instead.
+    """
+    job = get_object_or_404(ReportJob, pk=job_id)
+    if job.status != ReportJob.DONE:
+        return JsonResponse(report_job_json(job), status=409)
+
+    return FileResponse(job.result.open('rb'), as_attachment=True, filename=f'{job.report_name}.zip', content_type='application/zip')